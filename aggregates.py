@@ -0,0 +1,91 @@
+# aggregates.py
+# Dashboard aggregates (per-program enrollment counts, registry totals and the
+# most recent registrations) kept up to date incrementally from the change
+# feed in changes.py, so reading them costs the same at any registry size.
+from collections import Counter
+from sqlalchemy import delete, func, insert, select, update
+from changes import on_flush
+from models import db, Client, ProgramModel, ProgramStat, RegistryStat, RecentRegistration, enrollments
+
+RECENT_REGISTRATIONS = 10
+
+# Recompute everything from the base tables (startup backfill / repair)
+def rebuild(connection):
+    connection.execute(delete(ProgramStat))
+    counts = (select(enrollments.c.program_id, func.count().label('n'))
+              .group_by(enrollments.c.program_id).subquery())
+    connection.execute(insert(ProgramStat).from_select(
+        ['program_id', 'name', 'client_count'],
+        select(ProgramModel.id, ProgramModel.name, func.coalesce(counts.c.n, 0))
+        .outerjoin(counts, counts.c.program_id == ProgramModel.id)
+    ))
+    connection.execute(delete(RegistryStat))
+    connection.execute(insert(RegistryStat), [
+        {"key": "total_clients", "value": connection.scalar(select(func.count()).select_from(Client))},
+        {"key": "total_programs", "value": connection.scalar(select(func.count()).select_from(ProgramModel))},
+    ])
+    _refresh_recent(connection)
+
+def init_aggregates():
+    if db.session.get(RegistryStat, 'total_clients') is None:
+        rebuild(db.session.connection())
+        db.session.commit()
+
+def _refresh_recent(connection):
+    connection.execute(delete(RecentRegistration))
+    connection.execute(insert(RecentRegistration).from_select(
+        ['client_id', 'name'],
+        select(Client.id, Client.name).order_by(Client.id.desc()).limit(RECENT_REGISTRATIONS)
+    ))
+
+def _add_total(connection, key, delta):
+    if delta:
+        connection.execute(update(RegistryStat).where(RegistryStat.key == key)
+                           .values(value=RegistryStat.value + delta))
+
+@on_flush
+def _apply_changes(connection, changes):
+    if connection.scalar(select(RegistryStat.value).where(RegistryStat.key == 'total_clients')) is None:
+        rebuild(connection)  # store missing (fresh tables): the rebuild already includes this change
+        return
+
+    programs = changes.programs
+    if programs['deleted']:
+        connection.execute(delete(ProgramStat).where(ProgramStat.program_id.in_(programs['deleted'])))
+    if programs['inserted']:
+        connection.execute(insert(ProgramStat).from_select(
+            ['program_id', 'name', 'client_count'],
+            select(ProgramModel.id, ProgramModel.name, 0).where(ProgramModel.id.in_(programs['inserted']))
+        ))
+    for program_id in programs['updated'] - programs['deleted']:
+        name = select(ProgramModel.name).where(ProgramModel.id == program_id).scalar_subquery()
+        connection.execute(update(ProgramStat).where(ProgramStat.program_id == program_id).values(name=name))
+
+    deltas = Counter(p for _, p in changes.enrolled)
+    deltas.subtract(p for _, p in changes.unenrolled)
+    for program_id, delta in deltas.items():
+        if delta and program_id not in programs['deleted']:
+            connection.execute(update(ProgramStat).where(ProgramStat.program_id == program_id)
+                               .values(client_count=ProgramStat.client_count + delta))
+
+    clients = changes.clients
+    _add_total(connection, 'total_clients', len(clients['inserted']) - len(clients['deleted']))
+    _add_total(connection, 'total_programs', len(programs['inserted']) - len(programs['deleted']))
+    if any(clients.values()):
+        _refresh_recent(connection)
+
+# Everything the dashboard shows, read from the aggregate tables only
+def dashboard_snapshot():
+    totals = dict(db.session.execute(select(RegistryStat.key, RegistryStat.value)).all())
+    programs = db.session.execute(
+        select(ProgramStat.name, ProgramStat.client_count).order_by(ProgramStat.program_id)
+    ).all()
+    recent = db.session.execute(
+        select(RecentRegistration.client_id, RecentRegistration.name).order_by(RecentRegistration.client_id.desc())
+    ).all()
+    return {
+        "total_clients": totals.get('total_clients', 0),
+        "total_programs": totals.get('total_programs', 0),
+        "programs": [{"name": name, "client_count": count} for name, count in programs],
+        "recent_clients": [{"id": client_id, "name": name} for client_id, name in recent],
+    }
@@ -0,0 +1,209 @@
+# analytics.py
+# Cohort rollups for the dashboard, the summary page and /api/analytics:
+# per program, enrolled clients by gender and age band, and enrollments per
+# month. Like aggregates.py, the counts are kept up to date from the change
+# feed, in the writing transaction, in two small tables (models.py):
+# demographic_stat holds counts per (program, gender, birth year), so a read
+# groups a few thousand rows instead of joining enrollments to every client.
+# Age bands are applied when reading: a client's age is the one reached in
+# the current calendar year.
+from collections import Counter, defaultdict
+from datetime import date
+from sqlalchemy import case, delete, extract, func, insert, select, update, bindparam
+from changes import on_flush
+from models import db, Client, DemographicStat, EnrollmentTrend, ProgramModel, ProgramStat, enrollments
+from cache import cache
+from versions import version_tag
+
+REGISTRY = 0  # program_id of the whole-registry rows
+AGE_BANDS = ((0, '0-4'), (5, '5-14'), (15, '15-24'), (25, '25-34'), (35, '35-49'), (50, '50-64'), (65, '65+'))
+MAX_TREND_MONTHS = 60
+BATCH = 500
+
+def _birth_year(column):
+    return extract('year', column)
+
+# Recompute the demographics from the base tables (startup backfill / repair).
+# Monthly trends can't be recovered from the base tables: rows of programs
+# that no longer exist are dropped, the rest are kept.
+def rebuild(connection):
+    connection.execute(delete(DemographicStat))
+    year = _birth_year(Client.dob)
+    connection.execute(insert(DemographicStat).from_select(
+        ['program_id', 'gender', 'birth_year', 'client_count'],
+        select(enrollments.c.program_id, Client.gender, year, func.count())
+        .select_from(enrollments.join(Client, Client.id == enrollments.c.client_id))
+        .group_by(enrollments.c.program_id, Client.gender, year)
+    ))
+    connection.execute(insert(DemographicStat).from_select(
+        ['program_id', 'gender', 'birth_year', 'client_count'],
+        select(REGISTRY, Client.gender, year, func.count()).group_by(Client.gender, year)
+    ))
+    connection.execute(delete(EnrollmentTrend).where(
+        EnrollmentTrend.program_id != REGISTRY, EnrollmentTrend.program_id.not_in(select(ProgramModel.id))))
+
+def init_analytics():
+    empty = db.session.scalar(select(DemographicStat.program_id).limit(1)) is None
+    if empty and db.session.scalar(select(Client.id).limit(1)) is not None:
+        rebuild(db.session.connection())
+        db.session.commit()
+
+def _upsert(connection, model, keys, deltas):
+    # deltas: {key tuple: {column: delta}}; rows are created on first use
+    key_columns = [getattr(model, k) for k in keys]
+    programs = {key[0] for key in deltas}
+    existing = set(map(tuple, connection.execute(
+        select(*key_columns).where(key_columns[0].in_(programs)))))
+    columns = sorted({c for values in deltas.values() for c in values})
+    updates, inserts = [], []
+    for key, values in deltas.items():
+        row = dict(zip(keys, key))
+        if key in existing:
+            updates.append({**{f'_{k}': v for k, v in row.items()}, **{c: values.get(c, 0) for c in columns}})
+        else:
+            inserts.append({**row, **{c: values.get(c, 0) for c in columns}})
+    if updates:
+        connection.execute(
+            update(model).where(*[column == bindparam(f'_{k}') for k, column in zip(keys, key_columns)])
+            .values({c: getattr(model, c) + bindparam(c) for c in columns}),
+            updates)
+    if inserts:
+        connection.execute(insert(model), inserts)
+
+def _client_deltas(connection, changes, dropped):
+    clients = changes.clients
+    enrolled_by, unenrolled_by = defaultdict(set), defaultdict(set)
+    for client_id, program_id in changes.enrolled:
+        if program_id not in dropped:
+            enrolled_by[client_id].add(program_id)
+    for client_id, program_id in changes.unenrolled:
+        if program_id not in dropped:
+            unenrolled_by[client_id].add(program_id)
+    affected = sorted(set(enrolled_by) | set(unenrolled_by) | clients['inserted'] | clients['deleted']
+                      | set(changes.client_before))
+
+    deltas = Counter()
+    for start in range(0, len(affected), BATCH):
+        chunk = affected[start:start + BATCH]
+        now = {row[0]: (row[1], row[2]) for row in connection.execute(
+            select(Client.id, Client.gender, Client.dob).where(Client.id.in_(chunk)))}
+        programs = defaultdict(set)
+        for client_id, program_id in connection.execute(
+                select(enrollments.c.client_id, enrollments.c.program_id).where(enrollments.c.client_id.in_(chunk))):
+            programs[client_id].add(program_id)
+        for client_id in chunk:
+            new = now.get(client_id)
+            if client_id in changes.client_before:
+                old = changes.client_before[client_id]
+            else:
+                old = None if client_id in clients['inserted'] else new
+            # A client counts towards its programs and the registry row;
+            # the programs it had are today's minus this change's enrollments
+            if new is not None:
+                for program_id in programs[client_id] | {REGISTRY}:
+                    deltas[(program_id, new[0], new[1].year)] += 1
+            if old is not None:
+                before = (programs[client_id] - enrolled_by[client_id]) | unenrolled_by[client_id] | {REGISTRY}
+                for program_id in before:
+                    deltas[(program_id, old[0], old[1].year)] -= 1
+    return {key: {'client_count': delta} for key, delta in deltas.items() if delta}
+
+@on_flush
+def _apply_changes(connection, changes):
+    dropped = changes.programs['deleted']
+    if dropped:
+        connection.execute(delete(DemographicStat).where(DemographicStat.program_id.in_(dropped)))
+        connection.execute(delete(EnrollmentTrend).where(EnrollmentTrend.program_id.in_(dropped)))
+
+    demographics = _client_deltas(connection, changes, dropped)
+    if demographics:
+        _upsert(connection, DemographicStat, ('program_id', 'gender', 'birth_year'), demographics)
+
+    month = date.today().strftime('%Y-%m')
+    trend = defaultdict(Counter)
+    for _, program_id in changes.enrolled:
+        trend[(program_id, month)]['enrolled'] += 1
+    for _, program_id in changes.unenrolled:
+        trend[(program_id, month)]['unenrolled'] += 1
+    if changes.clients['inserted']:
+        trend[(REGISTRY, month)]['enrolled'] += len(changes.clients['inserted'])
+    if changes.clients['deleted']:
+        trend[(REGISTRY, month)]['unenrolled'] += len(changes.clients['deleted'])
+    trend = {key: counts for key, counts in trend.items() if key[0] not in dropped}
+    if trend:
+        _upsert(connection, EnrollmentTrend, ('program_id', 'month'), trend)
+
+# --- READS ---
+
+def _age_band(year):
+    # Oldest band first: a birth year at or before year - lower bound
+    birth_year = DemographicStat.birth_year
+    return case(*[(birth_year <= year - low, label) for low, label in reversed(AGE_BANDS[1:])],
+                else_=AGE_BANDS[0][1])
+
+def _months(today, count):
+    months, year, month = [], today.year, today.month
+    for _ in range(count):
+        months.append(f'{year:04d}-{month:02d}')
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return months[::-1]
+
+def _breakdown(cells, genders):
+    bands = [label for _, label in AGE_BANDS]
+    by_gender = {g: sum(cells.get((g, b), 0) for b in bands) for g in genders}
+    return {
+        "total": sum(by_gender.values()),
+        "by_gender": by_gender,
+        "by_age_band": {b: sum(cells.get((g, b), 0) for g in genders) for b in bands},
+        "by_gender_and_age_band": {g: {b: cells.get((g, b), 0) for b in bands} for g in genders},
+    }
+
+def rollups(session=None, today=None, months=12):
+    """Demographics per program and for the registry, and monthly trends for
+    the last `months` months, from the rollup tables."""
+    session = session or db.session
+    today = today or date.today()
+    band = _age_band(today.year)
+    cells = defaultdict(dict)
+    for program_id, gender, label, count in session.execute(
+            select(DemographicStat.program_id, DemographicStat.gender, band, func.sum(DemographicStat.client_count))
+            .group_by(DemographicStat.program_id, DemographicStat.gender, band)):
+        if count:
+            cells[program_id][(gender, label)] = count
+    genders = sorted({gender for program in cells.values() for gender, _ in program})
+    names = session.execute(select(ProgramStat.program_id, ProgramStat.name).order_by(ProgramStat.program_id)).all()
+
+    labels = _months(today, months)
+    series = defaultdict(lambda: {m: [0, 0] for m in labels})
+    for program_id, month, enrolled, unenrolled in session.execute(
+            select(EnrollmentTrend.program_id, EnrollmentTrend.month, EnrollmentTrend.enrolled,
+                   EnrollmentTrend.unenrolled).where(EnrollmentTrend.month >= labels[0])):
+        if month in series[program_id]:
+            series[program_id][month] = [enrolled, unenrolled]
+
+    def trend(program_id):
+        points = series[program_id] if program_id in series else {m: [0, 0] for m in labels}
+        return {"enrolled": [points[m][0] for m in labels], "unenrolled": [points[m][1] for m in labels]}
+
+    registry_trend = trend(REGISTRY)
+    return {
+        "as_of": today.isoformat(),
+        "age_bands": [label for _, label in AGE_BANDS],
+        "genders": genders,
+        "registry": _breakdown(cells.get(REGISTRY, {}), genders),
+        "programs": [{"id": program_id, "name": name, **_breakdown(cells.get(program_id, {}), genders)}
+                     for program_id, name in names],
+        "trends": {
+            "months": labels,
+            "registrations": registry_trend["enrolled"],
+            "removals": registry_trend["unenrolled"],
+            "programs": [{"id": program_id, "name": name, **trend(program_id)} for program_id, name in names],
+        },
+    }
+
+# Rollups served from the object cache until the registry changes (or the
+# day does: age bands and trend months move with the date)
+def cached_rollups(months=12):
+    today = date.today()
+    key = f"analytics:{version_tag()}:{today.isoformat()}:{months}"
+    return cache.get_or_set(key, lambda: rollups(today=today, months=months))
@@ -1,44 +1,251 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file, Response
-from flask_sqlalchemy import SQLAlchemy
-from flask_mail import Mail, Message
-from flask_bcrypt import Bcrypt
-from models import db, Client, ProgramModel, Doctor
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from datetime import datetime
+from flask import Flask, current_app, render_template, request, redirect, url_for, session, flash, jsonify, send_file, Response, stream_with_context, abort
+from flask.cli import with_appcontext
+from werkzeug.utils import secure_filename
+from sqlalchemy.orm import joinedload, selectinload
+from config import Config, engine_options, install_sqlite_pragmas
+from models import db, Client, ProgramModel, Doctor, OutboxMessage, enrollments
+from utils import parse_date, parse_page_args, keyset_page, iter_chunks
+from reports import REPORTS, filter_clients, render_report
+from versions import current_versions, init_versions, version_tag
+from changes import on_commit
+from http_cache import etag, init_http_cache
+import metrics
+from cache import cache, client_key, programs_key, invalidate as invalidate_cache, make_backend
+from broadcast import hub
+from aggregates import dashboard_snapshot, init_aggregates, rebuild as rebuild_aggregates
+import analytics
+import archive
+from importer import import_clients
+from bulk_enroll import apply_enrollment_delta
+from migrations import MigrationError, current_version as schema_version, upgrade as upgrade_schema, stamp as stamp_schema
+from search import SEARCH_LIMIT, init_search, rebuild as rebuild_search_index, reindex as reindex_blind, search_client_ids, search_clients
+from pii import cipher, init_pii, rotate as rotate_pii, settings as pii_settings
+from storage import NAME_THRESHOLD, client_index, init_client_index, name_similarity, start_client_index
+from passwords import PoolSaturated, hasher, init_passwords
+from json_provider import init_json
+import changelog
+import reads
+import outbox
+import jobs
+from sqlalchemy import func, select
+import click
+import csv
+import hashlib
 import io
-
-# Initialize Flask app
-app = Flask(__name__)
-app.secret_key = 'super_secret_key'
-
-# Database Configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///healthsystem.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-# Configure Flask-Mail
-app.config['MAIL_SERVER'] = 'smtp.gmail.com'   # Or your SMTP server
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
-app.config['MAIL_USERNAME'] = 'your_email@gmail.com'  # Your email address
-app.config['MAIL_PASSWORD'] = 'your_email_password'   # Your app-specific password (don't use real password)
-
-mail = Mail(app)
-# Initialize database and Bcrypt
-db.init_app(app)
-bcrypt = Bcrypt(app)
-
-# Create tables if they don't exist
-with app.app_context():
-    db.create_all()
+import json
+import os
+
+# Views, error handlers and CLI commands are collected here at import time and
+# added to each app by create_app(), under the same endpoint names url_for()
+# already uses (a blueprint would prefix them)
+class Routes:
+    def __init__(self):
+        self.views = []
+        self.error_handlers = []
+        self.commands = []
+
+    def route(self, rule, **options):
+        def decorator(view):
+            self.views.append((rule, view, options))
+            return view
+        return decorator
+
+    def errorhandler(self, exception):
+        def decorator(handler):
+            self.error_handlers.append((exception, handler))
+            return handler
+        return decorator
+
+    def command(self, name):
+        def decorator(fn):
+            self.commands.append(click.command(name)(with_appcontext(fn)))
+            return fn
+        return decorator
+
+    def register(self, app):
+        for rule, view, options in self.views:
+            app.add_url_rule(rule, view_func=view, **options)
+        for exception, handler in self.error_handlers:
+            app.register_error_handler(exception, handler)
+        for command in self.commands:
+            app.cli.add_command(command)
+
+routes = Routes()
+
+def create_app(config=None):
+    """Build the app: Config from the environment, then the `config` overrides
+    (a mapping), then the schema, derived tables and caches are brought up to date."""
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if config:
+        app.config.update(config)
+        if 'SQLALCHEMY_ENGINE_OPTIONS' not in config:
+            app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+
+    # Initialize database, the password hashing pool and the PII cipher
+    db.init_app(app)
+    init_passwords(app)
+    init_pii(app)
+    changelog.init_changelog(app)
+    archive.init_archive(app)
+    with app.app_context():
+        install_sqlite_pragmas(db.engine)
+        # Registered before the compression hook so it measures bytes as sent
+        metrics.init_metrics(app, db.engine)
+
+        # Create tables if they don't exist
+        upgrade_schema(db.engine)
+        db.create_all()
+        stamp_schema(db.engine)
+        init_versions()
+        init_aggregates()
+        analytics.init_analytics()
+        app.config['CLIENT_SEARCH_FTS'] = init_search(db.engine)
+        init_client_index(app)
+
+    cache.backend = make_backend(app.config['CACHE_BACKEND'], os.path.join(app.instance_path, 'cache.db'),
+                                 app.config['CACHE_MAX_ENTRIES'])
+    cache.ttl = app.config['CACHE_TTL']
+    init_http_cache(app)
+    init_json(app)
+    routes.register(app)
+
+    # Each worker warms its similarity index after the fork, on its first request
+    @app.before_request
+    def warm_client_index():
+        start_client_index(app)
+
+    return app
+
+# Flask-Mail is only imported (and configured) the first time an email is sent
+def get_mail(app=None):
+    app = app or current_app._get_current_object()
+    mail = app.extensions.get('cema_mail')
+    if mail is None:
+        from flask_mail import Mail
+        mail = app.extensions['cema_mail'] = Mail(app)
+    return mail
+
+# `from app import app` (flask --app app, older scripts) gets a default app
+# built on first access instead of at import time
+_default_app = None
+
+def __getattr__(name):
+    global _default_app
+    if name == 'app':
+        if _default_app is None:
+            _default_app = create_app()
+        return _default_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+on_commit(invalidate_cache)
+
+# Tables each cacheable response is built from (see http_cache.etag)
+REGISTRY_TABLES = ('client', 'program_model', 'enrollments')
+
+# Backfill the full-text search index: flask --app app search-backfill
+@routes.command('search-backfill')
+def search_backfill():
+    if cipher.enabled:
+        init_search(db.engine)
+        print('PII encryption is on: search uses the blind indexes (flask --app app pii-rotate --reindex-only).')
+        return
+    if not init_search(db.engine):
+        print('FTS5 is not available for this database; search uses LIKE.')
+        return
+    with db.engine.begin() as connection:
+        rebuild_search_index(connection)
+    print(f'Indexed {Client.query.count()} clients.')
+
+# Encrypt legacy plaintext rows / re-encrypt under the newest key, then rebuild
+# the blind indexes: flask --app app pii-rotate (--reindex-only after changing PII_INDEX_KEY)
+@routes.command('pii-rotate')
+@click.option('--reindex-only', is_flag=True, help='Only rebuild the blind indexes.')
+def pii_rotate_command(reindex_only):
+    if not cipher.enabled:
+        raise click.ClickException('PII_ENCRYPTION_KEYS is not set.')
+    with db.engine.begin() as connection:
+        rewritten = 0 if reindex_only else rotate_pii(connection)
+        indexed = reindex_blind(connection)
+        rebuild_aggregates(connection)  # recent registrations hold copies of names
+    print(f'Re-encrypted {rewritten} clients, indexed {indexed}.')
+
+# Bound the /api/changes log (also runs in the background, see
+# CHANGE_LOG_COMPACT_EVERY): flask --app app changes-compact
+@routes.command('changes-compact')
+@click.option('--max-rows', type=int, help='Defaults to CHANGE_LOG_MAX_ROWS.')
+def changes_compact_command(max_rows):
+    with db.engine.begin() as connection:
+        superseded, truncated = changelog.compact(connection, max_rows or current_app.config['CHANGE_LOG_MAX_ROWS'])
+    print(f'Dropped {superseded} superseded and {truncated} old change log entries.')
+
+# Move inactive clients to the archive in batches:
+# flask --app app archive-clients [--idle-days N] [--max N]
+@routes.command('archive-clients')
+@click.option('--idle-days', type=int, help='Defaults to ARCHIVE_IDLE_DAYS.')
+@click.option('--batch-size', type=int, help='Defaults to ARCHIVE_BATCH_SIZE.')
+@click.option('--max', 'max_clients', type=int, help='Stop after this many clients.')
+def archive_clients_command(idle_days, batch_size, max_clients):
+    config = current_app.config
+    archived = archive.archive_clients(idle_days if idle_days is not None else config['ARCHIVE_IDLE_DAYS'],
+                                       batch_size or config['ARCHIVE_BATCH_SIZE'], max_clients)
+    counts = archive.store.counts()
+    print(f"Archived {archived} clients; the archive holds {counts['clients']} clients in {counts['segments']} "
+          f"segments and {counts['programs']} programs ({counts['bytes']} compressed bytes).")
+
+# Upgrade an existing database file in place: flask --app app db-upgrade
+# (also runs automatically on startup)
+@routes.command('db-upgrade')
+def db_upgrade_command():
+    try:
+        applied = upgrade_schema(db.engine)
+    except MigrationError as e:
+        raise click.ClickException(str(e))
+    with db.engine.connect() as connection:
+        print(f"Applied migrations: {applied or 'none'}; schema version {schema_version(connection)}.")
+
+# Bulk client import: flask --app app import-clients registry.csv
+@routes.command('import-clients')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help='Defaults to the file extension.')
+def import_clients_command(path, fmt):
+    fmt = fmt or ('ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv')
+    with open(path, 'rb') as f:
+        result = import_clients(f, fmt)
+    print(f'Inserted {result.inserted} clients, {result.enrolled} enrollments, rejected {result.rejected} rows.')
+    for error in result.errors:
+        print(f"  row {error['row']}: {'; '.join(error['errors'])}")
+
+# Recompute the dashboard aggregates and demographic rollups from scratch:
+# flask --app app rebuild-aggregates
+@routes.command('rebuild-aggregates')
+def rebuild_aggregates_command():
+    rebuild_aggregates(db.session.connection())
+    analytics.rebuild(db.session.connection())
+    db.session.commit()
+    print('Dashboard aggregates rebuilt.')
+
+# Drain the email outbox from a dedicated process: flask --app app send-outbox [--watch]
+@routes.command('send-outbox')
+@click.option('--watch', is_flag=True, help='Keep running and send new mail as it is queued.')
+def send_outbox_command(watch):
+    app = current_app._get_current_object()
+    if watch:
+        outbox.sender.start(app, get_mail(app), db)
+        outbox.sender.join()
+        return
+    sent = 0
+    while (claimed := outbox.deliver_pending(get_mail(app), db.session, app.config)):
+        sent += claimed
+    print(f"Processed {sent} messages: {outbox.outbox_stats(db.session)}")
 
 # --- AUTH ROUTES ---
 
-@app.route('/')
+@routes.route('/')
 def home():
     return redirect(url_for('login'))
 
-@app.route('/signup', methods=['GET', 'POST'])
+@routes.route('/signup', methods=['GET', 'POST'])
 def signup():
     if request.method == 'POST':
         username = request.form['username']
@@ -50,7 +257,7 @@ def signup():
             flash('Username already exists.', 'danger')
             return redirect(url_for('signup'))
 
-        hashed_pw = bcrypt.generate_password_hash(password).decode('utf-8')
+        hashed_pw = hasher.hash(password)
         new_doctor = Doctor(username=username, name=name, password=hashed_pw)
         db.session.add(new_doctor)
         db.session.commit()
@@ -66,14 +273,18 @@ def signup():
 
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@routes.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
 
         doctor = Doctor.query.filter_by(username=username).first()
-        if doctor and bcrypt.check_password_hash(doctor.password, password):
+        if hasher.verify(password, doctor.password if doctor else None):
+            # Upgrade hashes made at an older cost factor while we have the plaintext
+            if hasher.needs_rehash(doctor.password):
+                doctor.password = hasher.hash(password)
+                db.session.commit()
             session['logged_in'] = True
             session['doctor'] = doctor.name
             session['doctor_id'] = doctor.id
@@ -83,7 +294,13 @@ def login():
             flash("Invalid credentials.", "danger")
     return render_template('login.html')
 
-@app.route('/logout')
+# Hashing pool full: tell the client when to come back instead of queueing
+@routes.errorhandler(PoolSaturated)
+def password_pool_saturated(e):
+    return Response('Too many sign-ins at once, please retry shortly.', status=503,
+                    headers={'Retry-After': str(e.retry_after)}, mimetype='text/plain')
+
+@routes.route('/logout')
 def logout():
     session.clear()
     flash("Logged out successfully.", "info")
@@ -91,49 +308,136 @@ def logout():
 
 # --- MAIN DASHBOARD ---
 
-@app.route('/dashboard')
+@routes.route('/dashboard')
 def dashboard():
     if not session.get('logged_in'):
         return redirect(url_for('login'))
-    
-    programs = ProgramModel.query.filter_by(created_by=session['doctor_id']).all()
-    clients = Client.query.all()
-    return render_template('dashboard.html', programs=programs, clients=clients)
 
-# Dasboard route for auto refresh
-@app.route('/api/dashboard-data')
+    # Stats, charts and lists are filled in from /api/dashboard-data
+    return render_template('dashboard.html')
+
+# Dasboard route for auto refresh. Served from the precomputed aggregates
+# (aggregates.py), so the cost per poll doesn't grow with the registry.
+@routes.route('/api/dashboard-data')
+@etag(*REGISTRY_TABLES)
 def api_dashboard_data():
-    programs = ProgramModel.query.all()
-    clients = Client.query.all()
-    return jsonify({
-        "programs": [
-            {"name": p.name, "clients": [{"name": c.name} for c in p.clients]} for p in programs
-        ],
-        "clients": [{"name": c.name} for c in clients]
-    })
+    return jsonify(dashboard_snapshot())
+
+# Enrolled clients by gender and age band per program, and monthly
+# enrollment trends (analytics.py): ?months= sets the trend window. No ETag:
+# the answer also moves with the date, the object cache keeps it cheap.
+@routes.route('/api/analytics')
+def api_analytics():
+    try:
+        months = int(request.args.get('months', 12))
+    except ValueError:
+        return jsonify({"error": "months must be an integer"}), 400
+    if not 1 <= months <= analytics.MAX_TREND_MONTHS:
+        return jsonify({"error": f"months must be between 1 and {analytics.MAX_TREND_MONTHS}"}), 400
+    return jsonify(analytics.cached_rollups(months))
+
+
+# --- LIVE UPDATES ---
+
+# Every committed change to clients, programs or enrollments is pushed to the
+# open /api/stream connections of this process
+@on_commit
+def publish_changes(changes):
+    hub.publish('change', changes.summary(), changes.versions)
+
+def data_version_reader(app):
+    def read():
+        with app.app_context():
+            return current_versions()
+    return read
+
+# Server-Sent Events channel used by the dashboard and the clients page. In
+# production it is served by the gevent stream server (gunicorn_stream.conf.py),
+# where a stream is a greenlet; under a threaded server it holds a request
+# thread. Past STREAM_MAX_SUBSCRIBERS in a process new subscribers get 503
+# and the pages fall back to polling.
+@routes.route('/api/stream')
+def api_stream():
+    if not session.get('logged_in'):
+        return jsonify({"error": "Login required."}), 401
+    if not hub.acquire(current_app.config['STREAM_MAX_SUBSCRIBERS']):
+        retry = current_app.config['STREAM_RETRY_SECONDS']
+        return Response(f"retry: {retry * 1000}\n\n", 503, mimetype='text/event-stream',
+                        headers={"Retry-After": str(retry), "Cache-Control": "no-cache"})
+
+    # Other processes' writes are picked up by polling the data versions. An
+    # in-memory database has no other writers, and the poller would share its
+    # one connection with the request threads.
+    if db.engine.url.database not in (None, '', ':memory:'):
+        hub.watch(data_version_reader(current_app._get_current_object()), current_app.config['STREAM_POLL_SECONDS'])
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    last_seq = int(last_event_id) if last_event_id.isdigit() else None
+    response = Response(
+        hub.stream(last_seq, current_app.config['STREAM_KEEPALIVE_SECONDS']),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    response.call_on_close(hub.release)  # runs even if the stream never started
+    return response
 
 
 # --- CLIENT ROUTES ---
 
-@app.route('/clients')
+# One page of the client list. Browsing is keyset-paginated on the id
+# (?cursor= is the last id shown); search results are ranked, so there
+# ?cursor= is an offset into the best SEARCH_LIMIT matches.
+def client_list_page(search, program, after, cursor, limit):
+    query = filtered_clients_query(program, after, program_contains=True).options(selectinload(Client.programs))
+    if not search:
+        return keyset_page(query, Client.id, cursor, limit)
+    ids = search_client_ids(search, SEARCH_LIMIT, use_fts=current_app.config['CLIENT_SEARCH_FTS'])
+    if ids and (program or after):
+        allowed = {row[0] for row in query.with_entities(Client.id).filter(Client.id.in_(ids))}
+        ids = [i for i in ids if i in allowed]
+    page_ids = ids[cursor:cursor + limit]
+    by_id = {c.id: c for c in query.filter(Client.id.in_(page_ids))} if page_ids else {}
+    next_cursor = cursor + limit if len(ids) > cursor + limit else None
+    return [by_id[i] for i in page_ids if i in by_id], next_cursor
+
+# Rendered table rows for one page, cached until the registry changes
+def client_rows_fragment(search, program, after, cursor, limit):
+    params = json.dumps([search, program, after, cursor, limit])
+    key = f"fragment:clients:{version_tag(*REGISTRY_TABLES)}:{hashlib.sha1(params.encode()).hexdigest()}"
+
+    def render():
+        clients, next_cursor = client_list_page(search, program, after, cursor, limit)
+        next_url = None
+        if next_cursor is not None:
+            next_url = url_for('clients_page', search=search or None, program=program or None,
+                               after=after or None, cursor=next_cursor, limit=limit)
+        return render_template('partials/client_list.html', clients=clients, next_url=next_url,
+                               first_page=cursor == 0)
+
+    return cache.get_or_set(key, render)
+
+@routes.route('/clients')
 def clients_page():
     if not session.get('logged_in'):
         return redirect(url_for('login'))
 
-    query = request.args.get('search', '')
-    if query:
-        clients = Client.query.filter(Client.name.ilike(f"%{query}%")).all()
-    else:
-        clients = Client.query.all()
+    search = request.args.get('search', '').strip()
+    program = request.args.get('program', '').strip()
+    after = request.args.get('after', '').strip()
+    try:
+        cursor, limit = parse_page_args(request.args, current_app.config['CLIENTS_PAGE_SIZE'],
+                                        current_app.config['CLIENTS_PAGE_MAX'])
+    except ValueError as e:
+        return str(e), 400
+    rows = client_rows_fragment(search, program, after, cursor, limit)
 
-    # If it's an AJAX (fetch) request, only return the HTML for the clients list
+    # Search, filters and the next page fetch just the rows
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        return render_template('partials/client_list.html', clients=clients)
-    
-    return render_template('clients_page.html', clients=clients, query=query)
+        return rows
+
+    return render_template('clients_page.html', rows=rows, query=search, program=program, after=after)
 
 #email client route
-@app.route('/email-clients-pdf', methods=['POST'])
+@routes.route('/email-clients-pdf', methods=['POST'])
 def email_clients_pdf():
     if not session.get('logged_in'):
         return jsonify({"success": False}), 401
@@ -145,41 +449,90 @@ def email_clients_pdf():
         if not recipient_list:
             return jsonify({"success": False}), 400
 
-        buffer = io.BytesIO()
-        pdf = canvas.Canvas(buffer, pagesize=letter)
-        pdf.setFont("Helvetica", 12)
-        pdf.drawString(100, 750, "This is the client registry!")
-        pdf.save()
-        buffer.seek(0)
-
-        msg = Message('Client Registry Report', sender=app.config['MAIL_USERNAME'], recipients=recipient_list)
-        msg.body = 'Attached is the latest client registry report.'
-        msg.attach('client_registry.pdf', 'application/pdf', buffer.read())
-
-        mail.send(msg)
+        # Queue the registry report on the report pool and the message with a
+        # reference to its job; the outbox sender attaches the cached PDF once
+        # it is rendered, and delivers (and retries) off the request
+        report = {"kind": 'clients', "params": {}, "job": start_report('clients', {})}
+        message = outbox.enqueue(db.session, 'Client Registry Report', current_app.config['MAIL_USERNAME'], recipient_list,
+                                 body='Attached is the latest client registry report.',
+                                 attachment=('client_registry.pdf', 'application/pdf', None), report=report)
+        db.session.commit()
+        start_outbox_sender()
 
-        return jsonify({"success": True})
+        return jsonify({"success": True, "message_id": message.id,
+                        "status_url": url_for('outbox_message_status', message_id=message.id)}), 202
     except Exception as e:
-        print('Email error:', e)
+        current_app.logger.exception('Email error: %s', e)
         return jsonify({"success": False}), 500
 
+# Runs in each gunicorn worker as it boots (gunicorn.conf.py post_fork), so
+# mail queued before a restart and due retries go out without waiting for
+# the next email, and again on every enqueue to skip the poll wait
+def start_outbox_sender(app=None):
+    app = app or current_app._get_current_object()
+    # Tests drive outbox.deliver_pending directly instead of a live thread
+    if app.config['OUTBOX_SENDER'] and not app.testing:
+        outbox.sender.start(app, get_mail(app), db)
+        outbox.sender.wake()
+
+# Reads a report attached to an outbox message from the report cache when the
+# sender gets to it. A job that failed, or whose marker or PDF is gone (a
+# killed worker, pruning), is queued again.
+@outbox.report_loader
+def load_report_attachment(report):
+    cache_dir = report_cache_dir()
+    path = jobs.artifact_path(cache_dir, report['job'])
+    if not os.path.exists(path):
+        status = jobs.job_status(cache_dir, report['job'], current_app.config['REPORT_JOB_TIMEOUT'])
+        if status['status'] != 'pending':
+            report['job'] = start_report(report['kind'], report['params'])
+            path = jobs.artifact_path(cache_dir, report['job'])
+        if status['status'] == 'failed':
+            raise RuntimeError(f"Report failed: {status['error']}")  # counts as an attempt
+        if not os.path.exists(path):
+            raise outbox.NotReady(report['job'])
+    with open(path, 'rb') as f:
+        return f.read()
+
+# Delivery status of one queued email
+@routes.route('/api/outbox/<int:message_id>')
+def outbox_message_status(message_id):
+    if not session.get('logged_in'):
+        return jsonify({"error": "Unauthorized"}), 401
+    message = db.session.get(OutboxMessage, message_id)
+    if message is None:
+        return jsonify({"error": "Message not found"}), 404
+    return jsonify(outbox.message_json(message))
+
+# Outbox counts by status
+@routes.route('/api/outbox')
+def outbox_status():
+    if not session.get('logged_in'):
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify(outbox.outbox_stats(db.session))
+
 #create client route
-@app.route('/api/create-client', methods=['POST'])
+@routes.route('/api/create-client', methods=['POST'])
 def api_create_client():
     data = request.json
+    try:
+        dob = parse_date(data['dob'])
+    except ValueError:
+        return jsonify({"error": "dob must be YYYY-MM-DD."}), 400
     new_client = Client(
         name=f"{data['first_name']} {data['last_name']}",
-        dob=data['dob'],
+        dob=dob,
         gender=data['gender'],
         contact=data['contact'],
         address=data['address']
     )
+    duplicates = indexed_clients(client_index.possible_duplicates(new_client.name, new_client.contact, dob))
     db.session.add(new_client)
     db.session.commit()
-    return jsonify({"message": "Client created successfully."}), 201
+    return jsonify({"message": "Client created successfully.", "possible_duplicates": duplicates}), 201
 
 #Register client route
-@app.route('/register-client', methods=['GET', 'POST'])
+@routes.route('/register-client', methods=['GET', 'POST'])
 def register_client():
     if not session.get('logged_in'):
         return redirect(url_for('login'))
@@ -188,13 +541,23 @@ def register_client():
         first_name = request.form['first_name']
         last_name = request.form['last_name']
         full_name = f"{first_name} {last_name}"
-        dob = request.form['dob']
+        try:
+            dob = parse_date(request.form['dob'])
+        except ValueError:
+            flash('Please enter a valid date of birth.', 'danger')
+            return render_template('register_client.html')
         gender = request.form['gender']
         country_code = request.form['country_code']
         phone = request.form['contact']
         full_contact = f"{country_code}{phone}"
         email = request.form['email']  
 
+        # Ask before registering someone who looks already registered
+        if not request.form.get('allow_duplicate'):
+            duplicates = indexed_clients(client_index.possible_duplicates(full_name, full_contact, dob))
+            if duplicates:
+                return render_template('register_client.html', duplicates=duplicates, form=request.form)
+
         new_client = Client(
             name=full_name,
             dob=dob,
@@ -213,18 +576,79 @@ def register_client():
 
 
 
+# Index hits as client dicts (id, name, dob, contact, score[, reasons]), read
+# back from the database: clients deleted by another worker drop out and the
+# scores of names they edited are recomputed
+def indexed_clients(hits, query=None):
+    if not hits:
+        return []
+    rows = {row.id: row for row in db.session.execute(
+        select(Client.id, Client.name, Client.dob, Client.contact).where(Client.id.in_([h[0] for h in hits])))}
+    results = []
+    for client_id, score, *reasons in hits:
+        row = rows.get(client_id)
+        if row is None:
+            continue
+        if query is not None:
+            score = name_similarity(query, row.name)  # the name may have been edited by another worker
+        item = {"id": row.id, "name": row.name, "dob": row.dob.isoformat(), "contact": row.contact, "score": round(score, 3)}
+        if reasons:
+            item["reasons"] = reasons[0]
+        results.append(item)
+    if query is not None:
+        results.sort(key=lambda item: -item["score"])
+    return results
+
+# Typo-tolerant lookup by name (or ?field=contact) on the in-memory trigram index
+@routes.route('/api/clients/similar')
+def api_similar_clients():
+    query = request.args.get('q', '').strip()
+    field = request.args.get('field', 'name')
+    try:
+        limit = min(int(request.args.get('limit', 10)), 100)
+        threshold = float(request.args.get('threshold', NAME_THRESHOLD))
+    except ValueError:
+        return jsonify({"error": "limit and threshold must be numbers"}), 400
+    if field not in ('name', 'contact'):
+        return jsonify({"error": "field must be name or contact"}), 400
+    if not client_index.ready.is_set():
+        return jsonify({"error": "The client index is still warming up."}), 503, {"Retry-After": "1"}
+    hits = client_index.search(query, limit, threshold, field)
+    return jsonify(indexed_clients(hits, query if field == 'name' else None))
+
+# Possible duplicates of a client about to be registered:
+# ?name= (or first_name/last_name), &contact=, &dob=YYYY-MM-DD
+@routes.route('/api/clients/duplicates')
+def api_client_duplicates():
+    args = request.args
+    name = args.get('name') or f"{args.get('first_name', '')} {args.get('last_name', '')}".strip()
+    try:
+        dob = parse_date(args['dob']) if args.get('dob') else None
+    except ValueError:
+        return jsonify({"error": "dob must be YYYY-MM-DD."}), 400
+    if not client_index.ready.is_set():
+        return jsonify({"error": "The client index is still warming up."}), 503, {"Retry-After": "1"}
+    return jsonify(indexed_clients(client_index.possible_duplicates(name, args.get('contact'), dob)))
+
 # Client Profile Route
-@app.route('/client/<int:client_id>')
+@routes.route('/client/<int:client_id>')
 def view_client(client_id):
-    client = Client.query.get_or_404(client_id)
+    data = cached_client_json(client_id)
+    # The template reads program.name, the cached profile has plain names
+    client = dict(data, programs=[{"name": name} for name in data['programs']])
     return render_template('view_client.html', client=client)
 
-@app.route('/edit-client/<int:client_id>', methods=['GET', 'POST'])
+@routes.route('/edit-client/<int:client_id>', methods=['GET', 'POST'])
 def edit_client(client_id):
     client = Client.query.get_or_404(client_id)
     if request.method == 'POST':
+        try:
+            dob = parse_date(request.form['dob'])
+        except ValueError:
+            flash('Please enter a valid date of birth.', 'danger')
+            return redirect(url_for('edit_client', client_id=client_id))
         client.name = f"{request.form['first_name']} {request.form['last_name']}"
-        client.dob = request.form['dob']
+        client.dob = dob
         client.gender = request.form['gender']
         client.contact = request.form['contact']
         client.address = request.form['address']
@@ -235,20 +659,22 @@ def edit_client(client_id):
     return render_template('edit_client.html', client=client, first_name=first, last_name=" ".join(last))
 
 # API route for single client profile
-@app.route('/api/clients/<int:client_id>', methods=['GET'])
+@routes.route('/api/clients/<int:client_id>', methods=['GET'])
+@etag(*REGISTRY_TABLES)
 def api_client_profile(client_id):
-    client = Client.query.get_or_404(client_id)
-    return jsonify({
-        "id": client.id,
-        "name": client.name,
-        "dob": client.dob,
-        "gender": client.gender,
-        "contact": client.contact,
-        "address": client.address,
-        "programs": [program.name for program in client.programs]
-    })
+    return jsonify(cached_client_json(client_id))
 
-@app.route('/delete-client/<int:client_id>')
+# Client profile dict, served from the cache (404 if the client doesn't exist)
+def cached_client_json(client_id):
+    def load():
+        return reads.client_profile(client_id)
+
+    data = cache.get_or_set(client_key(client_id), load)
+    if data is None:
+        abort(404)
+    return data
+
+@routes.route('/delete-client/<int:client_id>')
 def delete_client(client_id):
     client = Client.query.get_or_404(client_id)
     db.session.delete(client)
@@ -256,7 +682,7 @@ def delete_client(client_id):
     flash('Client deleted.', 'success')
     return redirect(url_for('clients_page'))
 
-@app.route('/enroll-client/<int:client_id>', methods=['GET', 'POST'])
+@routes.route('/enroll-client/<int:client_id>', methods=['GET', 'POST'])
 def enroll_client(client_id):
     client = Client.query.get_or_404(client_id)
     if request.method == 'POST':
@@ -269,7 +695,7 @@ def enroll_client(client_id):
     programs = ProgramModel.query.all()
     return render_template('enroll_client.html', client=client, programs=programs)
 
-@app.route('/api/enroll-client', methods=['POST'])
+@routes.route('/api/enroll-client', methods=['POST'])
 def api_enroll_client():
     data = request.json
     client = Client.query.get_or_404(data['client_id'])
@@ -278,7 +704,85 @@ def api_enroll_client():
     db.session.commit()
     return jsonify({"message": "Client enrolled successfully."}), 200
 
-@app.route('/api/delete-client/<int:id>', methods=['DELETE'])
+# Bulk client import. The body is streamed as CSV (text/csv) or NDJSON
+# (application/x-ndjson) with name or first_name/last_name, dob, gender,
+# contact, address or email and an optional programs list (names).
+@routes.route('/api/clients/import', methods=['POST'])
+def api_import_clients():
+    fmt = request.args.get('format')
+    if not fmt:
+        fmt = 'ndjson' if request.mimetype in ('application/x-ndjson', 'application/jsonl') else 'csv'
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({"error": f"Unsupported import format '{fmt}'."}), 400
+    try:
+        result = import_clients(request.stream, fmt)
+    except UnicodeDecodeError:
+        return jsonify({"error": "Upload must be UTF-8 encoded."}), 400
+    return jsonify(result.as_dict()), 200
+
+# Set-based enrollment changes for many clients:
+# {"client_ids": [...], "add": [program ids], "remove": [program ids]}
+@routes.route('/api/enrollments/bulk', methods=['POST'])
+def api_bulk_enroll():
+    data = request.get_json(silent=True) or {}
+    try:
+        client_ids, add, remove = (
+            [int(i) for i in data.get(key) or []] for key in ('client_ids', 'add', 'remove')
+        )
+    except (TypeError, ValueError):
+        return jsonify({"error": "client_ids, add and remove must be lists of ids."}), 400
+    if not client_ids or not (add or remove):
+        return jsonify({"error": "Provide client_ids and at least one of add or remove."}), 400
+    if set(add) & set(remove):
+        return jsonify({"error": "A program can't be both added and removed."}), 400
+
+    enrolled, unenrolled = apply_enrollment_delta(client_ids, add, remove)
+    return jsonify({"enrolled": enrolled, "unenrolled": unenrolled}), 200
+
+# --- ARCHIVE ROUTES ---
+
+# Archived clients and programs are only served from here (archive.py)
+@routes.route('/api/archive/clients')
+def api_archived_clients():
+    try:
+        cursor, limit = parse_page_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    clients, next_cursor = archive.store.client_page(cursor, limit)
+    return paged_response([archive.client_json(c) for c in clients], next_cursor, limit)
+
+@routes.route('/api/archive/clients/<int:client_id>')
+def api_archived_client(client_id):
+    client = archive.store.clients([client_id]).get(client_id)
+    if client is None:
+        abort(404)
+    return jsonify(archive.client_json(client))
+
+@routes.route('/api/archive/clients/<int:client_id>/restore', methods=['POST'])
+def api_restore_client(client_id):
+    restored = archive.restore_clients([client_id])
+    if not restored:
+        abort(404)
+    return jsonify({"id": restored[client_id]}), 200
+
+@routes.route('/api/archive/programs')
+def api_archived_programs():
+    try:
+        cursor, limit = parse_page_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    programs, next_cursor = archive.store.program_page(cursor, limit)
+    return paged_response(programs, next_cursor, limit)
+
+@routes.route('/api/archive/programs/<int:program_id>/restore', methods=['POST'])
+def api_restore_program(program_id):
+    result = archive.restore_program(program_id)
+    if result is None:
+        abort(404)
+    new_id, enrolled = result
+    return jsonify({"id": new_id, "enrolled": enrolled}), 200
+
+@routes.route('/api/delete-client/<int:id>', methods=['DELETE'])
 def api_delete_client(id):
     client = Client.query.get_or_404(id)
     db.session.delete(client)
@@ -286,14 +790,27 @@ def api_delete_client(id):
     return jsonify({"message": "Client deleted successfully."}), 200
 # --- PROGRAM ROUTES ---
 
-@app.route('/programs')
+@routes.route('/programs')
 def programs_page():
-    programs = ProgramModel.query.all()
+    def load():
+        query = ProgramModel.query.options(joinedload(ProgramModel.creator)).order_by(ProgramModel.id)
+        programs = query.all()
+        counts = dict(db.session.query(enrollments.c.program_id, func.count()).group_by(enrollments.c.program_id))
+        return [
+            {
+                "id": p.id,
+                "name": p.name,
+                "creator": {"name": p.creator.name} if p.creator else None,
+                "client_count": counts.get(p.id, 0)
+            } for p in programs
+        ]
+
+    programs = cache.get_or_set(programs_key('page'), load)
     doctors = Doctor.query.all()
     return render_template('programs_page.html', programs=programs, doctors=doctors)
 
 #create program route
-@app.route('/api/create-program', methods=['POST'])
+@routes.route('/api/create-program', methods=['POST'])
 def api_create_program():
     data = request.json
     new_program = ProgramModel(
@@ -304,7 +821,7 @@ def api_create_program():
     db.session.commit()
     return jsonify({"message": "Program created successfully."}), 201
 
-@app.route('/programs/new', methods=['GET', 'POST'])
+@routes.route('/programs/new', methods=['GET', 'POST'])
 def create_program():
     if request.method == 'POST':
         name = request.form['name']
@@ -316,7 +833,7 @@ def create_program():
         return redirect(url_for('programs_page'))
     return render_template('create_program.html')
 
-@app.route('/programs/edit/<int:program_id>', methods=['GET', 'POST'])
+@routes.route('/programs/edit/<int:program_id>', methods=['GET', 'POST'])
 def edit_program(program_id):
     program = ProgramModel.query.get_or_404(program_id)
     if request.method == 'POST':
@@ -326,9 +843,10 @@ def edit_program(program_id):
         return redirect(url_for('programs_page'))
     return render_template('edit_program.html', program=program)
 
-@app.route('/programs/delete/<int:program_id>')
+@routes.route('/programs/delete/<int:program_id>')
 def delete_program(program_id):
     program = ProgramModel.query.get_or_404(program_id)
+    archive.archive_program(program)  # restorable from /api/archive/programs
     db.session.delete(program)
     db.session.commit()
     flash('Program deleted successfully.', 'info')
@@ -336,194 +854,291 @@ def delete_program(program_id):
 
 # --- SUMMARY ROUTE ---
 
-@app.route('/summary')
+@routes.route('/summary')
 def summary_page():
     doctor_id = session.get('doctor_id')
-    programs = ProgramModel.query.filter_by(created_by=doctor_id).all()
-    total_programs = len(programs)
-    total_clients = len(Client.query.all())
-    return render_template('summary_page.html', total_programs=total_programs, total_clients=total_clients)
+    total_programs = ProgramModel.query.filter_by(created_by=doctor_id).count()
+    rollups = analytics.cached_rollups()
+    return render_template('summary_page.html', total_programs=total_programs,
+                           total_clients=rollups['registry']['total'], rollups=rollups)
 
 # --- API ROUTES ---
 
-@app.route('/api/clients')
+def client_json(c):
+    return {
+        "id": c.id,
+        "name": c.name,
+        "dob": c.dob.isoformat(),
+        "gender": c.gender,
+        "contact": c.contact,
+        "address": c.address,
+        "programs": [p.name for p in c.programs]
+    }
+
+# List endpoints are keyset-paginated on the primary key: pass ?limit= and the
+# X-Next-Cursor value from the previous response as ?cursor= to get the next page.
+def paged_response(items, next_cursor, limit):
+    response = jsonify(items)
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+        next_url = url_for(request.endpoint, cursor=next_cursor, limit=limit, _external=True)
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
+
+@routes.route('/api/clients')
+@etag(*REGISTRY_TABLES)
 def api_clients():
-    clients = Client.query.all()
-    return jsonify([
-        {
-            "id": c.id,
-            "name": c.name,
-            "dob": c.dob,
-            "gender": c.gender,
-            "contact": c.contact,
-            "address": c.address,
-            "programs": [p.name for p in c.programs]
-        } for c in clients
-    ])
-
-@app.route('/api/programs')
+    try:
+        cursor, limit = parse_page_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Core rows with the program names aggregated in SQL (reads.py)
+    items, next_cursor = reads.client_page(cursor, limit)
+    return paged_response(items, next_cursor, limit)
+
+# Ranked full-text search over name, contact and address (prefix matching)
+@routes.route('/api/clients/search')
+@etag(*REGISTRY_TABLES)
+def api_search_clients():
+    query = request.args.get('q', '').strip()
+    try:
+        limit = min(int(request.args.get('limit', SEARCH_LIMIT)), SEARCH_LIMIT)
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if not query:
+        return jsonify([])
+    clients = search_clients(query, limit, use_fts=current_app.config['CLIENT_SEARCH_FTS'], options=[selectinload(Client.programs)])
+    return jsonify([client_json(c) for c in clients])
+
+@routes.route('/api/programs')
+@etag(*REGISTRY_TABLES)
 def api_programs():
-    programs = ProgramModel.query.all()
-    return jsonify([
-        {
-            "id": p.id,
-            "name": p.name,
-            "created_by": p.creator.name if p.creator else None,
-            "enrolled_clients": [c.name for c in p.clients]
-        } for p in programs
-    ])
+    try:
+        cursor, limit = parse_page_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def load():
+        items, next_cursor = reads.program_page(cursor, limit)
+        return {"items": items, "next_cursor": next_cursor}
+
+    page = cache.get_or_set(programs_key('api', cursor, limit), load)
+    return paged_response(page['items'], page['next_cursor'], limit)
+
+# Incremental sync: NDJSON entries of the change log after ?since= (a seq),
+# oldest first, at most ?limit= per response. Resume from X-Change-Seq;
+# X-Next-Cursor is set while more entries are waiting. 410 means the log no
+# longer reaches back that far: reload /api/clients and /api/programs, then
+# follow the feed from the X-Change-Seq of the 410 response.
+@routes.route('/api/changes')
+def api_changes():
+    try:
+        since = int(request.args.get('since', 0))
+        limit = min(int(request.args.get('limit', current_app.config['CHANGES_PAGE_SIZE'])),
+                    current_app.config['CHANGES_PAGE_SIZE'])
+    except ValueError:
+        return jsonify({"error": "since and limit must be integers"}), 400
+    if since < 0 or limit < 1:
+        return jsonify({"error": "since must be >= 0 and limit >= 1"}), 400
+
+    connection = db.session.connection()
+    try:
+        end, head = changelog.page_end(connection, since, limit)
+    except changelog.ChangesGone:
+        response = jsonify({"error": "The change log no longer reaches back to this seq; resync from the full lists."})
+        response.headers['X-Change-Seq'] = str(changelog.head(connection))
+        return response, 410
+
+    def lines():
+        for entry in changelog.feed(db.session, since, end):
+            yield current_app.json.dumps(entry) + '\n'
+
+    response = Response(stream_with_context(lines()), mimetype='application/x-ndjson')
+    response.headers['X-Change-Seq'] = str(max(end, since))
+    if end < head:
+        response.headers['X-Next-Cursor'] = str(end)
+    return response
+
+# Per-route latency, SQL and response size histograms (Prometheus text format)
+@routes.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Hit/miss counters of the object cache in this process
+@routes.route('/api/cache-stats')
+def api_cache_stats():
+    return jsonify(cache.stats())
 
 # --- PDF DOWNLOAD (Advanced Feature) ---
 
-@app.route('/download-clients-pdf')
-def download_clients_pdf():
-    program_filter = request.args.get('program')
-    after_date = request.args.get('after')
-
-    buffer = io.BytesIO()
-    pdf = canvas.Canvas(buffer, pagesize=letter)
-    width, height = letter
-    y = height - 40
-    pdf.setFont("Helvetica-Bold", 14)
-    pdf.drawString(40, y, "Filtered Client Registry Report")
-    y -= 30
-    pdf.setFont("Helvetica", 10)
-
-    query = Client.query
-    if program_filter:
-        program = ProgramModel.query.filter_by(name=program_filter).first()
-        if program:
-            query = query.filter(Client.programs.contains(program))
-
-    if after_date:
-        try:
-            after_date_obj = datetime.strptime(after_date, "%Y-%m-%d")
-            query = query.filter(Client.dob >= after_date_obj)
-        except:
-            pass
-
-    clients = query.all()
-    for c in clients:
-        pdf.drawString(40, y, f"{c.name} | DOB: {c.dob} | Contact: {c.contact} | Programs: {', '.join([p.name for p in c.programs])}")
-        y -= 15
-        if y < 40:
-            pdf.showPage()
-            y = height - 40
-
-    pdf.save()
-    buffer.seek(0)
-    return send_file(buffer, as_attachment=True, download_name="client_registry_filtered.pdf", mimetype='application/pdf')
-
-#Export to CSV (Advanced Feature)
-import csv
-@app.route('/download-clients-csv')
-def download_clients_csv():
-    # Optional query parameters
-    program_filter = request.args.get('program')
-    after_date = request.args.get('after')
-
-    query = Client.query
+# Shared ?program= / ?after= filters for the client list and exports
+def filtered_clients_query(program_filter, after_date, program_contains=False):
+    return filter_clients(db.session, program_filter, after_date, program_contains)
+
+def report_cache_dir():
+    return current_app.config['REPORT_CACHE_DIR'] or os.path.join(current_app.instance_path, 'reports')
+
+# Queue (or reuse) the render for a report and return its job id. Reports are
+# rendered in the request only when the database can't be shared with another
+# process (in-memory SQLite).
+def start_report(kind, params):
+    cache_dir = report_cache_dir()
+    jobs.prune(cache_dir, current_app.config['REPORT_CACHE_MAX_AGE'])
+    version = version_tag()
+    if db.engine.url.database in (None, '', ':memory:'):
+        os.makedirs(cache_dir, exist_ok=True)
+        job = jobs.job_id(kind, params, version)
+        path = jobs.artifact_path(cache_dir, job)
+        if not os.path.exists(path):
+            with open(path, 'wb') as out:
+                render_report(kind, db.session, out, params)
+        return job
+    return jobs.submit(
+        db.engine.url.render_as_string(hide_password=False), kind, params, version, cache_dir,
+        workers=current_app.config['REPORT_WORKERS'], timeout=current_app.config['REPORT_JOB_TIMEOUT'],
+        pii_settings=pii_settings(current_app.config)
+    )
 
-    # Apply filters
-    if program_filter:
-        program = ProgramModel.query.filter_by(name=program_filter).first()
-        if program:
-            query = query.filter(Client.programs.contains(program))
+def report_params(kind, source):
+    _, names = REPORTS[kind]
+    return {name: source[name] for name in names if source.get(name)}
 
-    if after_date:
-        try:
-            after_date_obj = datetime.strptime(after_date, "%Y-%m-%d")
-            query = query.filter(Client.dob >= after_date_obj)
-        except ValueError:
-            pass  # Ignore bad dates
+def job_json(job):
+    status = jobs.job_status(report_cache_dir(), job, current_app.config['REPORT_JOB_TIMEOUT'])
+    status.update({
+        "job_id": job,
+        "status_url": url_for('report_job_status', job=job),
+        "download_url": url_for('report_job_download', job=job),
+    })
+    return status
+
+# Serve a cached report right away; otherwise give the pool a few seconds and,
+# if it is still rendering, send browsers to a page that waits for the job
+# (API clients get 202 with the job)
+def report_download(kind, download_name):
+    job = start_report(kind, report_params(kind, request.args))
+    path = jobs.artifact_path(report_cache_dir(), job)
+    if not os.path.exists(path):
+        jobs.wait(job, current_app.config['REPORT_WAIT_SECONDS'])
+    if os.path.exists(path):
+        return send_file(path, as_attachment=True, download_name=download_name, mimetype='application/pdf')
+    if request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'text/html':
+        return redirect(url_for('report_job_page', job=job, name=download_name))
+    return jsonify(job_json(job)), 202
+
+@routes.route('/download-clients-pdf')
+def download_clients_pdf():
+    return report_download('clients', "client_registry_filtered.pdf")
+
+# Report job API: enqueue, poll, download
+@routes.route('/api/reports/<kind>', methods=['POST'])
+def api_create_report(kind):
+    if kind not in REPORTS:
+        return jsonify({"error": f"Unknown report '{kind}'."}), 404
+    source = request.get_json(silent=True) or request.args
+    job = start_report(kind, report_params(kind, source))
+    data = job_json(job)
+    return jsonify(data), 200 if data['status'] == 'done' else 202
+
+@routes.route('/api/reports/jobs/<job>')
+def report_job_status(job):
+    if not jobs.is_job_id(job):
+        return jsonify({"error": "Unknown job."}), 404
+    data = job_json(job)
+    return jsonify(data), 404 if data['status'] == 'unknown' else 200
+
+@routes.route('/api/reports/jobs/<job>/download')
+def report_job_download(job):
+    if not jobs.is_job_id(job):
+        return jsonify({"error": "Unknown job."}), 404
+    path = jobs.artifact_path(report_cache_dir(), job)
+    if not os.path.exists(path):
+        return jsonify(job_json(job)), 404
+    name = secure_filename(request.args.get('name', '')) or f"report_{job}.pdf"
+    return send_file(path, as_attachment=True, download_name=name, mimetype='application/pdf')
+
+# Waiting page for a report still rendering: polls the job, then downloads it
+@routes.route('/reports/jobs/<job>')
+def report_job_page(job):
+    if not jobs.is_job_id(job):
+        abort(404)
+    return render_template('report_status.html', job=job_json(job), name=request.args.get('name', ''))
 
-    clients = query.all()
+#Export to CSV (Advanced Feature)
+EXPORT_CHUNK_SIZE = 500
 
-    # Create in-memory CSV
+# Serialize rows to CSV text one chunk at a time
+def csv_chunks(header, row_chunks):
     buffer = io.StringIO()
     writer = csv.writer(buffer)
+    writer.writerow(header)
+    for rows in row_chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
 
-    # Header
-    writer.writerow(["Name", "DOB", "Gender", "Contact", "Address", "Programs"])
-
-    # Write client rows
-    for client in clients:
-        programs = ", ".join([p.name for p in client.programs])
-        writer.writerow([client.name, client.dob, client.gender, client.contact, client.address, programs])
-
-    buffer.seek(0)
-
-    # Return as downloadable file
-    return send_file(
-        io.BytesIO(buffer.getvalue().encode()),
+# Exports are streamed with chunked transfer encoding so memory stays flat
+def csv_response(chunks, filename):
+    return Response(
+        stream_with_context(chunks),
         mimetype='text/csv',
-        as_attachment=True,
-        download_name="filtered_clients.csv"
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
-# Export programs to CSV
-@app.route('/export-programs-csv')
-def export_programs_csv():
-    programs = ProgramModel.query.all()
-
-    output = io.StringIO()
-    writer = csv.writer(output)
+@routes.route('/download-clients-csv')
+@etag(*REGISTRY_TABLES)
+def download_clients_csv():
+    # Optional query parameters
+    program_filter = request.args.get('program')
+    after_date = request.args.get('after')
 
-    # Write CSV Header
-    writer.writerow(['Program Name', 'Created By', 'Number of Clients'])
+    query = filtered_clients_query(program_filter, after_date).options(selectinload(Client.programs))
 
-    for program in programs:
-        writer.writerow([
-            program.name,
-            program.creator.name if program.creator else 'Unknown',
-            len(program.clients)
-        ])
+    def rows():
+        for clients in iter_chunks(query, Client.id, EXPORT_CHUNK_SIZE):
+            yield [
+                [c.name, c.dob, c.gender, c.contact, c.address, ", ".join(p.name for p in c.programs)]
+                for c in clients
+            ]
 
-    output.seek(0)
+    return csv_response(
+        csv_chunks(["Name", "DOB", "Gender", "Contact", "Address", "Programs"], rows()),
+        "filtered_clients.csv"
+    )
 
-    return Response(
-        output,
-        mimetype='text/csv',
-        headers={"Content-Disposition": "attachment; filename=programs_list.csv"}
+# Export programs to CSV
+@routes.route('/export-programs-csv')
+@etag(*REGISTRY_TABLES)
+def export_programs_csv():
+    query = ProgramModel.query.options(joinedload(ProgramModel.creator))
+
+    def rows():
+        for programs in iter_chunks(query, ProgramModel.id, EXPORT_CHUNK_SIZE):
+            # One grouped count per chunk instead of loading every enrolled client
+            counts = dict(db.session.query(enrollments.c.program_id, func.count())
+                          .filter(enrollments.c.program_id.in_([p.id for p in programs]))
+                          .group_by(enrollments.c.program_id))
+            yield [
+                [p.name, p.creator.name if p.creator else 'Unknown', counts.get(p.id, 0)]
+                for p in programs
+            ]
+
+    return csv_response(
+        csv_chunks(['Program Name', 'Created By', 'Number of Clients'], rows()),
+        "programs_list.csv"
     )
 
 
 # Export programs to PDF
-@app.route('/export-programs-pdf')
+@routes.route('/export-programs-pdf')
 def export_programs_pdf():
-    programs = ProgramModel.query.all()
-
-    buffer = io.BytesIO()
-    pdf = canvas.Canvas(buffer, pagesize=letter)
-    width, height = letter
-    y = height - 40
-
-    pdf.setFont("Helvetica-Bold", 16)
-    pdf.drawString(40, y, "Programs Report")
-    y -= 30
-    pdf.setFont("Helvetica", 11)
-
-    for program in programs:
-        created_by = program.creator.name if program.creator else 'Unknown'
-        enrolled_clients = len(program.clients)
-        pdf.drawString(40, y, f"{program.name} | Created by: {created_by} | {enrolled_clients} Clients")
-        y -= 20
-        if y < 40:
-            pdf.showPage()
-            y = height - 40
-
-    pdf.save()
-    buffer.seek(0)
-    return send_file(buffer, as_attachment=True, download_name="programs_report.pdf", mimetype='application/pdf')
-
-# --- Security Configurations ---
-app.config['SESSION_COOKIE_SECURE'] = True      # Cookie sent only via HTTPS
-app.config['SESSION_COOKIE_HTTPONLY'] = True    # Cookie can't be accessed via JavaScript
-app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'   # Protect against CSRF
-app.config['REMEMBER_COOKIE_SECURE'] = True     # If using 'Remember Me' login (future-proof)
-app.config['PERMANENT_SESSION_LIFETIME'] = 3600 # Sessions expire after 1 hour (in seconds)
-
+    return report_download('programs', "programs_report.pdf")
 
 # --- Run App ---
+# Development server only; production runs gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,301 @@
+# archive.py
+# Cold tier for rows the hot tables don't need to carry: clients with no
+# enrollments and no activity for ARCHIVE_IDLE_DAYS, and deleted programs.
+# Activity is client.updated_at: set on insert, and on every change to the
+# client or its enrollments by the flush listener below. Databases upgraded
+# from before the column existed start counting from the upgrade.
+# They live in a second SQLite file (ARCHIVE_PATH, default
+# instance/archive.db) and are restored on demand; the hot routes (search,
+# lists, exports, dashboard) only ever see the hot tables.
+#
+# Clients are archived by `flask archive-clients` in batches: each batch is
+# one DELETE ... RETURNING in its own short transaction, written to the
+# archive as one zlib-compressed NDJSON segment before the hot transaction
+# commits. The removal is reported to the change feed, so the search
+# indexes, aggregates, rollups, change log and caches follow as they do for
+# any delete. Values are archived as stored: PII stays encrypted.
+#
+# A crash between the two commits leaves a client in both places; archiving
+# it again replaces the stale archive entry.
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from datetime import date, timedelta
+from sqlalchemy import Text, bindparam, delete, exists, func, insert, select, type_coerce, update
+from changes import ChangeSet, on_flush, record
+from models import db, Client, ProgramModel, enrollments
+from pii import cipher, raw
+from utils import utcnow
+
+ARCHIVE_BATCH = 1000
+COMPRESS_LEVEL = 6
+_CLIENT_FIELDS = ('id', 'name', 'dob', 'gender', 'contact', 'address')
+
+def _compress(lines):
+    return zlib.compress('\n'.join(json.dumps(line, separators=(',', ':')) for line in lines).encode(), COMPRESS_LEVEL)
+
+def _decompress(payload):
+    return [json.loads(line) for line in zlib.decompress(payload).decode().split('\n') if line]
+
+def _now():
+    return utcnow().isoformat(timespec='seconds') + 'Z'
+
+class ArchiveStore:
+    """The archive file: client segments with an id index, and one
+    compressed record per deleted program (its enrollments included)."""
+
+    def __init__(self):
+        self.path = None
+        self._local = threading.local()
+
+    def configure(self, path):
+        self.path = path
+        self._local = threading.local()  # the file is created on first use
+
+    def _connect(self):
+        archive = getattr(self._local, 'db', None)
+        if archive is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            archive = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            archive.execute("PRAGMA journal_mode = WAL")
+            archive.execute("PRAGMA synchronous = NORMAL")
+            archive.execute("CREATE TABLE IF NOT EXISTS segment (id INTEGER PRIMARY KEY, payload BLOB NOT NULL)")
+            archive.execute("CREATE TABLE IF NOT EXISTS client ("
+                            "id INTEGER PRIMARY KEY, segment_id INTEGER NOT NULL, archived_at TEXT NOT NULL)")
+            archive.execute("CREATE INDEX IF NOT EXISTS ix_client_segment ON client (segment_id)")
+            archive.execute("CREATE TABLE IF NOT EXISTS program ("
+                            "id INTEGER PRIMARY KEY, archived_at TEXT NOT NULL, payload BLOB NOT NULL)")
+            self._local.db = archive
+        return archive
+
+    def add_clients(self, rows):
+        """Store client dicts (values as in the database) as one segment."""
+        archive, archived_at = self._connect(), _now()
+        archive.execute("BEGIN IMMEDIATE")
+        try:
+            segment_id = archive.execute("INSERT INTO segment (payload) VALUES (?)", (_compress(rows),)).lastrowid
+            archive.executemany("INSERT OR REPLACE INTO client VALUES (?, ?, ?)",
+                                [(row['id'], segment_id, archived_at) for row in rows])
+            self._drop_empty_segments(archive)
+            archive.execute("COMMIT")
+        except BaseException:
+            archive.execute("ROLLBACK")
+            raise
+
+    def clients(self, ids):
+        """Archived client dicts by id, with their archived_at."""
+        archive, found = self._connect(), {}
+        by_segment = {}
+        for start in range(0, len(ids), 500):
+            chunk = list(ids[start:start + 500])
+            marks = ','.join('?' * len(chunk))
+            for client_id, segment_id, archived_at in archive.execute(
+                    f"SELECT id, segment_id, archived_at FROM client WHERE id IN ({marks})", chunk):
+                by_segment.setdefault(segment_id, {})[client_id] = archived_at
+        for segment_id, wanted in by_segment.items():
+            payload = archive.execute("SELECT payload FROM segment WHERE id = ?", (segment_id,)).fetchone()[0]
+            for row in _decompress(payload):
+                if row['id'] in wanted:
+                    found[row['id']] = {**row, 'archived_at': wanted[row['id']]}
+        return found
+
+    def client_page(self, cursor, limit):
+        """(archived client dicts after `cursor` in id order, next cursor)."""
+        ids = [row[0] for row in self._connect().execute(
+            "SELECT id FROM client WHERE id > ? ORDER BY id LIMIT ?", (cursor, limit + 1))]
+        next_cursor = ids[limit - 1] if len(ids) > limit else None
+        found = self.clients(ids[:limit])
+        return [found[i] for i in ids[:limit] if i in found], next_cursor
+
+    def remove_clients(self, ids):
+        archive = self._connect()
+        archive.execute("BEGIN IMMEDIATE")
+        archive.executemany("DELETE FROM client WHERE id = ?", [(i,) for i in ids])
+        self._drop_empty_segments(archive)
+        archive.execute("COMMIT")
+
+    def _drop_empty_segments(self, archive):
+        archive.execute("DELETE FROM segment WHERE NOT EXISTS (SELECT 1 FROM client WHERE segment_id = segment.id)")
+
+    def add_program(self, program):
+        self._connect().execute("INSERT OR REPLACE INTO program VALUES (?, ?, ?)",
+                                (program['id'], _now(), _compress([program])))
+
+    def program(self, program_id):
+        row = self._connect().execute("SELECT archived_at, payload FROM program WHERE id = ?", (program_id,)).fetchone()
+        if row is None:
+            return None
+        return {**_decompress(row[1])[0], 'archived_at': row[0]}
+
+    def program_page(self, cursor, limit):
+        rows = self._connect().execute(
+            "SELECT id, archived_at, payload FROM program WHERE id > ? ORDER BY id LIMIT ?", (cursor, limit + 1)
+        ).fetchall()
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return [{**_decompress(payload)[0], 'archived_at': archived_at}
+                for _, archived_at, payload in rows[:limit]], next_cursor
+
+    def remove_program(self, program_id):
+        self._connect().execute("DELETE FROM program WHERE id = ?", (program_id,))
+
+    def counts(self):
+        archive = self._connect()
+        return {
+            "clients": archive.execute("SELECT count(*) FROM client").fetchone()[0],
+            "segments": archive.execute("SELECT count(*) FROM segment").fetchone()[0],
+            "programs": archive.execute("SELECT count(*) FROM program").fetchone()[0],
+            "bytes": archive.execute("SELECT coalesce(sum(length(payload)), 0) FROM segment").fetchone()[0]
+                     + archive.execute("SELECT coalesce(sum(length(payload)), 0) FROM program").fetchone()[0],
+        }
+
+    def clear(self):
+        archive = self._connect()
+        for table in ('client', 'segment', 'program'):
+            archive.execute(f"DELETE FROM {table}")
+
+store = ArchiveStore()
+
+def init_archive(app):
+    store.configure(app.config['ARCHIVE_PATH'] or os.path.join(app.instance_path, 'archive.db'))
+
+# --- ARCHIVING ---
+
+def _client_columns():
+    table = Client.__table__
+    return (table.c.id, raw(table.c.name), table.c.dob, table.c.gender, raw(table.c.contact), raw(table.c.address))
+
+def _client_row(row):
+    data = dict(zip(_CLIENT_FIELDS, row))
+    data['dob'] = data['dob'].isoformat()
+    return data
+
+# Stamp clients whose row or enrollments changed (inserts get the column default)
+@on_flush
+def _touch_clients(connection, changes):
+    touched = changes.clients['updated'] | {client_id for client_id, _ in changes.enrolled | changes.unenrolled}
+    touched -= changes.clients['deleted']
+    if touched:
+        table = Client.__table__
+        connection.execute(update(table).where(table.c.id == bindparam('client_id')).values(updated_at=utcnow()),
+                           [{'client_id': client_id} for client_id in sorted(touched)])
+
+def _inactive(cutoff):
+    table = Client.__table__
+    return [
+        ~exists().where(enrollments.c.client_id == table.c.id),
+        table.c.updated_at < cutoff,  # NULL (never stamped) counts as active
+        # The newest client stays hot: SQLite hands out max(id) + 1, so an
+        # archived id is never given to a new client
+        table.c.id < select(func.max(table.c.id)).scalar_subquery(),
+    ]
+
+def archive_clients(idle_days, batch_size=ARCHIVE_BATCH, max_clients=None, progress=None):
+    """Move clients with no enrollments and no activity (updated_at) in the
+    last `idle_days` days to the archive, one transaction per batch;
+    progress(count) is called after each. Returns the number archived."""
+    session = db.session
+    table = Client.__table__
+    cutoff = utcnow() - timedelta(days=idle_days)
+    archived, cursor = 0, 0
+    while max_clients is None or archived < max_clients:
+        size = batch_size if max_clients is None else min(batch_size, max_clients - archived)
+        batch = select(table.c.id).where(table.c.id > cursor, *_inactive(cutoff)).order_by(table.c.id).limit(size)
+        rows = session.execute(delete(table).where(table.c.id.in_(batch)).returning(*_client_columns())).all()
+        if not rows:
+            session.rollback()
+            break
+        clients = sorted((_client_row(row) for row in rows), key=lambda c: c['id'])
+        store.add_clients(clients)  # durable before the hot rows go
+
+        changes = ChangeSet()
+        changes.clients['deleted'].update(c['id'] for c in clients)
+        changes.client_before.update((row[0], (row[3], row[2])) for row in rows)
+        record(session, changes)
+        session.commit()
+        archived += len(clients)
+        cursor = clients[-1]['id']
+        if progress:
+            progress(len(clients))
+    return archived
+
+def archive_program(program):
+    """Keep a program that is about to be deleted, with its enrollments."""
+    client_ids = db.session.scalars(
+        select(enrollments.c.client_id).where(enrollments.c.program_id == program.id).order_by(enrollments.c.client_id)
+    ).all()
+    store.add_program({"id": program.id, "name": program.name, "created_by": program.created_by,
+                       "client_ids": client_ids})
+
+# --- RESTORE ---
+
+def _insert_clients(session, clients):
+    """Insert archived clients with their stored values, under their own id
+    unless a hot client has taken it. Returns {archived id: hot id}."""
+    table = Client.__table__
+    taken = set(session.scalars(select(table.c.id).where(table.c.id.in_([c['id'] for c in clients]))))
+    restored = {}
+    for client in clients:
+        values = {field: type_coerce(bindparam(field), Text) for field in ('name', 'contact', 'address')}
+        params = {**client, 'dob': date.fromisoformat(client['dob'])}
+        params.pop('archived_at', None)
+        if client['id'] in taken:
+            params.pop('id')
+        new_id = session.execute(insert(table).values(**values).returning(table.c.id), params).scalar_one()
+        restored[client['id']] = new_id
+    return restored
+
+def restore_clients(ids):
+    """Move archived clients back to the hot tables. Returns {archived id: hot id}."""
+    session = db.session
+    clients = store.clients(list(ids))
+    if not clients:
+        return {}
+    restored = _insert_clients(session, [clients[i] for i in sorted(clients)])
+    changes = ChangeSet()
+    changes.clients['inserted'].update(restored.values())
+    record(session, changes)
+    session.commit()
+    store.remove_clients(list(restored))
+    return restored
+
+def restore_program(program_id):
+    """Recreate a deleted program and its enrollments, bringing its archived
+    clients back too (clients deleted since are skipped). Returns
+    (hot program id, enrolled count), or None if it isn't archived."""
+    session = db.session
+    program = store.program(program_id)
+    if program is None:
+        return None
+    values = {"name": program['name'], "created_by": program['created_by']}
+    if session.get(ProgramModel, program_id) is None:
+        values["id"] = program_id
+    new_id = session.execute(insert(ProgramModel).values(**values).returning(ProgramModel.id)).scalar_one()
+
+    client_ids = program['client_ids']
+    archived = store.clients(client_ids)
+    restored = _insert_clients(session, [archived[i] for i in sorted(archived)])
+    hot = set(session.scalars(select(Client.id).where(Client.id.in_(set(client_ids) - set(archived)))))
+    pairs = {(restored.get(i, i), new_id) for i in client_ids if i in restored or i in hot}
+    if pairs:
+        session.execute(insert(enrollments), [{"client_id": c, "program_id": p} for c, p in sorted(pairs)])
+
+    changes = ChangeSet()
+    changes.programs['inserted'].add(new_id)
+    changes.clients['inserted'].update(restored.values())
+    changes.enrolled.update(pairs)
+    record(session, changes)
+    session.commit()
+    store.remove_clients(list(restored))
+    store.remove_program(program_id)
+    return new_id, len(pairs)
+
+# --- READS ---
+
+def client_json(client):
+    """An archived client in the /api/clients shape (decrypted), plus archived_at."""
+    name, contact, address = cipher.decrypt_many([client['name'], client['contact'], client['address']]) \
+        if cipher.enabled else (client['name'], client['contact'], client['address'])
+    return {"id": client['id'], "name": name, "dob": client['dob'], "gender": client['gender'],
+            "contact": contact, "address": address, "programs": [], "archived_at": client['archived_at']}
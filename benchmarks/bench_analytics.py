@@ -0,0 +1,68 @@
+# bench_analytics.py
+# Cost of the demographic breakdowns: grouping the base tables (enrollments
+# joined to every client) against reading the rollup tables (analytics.py),
+# cold and through the object cache, plus the write-side cost the rollups
+# add to a client edit.
+#
+#   python benchmarks/bench_analytics.py --sizes 100000,1000000
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import seed
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+def main():
+    parser = argparse.ArgumentParser(description='Demographic breakdowns: base tables vs rollups.')
+    parser.add_argument('--sizes', default='10000,100000')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    from sqlalchemy import extract, func, select
+    from app import create_app
+    from models import db, Client, enrollments
+    import analytics
+    from cache import cache, make_backend
+    print(f"{'clients':>8} {'base GROUP BY ms':>17} {'rollups ms':>11} {'cached ms':>10} {'edit ms':>8}")
+    for size in [int(s) for s in args.sizes.split(',')]:
+        with tempfile.TemporaryDirectory() as tmp:
+            app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'analytics.db')}",
+                              'TESTING': True, 'CACHE_BACKEND': 'none', 'SLOW_REQUEST_MS': 10 ** 9})
+            with app.app_context():
+                seed(db.session, size)
+                year = extract('year', Client.dob)
+
+                def base():
+                    db.session.execute(
+                        select(enrollments.c.program_id, Client.gender, year, func.count())
+                        .select_from(enrollments.join(Client, Client.id == enrollments.c.client_id))
+                        .group_by(enrollments.c.program_id, Client.gender, year)).all()
+                    db.session.execute(select(Client.gender, year, func.count()).group_by(Client.gender, year)).all()
+
+                base_ms = timed(base, args.repeat)
+                rollup_ms = timed(analytics.rollups, args.repeat)
+                cache.backend = make_backend('memory', None, 1000)
+                cached_ms = timed(analytics.cached_rollups, args.repeat)
+
+                client_ids = db.session.scalars(select(Client.id).limit(args.repeat)).all()
+                def edit():
+                    client = db.session.get(Client, client_ids.pop())
+                    client.gender = 'Female' if client.gender == 'Male' else 'Male'
+                    db.session.commit()
+                edit_ms = timed(edit, len(client_ids))
+            print(f"{size:>8} {base_ms:>17.1f} {rollup_ms:>11.2f} {cached_ms:>10.3f} {edit_ms:>8.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# bench_api_reads.py
+# Throughput of the JSON read endpoints on a seeded registry, with the object
+# and HTTP caches out of the way (CACHE_BACKEND=none, no If-None-Match), so
+# every request runs its queries and encodes its body. Run it before and
+# after a change to the read path; --json picks the encoder (see
+# json_provider.py).
+#
+#   python benchmarks/bench_api_reads.py --clients 20000 --json stdlib
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import seed
+
+def run(http, path, seconds):
+    count, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        response = http.get(path)
+        assert response.status_code == 200, (path, response.status_code)
+        count += 1
+    return count / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='JSON read endpoint throughput.')
+    parser.add_argument('--clients', type=int, default=20000)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--json', default='auto', help='auto, orjson or stdlib')
+    args = parser.parse_args()
+
+    from app import create_app
+    from models import db, Client, ProgramModel
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'reads.db')}",
+                          'TESTING': True, 'CACHE_BACKEND': 'none', 'JSON_ENCODER': args.json,
+                          'SLOW_REQUEST_MS': 10 ** 9})
+        with app.app_context():
+            seed(db.session, args.clients)
+            client_ids = db.session.scalars(db.select(Client.id)).all()
+            program_count = db.session.query(ProgramModel).count()
+        http = app.test_client()
+        rng = random.Random(3)
+        middle = client_ids[len(client_ids) // 2]
+        paths = {
+            'GET /api/clients?limit=100': '/api/clients?limit=100',
+            'GET /api/clients?limit=1000': f'/api/clients?limit=1000&cursor={middle}',
+            'GET /api/clients/<id>': None,
+            'GET /api/programs?limit=100': '/api/programs?limit=100',
+            'GET /api/dashboard-data': '/api/dashboard-data',
+        }
+        print(f"{args.clients} clients, {program_count} programs, json={app.json.__class__.__name__}")
+        print(f"{'route':<30} {'req/s':>9}")
+        for label, path in paths.items():
+            if path is None:
+                ids = iter(rng.choice(client_ids) for _ in range(10 ** 7))
+                count, start = 0, time.perf_counter()
+                while time.perf_counter() - start < args.seconds:
+                    assert http.get(f'/api/clients/{next(ids)}').status_code == 200
+                    count += 1
+                rate = count / (time.perf_counter() - start)
+            else:
+                rate = run(http, path, args.seconds)
+            print(f"{label:<30} {rate:>9.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# bench_archive.py
+# The archive job on a synthetic registry (about 15% of clients have no
+# enrollments): batch times (each batch is one write transaction, so the
+# longest one bounds how long other writers wait), archive size against the
+# rows it holds, scan-based routes before and after, and single restores.
+#
+#   python benchmarks/bench_archive.py --clients 100000 --batch-size 1000
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import seed
+
+ROUTES = ('/api/clients/search?q=mar', '/download-clients-csv', '/api/dashboard-data')
+
+def route_ms(http, repeat):
+    timings = {}
+    for path in ROUTES:
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = http.get(path)
+            response.get_data()
+            samples.append((time.perf_counter() - start) * 1000)
+        timings[path] = statistics.median(samples)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive job cost and its effect on the hot routes.')
+    parser.add_argument('--clients', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    from sqlalchemy import func, select, text
+    from app import create_app
+    from models import db, Client
+    import archive
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'hot.db')}",
+                          'ARCHIVE_PATH': os.path.join(tmp, 'archive.db'), 'TESTING': True,
+                          'CACHE_BACKEND': 'none', 'SLOW_REQUEST_MS': 10 ** 9})
+        http = app.test_client()
+        with http.session_transaction() as sess:
+            sess['logged_in'] = True
+        with app.app_context():
+            seed(db.session, args.clients)
+        before = route_ms(http, args.repeat)
+
+        with app.app_context():
+            row_bytes = db.session.scalar(text(
+                "SELECT sum(length(name) + length(contact) + length(address) + 30) FROM client "
+                "WHERE id NOT IN (SELECT client_id FROM enrollments)"))
+            batches, last = [], [time.perf_counter()]
+            def lap(count):
+                now = time.perf_counter()
+                batches.append((now - last[0]) * 1000)
+                last[0] = now
+            archive.archive_clients(idle_days=0, batch_size=args.batch_size, progress=lap)
+            archived = archive.store.counts()
+            hot = db.session.scalar(select(func.count()).select_from(Client))
+            archived_ids = [c['id'] for c in archive.store.client_page(0, archived['clients'])[0]]
+            sample = random.Random(7).sample(archived_ids, min(20, len(archived_ids)))
+            restores = []
+            for client_id in sample:
+                start = time.perf_counter()
+                archive.restore_clients([client_id])
+                restores.append((time.perf_counter() - start) * 1000)
+        after = route_ms(http, args.repeat)
+
+    print(f"archived {archived['clients']} of {args.clients} clients in {len(batches)} batches of {args.batch_size}: "
+          f"{sum(batches) / 1000:.1f} s total, batch p50 {statistics.median(batches):.1f} ms, max {max(batches):.1f} ms")
+    print(f"archive {archived['bytes'] / 1e6:.2f} MB compressed for ~{row_bytes / 1e6:.2f} MB of rows; {hot} clients stay hot")
+    print(f"restore one client: p50 {statistics.median(restores):.1f} ms, max {max(restores):.1f} ms")
+    print(f"{'route':<28} {'before ms':>10} {'after ms':>10}")
+    for path in ROUTES:
+        print(f"{path:<28} {before[path]:>10.1f} {after[path]:>10.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# bench_changes.py
+# What a partner system pays to stay in sync: a full pull of /api/clients and
+# /api/programs against one /api/changes?since= read after a given amount of
+# churn (client edits through the ORM, so they go through the change log),
+# on registries of growing size.
+#
+#   python benchmarks/bench_changes.py --sizes 10000,50000 --churn 100
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import seed
+
+def full_pull(http):
+    start, count = time.perf_counter(), 0
+    for path in ('/api/clients', '/api/programs'):
+        cursor = ''
+        while True:
+            response = http.get(f'{path}?limit=1000{cursor}')
+            count += len(response.get_json())
+            next_cursor = response.headers.get('X-Next-Cursor')
+            if not next_cursor:
+                break
+            cursor = f'&cursor={next_cursor}'
+    return time.perf_counter() - start, count
+
+def changes_since(http, since):
+    start, count = time.perf_counter(), 0
+    while True:
+        response = http.get(f'/api/changes?since={since}')
+        count += len(response.get_data(as_text=True).splitlines())
+        since = response.headers['X-Change-Seq']
+        if 'X-Next-Cursor' not in response.headers:
+            break
+    return time.perf_counter() - start, count
+
+def main():
+    parser = argparse.ArgumentParser(description='Full pull vs change feed sync cost.')
+    parser.add_argument('--sizes', default='10000,50000')
+    parser.add_argument('--churn', type=int, default=100, help='clients edited between syncs')
+    args = parser.parse_args()
+
+    from app import create_app
+    from models import db, Client
+    import changelog
+    print(f"{'clients':>8} {'churn':>6} {'full pull ms':>13} {'rows':>7} {'changes ms':>11} {'entries':>8}")
+    for size in [int(s) for s in args.sizes.split(',')]:
+        with tempfile.TemporaryDirectory() as tmp:
+            app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'changes.db')}",
+                              'TESTING': True, 'CACHE_BACKEND': 'none', 'SLOW_REQUEST_MS': 10 ** 9})
+            with app.app_context():
+                seed(db.session, size)
+                since = changelog.head(db.session.connection())
+                ids = db.session.scalars(db.select(Client.id)).all()
+                for client_id in random.Random(5).sample(ids, args.churn):
+                    db.session.get(Client, client_id).address = f'moved-{client_id}@example.com'
+                db.session.commit()
+            http = app.test_client()
+            pull, rows = full_pull(http)
+            feed, entries = changes_since(http, since)
+            print(f"{size:>8} {args.churn:>6} {pull * 1000:>13.1f} {rows:>7} {feed * 1000:>11.1f} {entries:>8}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# bench_concurrency.py
+# Read/write throughput of several worker processes sharing one SQLite file,
+# with the engine settings the app used before config.py (rollback journal,
+# driver defaults) and with the tuned ones (WAL, synchronous=NORMAL, busy
+# timeout, cache/mmap pragmas).
+#
+#   python benchmarks/bench_concurrency.py --workers 4 --seconds 5
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.exc import OperationalError
+from config import engine_options, install_sqlite_pragmas
+from models import db, Client
+
+def make_engine(url, tuned):
+    if not tuned:
+        return create_engine(url)
+    engine = create_engine(url, **engine_options(url))
+    install_sqlite_pragmas(engine)
+    return engine
+
+def seed(url, clients):
+    engine = create_engine(url)
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Client), [
+            {"name": f"Client {i}", "dob": date(1990, 1, 1), "gender": "Male",
+             "contact": f"07{i:08d}", "address": f"c{i}@example.com"}
+            for i in range(clients)
+        ])
+    engine.dispose()
+
+def worker(url, tuned, seconds, write_ratio, clients, results):
+    engine = make_engine(url, tuned)
+    rng = random.Random(os.getpid())
+    reads = writes = locked = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        try:
+            if rng.random() < write_ratio:
+                with engine.begin() as connection:
+                    connection.execute(insert(Client).values(
+                        name="Bench Writer", dob=date(1990, 1, 1), gender="Female",
+                        contact="0700000000", address="w@example.com"))
+                writes += 1
+            else:
+                cursor = rng.randint(0, clients)
+                with engine.connect() as connection:
+                    connection.execute(select(Client).where(Client.id > cursor).order_by(Client.id).limit(50)).all()
+                reads += 1
+        except OperationalError:
+            locked += 1  # "database is locked"
+    results.put((reads, writes, locked))
+
+def run(tuned, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        seed(url, args.clients)
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=worker, args=(url, tuned, args.seconds, args.write_ratio,
+                                                              args.clients, results))
+                 for _ in range(args.workers)]
+        for p in procs:
+            p.start()
+        totals = [sum(x) for x in zip(*(results.get() for _ in procs))]
+        for p in procs:
+            p.join()
+    reads, writes, locked = totals
+    label = "tuned (WAL)" if tuned else "before (rollback journal)"
+    print(f"{label:28} reads/s {reads / args.seconds:9.0f}   writes/s {writes / args.seconds:7.0f}   "
+          f"locked errors {locked}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--clients', type=int, default=20000)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    args = parser.parse_args()
+    print(f"{args.workers} workers, {args.seconds:.0f} s each, {args.write_ratio:.0%} writes")
+    run(False, args)
+    run(True, args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# bench_export_filter.py
+# Query plans and timings for the client export filters (?program= and
+# ?after=) on a legacy-schema database, before and after migrations.upgrade().
+#
+#   python benchmarks/bench_export_filter.py --clients 200000
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import Session
+from migrations import upgrade
+from reports import filter_clients
+
+# Schema as it was before migration 1
+LEGACY_SCHEMA = """
+CREATE TABLE doctor (id INTEGER NOT NULL PRIMARY KEY, username VARCHAR(50) NOT NULL UNIQUE,
+                     password VARCHAR(128) NOT NULL, name VARCHAR(100) NOT NULL);
+CREATE TABLE client (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(100) NOT NULL, dob VARCHAR(20) NOT NULL,
+                     gender VARCHAR(20) NOT NULL, contact VARCHAR(50) NOT NULL, address VARCHAR(255) NOT NULL);
+CREATE TABLE program_model (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(100) NOT NULL,
+                            created_by INTEGER NOT NULL REFERENCES doctor (id));
+CREATE TABLE enrollments (client_id INTEGER REFERENCES client (id), program_id INTEGER REFERENCES program_model (id));
+"""
+
+# What the export routes sent before: Client.programs.contains(program) and a
+# datetime compared against the VARCHAR dob
+LEGACY_FILTER_SQL = (
+    "SELECT client.id, client.name, client.dob, client.gender, client.contact, client.address "
+    "FROM client, enrollments AS enrollments_1 "
+    "WHERE client.id = enrollments_1.client_id AND ? = enrollments_1.program_id AND client.dob >= ?"
+)
+
+def seed(path, clients, programs, seed_value=7):
+    rng = random.Random(seed_value)
+    connection = sqlite3.connect(path)
+    connection.executescript(LEGACY_SCHEMA)
+    connection.execute("INSERT INTO doctor VALUES (1, 'bench', 'x', 'Bench Doctor')")
+    connection.executemany("INSERT INTO program_model VALUES (?, ?, 1)",
+                           [(i, f"Program {i}") for i in range(1, programs + 1)])
+    connection.executemany("INSERT INTO client VALUES (?, ?, ?, ?, ?, ?)", (
+        (i, f"Client {i}", f"{rng.randint(1940, 2020)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+         rng.choice(("Male", "Female")), f"07{i:08d}", f"client{i}@example.com")
+        for i in range(1, clients + 1)
+    ))
+    connection.executemany("INSERT INTO enrollments VALUES (?, ?)", (
+        (i, p) for i in range(1, clients + 1) for p in rng.sample(range(1, programs + 1), rng.randint(0, 3))
+    ))
+    connection.commit()
+    connection.close()
+
+def timed(connection, sql, params, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        rows = connection.execute(sql, params).fetchall()
+        samples.append(time.perf_counter() - start)
+    return len(rows), statistics.median(samples) * 1000
+
+def report(label, connection, sql, params, runs):
+    print(f"\n== {label}")
+    print(sql)
+    for row in connection.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+        print("   plan:", row[-1])
+    count, ms = timed(connection, sql, params, runs)
+    print(f"   {count} rows, median {ms:.1f} ms over {runs} runs")
+
+def current_sql(engine, program, after):
+    with Session(engine) as session:
+        query = filter_clients(session, program, after)
+        compiled = query.statement.compile(dialect=sqlite.dialect())
+        return str(compiled), tuple(compiled.params[k] for k in compiled.positiontup)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=100000)
+    parser.add_argument('--programs', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        seed(path, args.clients, args.programs)
+        print(f"Seeded {args.clients} clients, {args.programs} programs")
+
+        connection = sqlite3.connect(path)
+        report("before: program + after filter", connection, LEGACY_FILTER_SQL,
+               (3, "2000-01-01 00:00:00.000000"), args.runs)
+        report("before: after filter only", connection,
+               "SELECT * FROM client WHERE client.dob >= ?", ("2000-01-01 00:00:00.000000",), args.runs)
+        connection.close()
+
+        engine = create_engine(f"sqlite:///{path}")
+        start = time.perf_counter()
+        upgrade(engine)
+        print(f"\nmigrations.upgrade() took {time.perf_counter() - start:.2f} s")
+
+        connection = sqlite3.connect(path)
+        sql, params = current_sql(engine, "Program 3", "2000-01-01")
+        report("after: program + after filter", connection, sql, params, args.runs)
+        sql, params = current_sql(engine, None, "2000-01-01")
+        report("after: after filter only", connection, sql, params, args.runs)
+        connection.close()
+
+if __name__ == '__main__':
+    main()
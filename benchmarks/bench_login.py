@@ -0,0 +1,55 @@
+# bench_login.py
+# Login throughput of the bcrypt hashing pool (passwords.py): password checks
+# per second, and per core, for a burst of concurrent logins at each pool size,
+# plus how many of them were turned away with 503 once the queue filled up.
+#
+#   python benchmarks/bench_login.py --rounds 12 --clients 32 --logins 128
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from passwords import PasswordHasher, PoolSaturated
+
+def burst(hasher, hashed, clients, logins):
+    def login(_):
+        try:
+            return hasher.verify('correct horse', hashed)
+        except PoolSaturated:
+            return None
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(login, range(logins)))
+    elapsed = time.perf_counter() - start
+    return sum(r is True for r in results), results.count(None), elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--clients', type=int, default=32, help='concurrent login requests')
+    parser.add_argument('--logins', type=int, default=128)
+    parser.add_argument('--max-pending', type=int, default=16)
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    sizes = sorted({1, max(1, cores // 2), cores})
+    print(f"bcrypt cost {args.rounds}, {args.clients} concurrent clients, {args.logins} logins, {cores} cores")
+    print(f"{'workers':>8} {'ok':>6} {'503':>6} {'logins/s':>10} {'per core':>10}")
+    for workers in sizes:
+        hasher = PasswordHasher(workers=workers, max_pending=args.max_pending, rounds=args.rounds,
+                                admission_wait=30)
+        hashed = hasher.hash('correct horse')
+        ok, rejected, elapsed = burst(hasher, hashed, args.clients, args.logins)
+        rate = ok / elapsed
+        print(f"{workers:>8} {ok:>6} {rejected:>6} {rate:>10.1f} {rate / workers:>10.1f}")
+
+    # Same burst with no admission wait: the overflow is rejected immediately
+    hasher = PasswordHasher(workers=1, max_pending=args.max_pending, rounds=args.rounds, admission_wait=0)
+    ok, rejected, elapsed = burst(hasher, hasher.hash('correct horse'), args.clients, args.logins)
+    print(f"\nsaturated (1 worker, no wait): {ok} ok, {rejected} answered 503 in {elapsed:.2f}s")
+
+if __name__ == '__main__':
+    main()
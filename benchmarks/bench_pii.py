@@ -0,0 +1,109 @@
+# bench_pii.py
+# Cost of PII encryption at rest (pii.py). First per row, in isolation:
+# encrypting a client's three fields, decrypting them with a cold and a warm
+# cache, and computing its blind indexes. Then end to end, on the same
+# synthetic registry stored in plaintext and encrypted: seeding, a full CSV
+# export (cold decrypt cache), a full /api/clients walk (warm cache) and
+# search (prefix terms answered from the tokens alone, and a long term that
+# needs candidate decryption).
+#
+#   python benchmarks/bench_pii.py --clients 20000
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import client_rows, seed
+
+SEARCHES = ('wan', 'otieno ka', 'kenyatta', 'nairobi 07')
+
+def per_row(rows):
+    from cryptography.fernet import Fernet
+    from pii import cipher
+    cipher.configure([Fernet.generate_key().decode()], 'bench-index-key', cache_size=len(rows) * 3)
+    fields = [(r['name'], r['contact'], r['address']) for r in rows]
+
+    def timed(fn, values):
+        start = time.perf_counter()
+        result = [fn(row) for row in values]
+        return (time.perf_counter() - start) / len(values) * 1e6, result
+
+    results = {}
+    results['encrypt'], encrypted = timed(lambda row: [cipher.encrypt(v, remember=False) for v in row], fields)
+    results['decrypt (cold)'], _ = timed(cipher.decrypt_many, encrypted)
+    results['decrypt (cached)'], _ = timed(cipher.decrypt_many, encrypted)
+    results['blind indexes'], _ = timed(lambda row: (cipher.blind_index('name', row[0]),
+                                                     cipher.blind_index('contact', row[1]), cipher.tokens(*row)), fields)
+    token_counts = [len(cipher.tokens(*row)) for row in fields]
+    cipher.configure([])
+    return results, statistics.mean(token_counts)
+
+def end_to_end(clients, encrypted, tmp):
+    from cryptography.fernet import Fernet
+    from app import create_app
+    from models import db
+    from pii import cipher
+    config = {'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'enc.db' if encrypted else 'plain.db')}",
+              'TESTING': True, 'CACHE_BACKEND': 'none',
+              'PII_ENCRYPTION_KEYS': Fernet.generate_key().decode() if encrypted else '',
+              'PII_INDEX_KEY': 'bench-index-key'}
+    app = create_app(config)
+    timings = {}
+    with app.app_context():
+        start = time.perf_counter()
+        seed(db.session, clients)
+        timings['seed'] = time.perf_counter() - start
+    cipher.clear_cache()  # the first export below decrypts cold, the walk after it is cached
+    http = app.test_client()
+    with http.session_transaction() as session:
+        session['doctor_id'] = 1
+
+    start = time.perf_counter()
+    http.get('/download-clients-csv').get_data()
+    timings['csv export'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cursor = ''
+    while True:
+        response = http.get(f'/api/clients?limit=500{cursor}')
+        next_cursor = response.headers.get('X-Next-Cursor')
+        if not next_cursor:
+            break
+        cursor = f'&cursor={next_cursor}'
+    timings['api walk'] = time.perf_counter() - start
+
+    for query in SEARCHES:
+        runs = []
+        for _ in range(5):
+            start = time.perf_counter()
+            http.get('/api/clients/search', query_string={'q': query})
+            runs.append(time.perf_counter() - start)
+        timings[f'search "{query}"'] = statistics.median(runs)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description='PII encryption overhead.')
+    parser.add_argument('--clients', type=int, default=20000)
+    args = parser.parse_args()
+
+    rows = list(client_rows(random.Random(1), min(args.clients, 20000)))
+    results, tokens = per_row(rows)
+    print(f"Per client row (3 fields), {len(rows)} rows; {tokens:.0f} prefix tokens per client")
+    for label, micros in results.items():
+        print(f"  {label:<18} {micros:8.1f} us")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        plain = end_to_end(args.clients, False, tmp)
+        encrypted = end_to_end(args.clients, True, tmp)
+    print(f"\n{args.clients} clients (ms)      plaintext  encrypted   ratio")
+    for label in plain:
+        print(f"  {label:<22} {plain[label] * 1000:9.1f} {encrypted[label] * 1000:10.1f} "
+              f"{encrypted[label] / plain[label]:7.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# bench_reports.py
+# PDF report rendering on a seeded registry: wall time, peak Python heap
+# (tracemalloc) and output size of each report, rendered straight to a file
+# the way the report jobs do (see jobs.py).
+#
+#   python benchmarks/bench_reports.py --sizes 10000,50000
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import seed
+
+def main():
+    parser = argparse.ArgumentParser(description='PDF report time and memory.')
+    parser.add_argument('--sizes', default='10000,50000')
+    parser.add_argument('--reports', default='clients,programs')
+    args = parser.parse_args()
+
+    from sqlalchemy.orm import Session
+    from app import create_app
+    from models import db
+    from reports import render_report
+    print(f"{'clients':>8} {'report':>9} {'seconds':>8} {'peak heap MB':>13} {'PDF MB':>7}")
+    for size in [int(s) for s in args.sizes.split(',')]:
+        with tempfile.TemporaryDirectory() as tmp:
+            app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'reports.db')}",
+                              'TESTING': True, 'CACHE_BACKEND': 'none'})
+            with app.app_context():
+                seed(db.session, size)
+                engine = db.engine
+            for kind in args.reports.split(','):
+                path = os.path.join(tmp, f'{kind}.pdf')
+                with Session(engine) as session, open(path, 'wb') as out:
+                    tracemalloc.start()
+                    start = time.perf_counter()
+                    render_report(kind, session, out, {})
+                    elapsed = time.perf_counter() - start
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                print(f"{size:>8} {kind:>9} {elapsed:>8.2f} {peak / 1e6:>13.1f} {os.path.getsize(path) / 1e6:>7.2f}")
+
+if __name__ == '__main__':
+    main()
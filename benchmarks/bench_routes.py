@@ -0,0 +1,238 @@
+# bench_routes.py
+# Load and regression benchmark for every route in app.py. For each dataset
+# size a fresh SQLite registry is seeded (synthetic.py) in its own process,
+# then each route is requested --repeat times through the Flask test client.
+# Reported per route: p50/p95/p99 latency, SQL statements per request and
+# response status; per size: seed time and peak RSS. Results are written as
+# JSON; pass --baseline with an earlier results file to fail (exit 1) when a
+# route's p95 grows past --threshold or it starts issuing more queries.
+#
+#   python benchmarks/bench_routes.py --sizes 1000,10000 --out results.json
+#   python benchmarks/bench_routes.py --sizes 1000,10000 --baseline results.json
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Not benchmarked: /api/stream holds the connection open by design, and
+# /logout, /delete-client and /programs/delete would change what later routes see
+def routes(state):
+    """(name, method, path, request kwargs) for one iteration; state holds ids
+    from the seeded data and a counter so write routes never collide."""
+    n = state['n'] = state['n'] + 1
+    client_id, program_id = state['client_id'], state['program_id']
+    state.setdefault('created', [])
+    return [
+        ('GET /', 'GET', '/', {}),
+        ('GET /login', 'GET', '/login', {}),
+        ('POST /login', 'POST', '/login', {'data': {'username': 'bench', 'password': 'bench'}}),
+        ('GET /signup', 'GET', '/signup', {}),
+        ('GET /dashboard', 'GET', '/dashboard', {}),
+        ('GET /api/dashboard-data', 'GET', '/api/dashboard-data', {}),
+        ('GET /clients', 'GET', '/clients', {}),
+        ('GET /clients next page', 'GET', f'/clients?cursor={client_id}', {'headers': {'X-Requested-With': 'XMLHttpRequest'}}),
+        ('GET /clients?search', 'GET', '/clients?search=wanj', {'headers': {'X-Requested-With': 'XMLHttpRequest'}}),
+        ('GET /client/<id>', 'GET', f'/client/{client_id}', {}),
+        ('GET /edit-client/<id>', 'GET', f'/edit-client/{client_id}', {}),
+        ('GET /enroll-client/<id>', 'GET', f'/enroll-client/{client_id}', {}),
+        ('GET /register-client', 'GET', '/register-client', {}),
+        ('GET /programs', 'GET', '/programs', {}),
+        ('GET /programs/new', 'GET', '/programs/new', {}),
+        ('GET /programs/edit/<id>', 'GET', f'/programs/edit/{program_id}', {}),
+        ('GET /summary', 'GET', '/summary', {}),
+        ('GET /api/clients', 'GET', '/api/clients?limit=100', {}),
+        ('GET /api/clients cursor', 'GET', f'/api/clients?limit=100&cursor={client_id}', {}),
+        ('GET /api/clients/<id>', 'GET', f'/api/clients/{client_id}', {}),
+        ('GET /api/clients/search', 'GET', '/api/clients/search?q=wanj', {}),
+        ('GET /api/programs', 'GET', '/api/programs', {}),
+        ('GET /api/cache-stats', 'GET', '/api/cache-stats', {}),
+        ('GET /api/outbox', 'GET', '/api/outbox', {}),
+        ('GET /download-clients-csv', 'GET', '/download-clients-csv', {}),
+        ('GET /download-clients-csv?program', 'GET', f'/download-clients-csv?program={program_id}', {}),
+        ('GET /export-programs-csv', 'GET', '/export-programs-csv', {}),
+        ('GET /download-clients-pdf', 'GET', '/download-clients-pdf', {}),
+        ('GET /export-programs-pdf', 'GET', '/export-programs-pdf', {}),
+        ('POST /api/reports/clients', 'POST', '/api/reports/clients', {'json': {'program': program_id}}),
+        ('POST /email-clients-pdf', 'POST', '/email-clients-pdf', {'data': {'emails': 'bench@example.com'}}),
+        ('POST /api/create-client', 'POST', '/api/create-client', {'json': {
+            'first_name': 'Bench', 'last_name': f'Client{n}', 'dob': '1990-01-01', 'gender': 'Female',
+            'contact': f'07{n:08d}', 'address': 'Bench Road'}}),
+        ('POST /register-client', 'POST', '/register-client', {'data': {
+            # Distinct birth dates, so the duplicate check lets the similar names through
+            'first_name': 'Form', 'last_name': f'Client{n}', 'dob': (date(1950, 1, 1) + timedelta(days=n)).isoformat(), 'gender': 'Male',
+            'country_code': '+254', 'contact': f'7{n:08d}', 'email': 'form@example.com'}}),
+        ('POST /edit-client/<id>', 'POST', f'/edit-client/{client_id}', {'data': {
+            'first_name': 'Edited', 'last_name': f'Client{n}', 'dob': '1980-02-02', 'gender': 'Female', 'contact': '0700000000',
+            'address': 'Edit Road'}}),
+        ('POST /api/enroll-client', 'POST', '/api/enroll-client',
+         {'json': {'client_id': client_id, 'program_ids': [program_id]}}),
+        ('POST /enroll-client/<id>', 'POST', f'/enroll-client/{client_id}', {'data': {'program_ids': [program_id]}}),
+        ('POST /api/enrollments/bulk', 'POST', '/api/enrollments/bulk', {'json': {
+            'client_ids': list(range(client_id, client_id + 50)),
+            **({'add': [program_id]} if n % 2 else {'remove': [program_id]})}}),
+        ('POST /api/clients/import', 'POST', '/api/clients/import?format=ndjson', {
+            'data': ''.join(json.dumps({'name': f'Imported {n}-{i}', 'dob': '2000-01-01', 'gender': 'Male',
+                                        'contact': f'07{i:08d}', 'address': 'Import Lane'}) + '\n'
+                            for i in range(20)),
+            'content_type': 'application/x-ndjson'}),
+        ('POST /api/create-program', 'POST', '/api/create-program', {'json': {'name': f'Bench Program {n}'}}),
+        ('POST /programs/new', 'POST', '/programs/new', {'data': {'name': f'Form Program {n}'}}),
+        ('POST /programs/edit/<id>', 'POST', f'/programs/edit/{program_id}', {'data': {'name': f'Renamed {n}'}}),
+        ('DELETE /api/delete-client/<id>', 'DELETE', None, {}),  # path filled in from `created`
+    ]
+
+def percentile(values, q):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+def run_size(size, repeat, workdir):
+    """Runs in a child process: seed a registry of `size` clients and time every route."""
+    os.environ.update(DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+                      REPORT_CACHE_DIR=os.path.join(workdir, 'reports'), OUTBOX_SENDER='false',
+                      BCRYPT_LOG_ROUNDS='10')
+    from sqlalchemy import event, select
+    from app import create_app
+    from models import db
+    from models import Client, ProgramModel
+    from passwords import hasher
+    from synthetic import seed
+
+    app = create_app()
+
+    start = time.perf_counter()
+    with app.app_context():
+        seed(db.session, size, password_hash=hasher.hash('bench'))
+        client_id = db.session.scalar(select(Client.id).order_by(Client.id).offset(size // 2).limit(1))
+        program_id = db.session.scalar(select(ProgramModel.id).order_by(ProgramModel.id).limit(1))
+        engine = db.engine
+    seed_seconds = time.perf_counter() - start
+
+    queries = [0]
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_query(*args):
+        queries[0] += 1
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+    timings, query_counts, statuses = {}, {}, {}
+    state = {'n': 0, 'client_id': client_id, 'program_id': program_id}
+    for _ in range(repeat):
+        for name, method, path, kwargs in routes(state):
+            if path is None:
+                if not state['created']:
+                    continue
+                path = f"/api/delete-client/{state['created'].pop()}"
+            queries[0] = 0
+            start = time.perf_counter()
+            response = client.open(path, method=method, **kwargs)
+            response.get_data()  # drain streamed bodies
+            elapsed = time.perf_counter() - start
+            if name == 'POST /api/create-client' and response.status_code == 201:
+                with app.app_context():
+                    state['created'].append(db.session.scalar(select(Client.id).order_by(Client.id.desc()).limit(1)))
+            timings.setdefault(name, []).append(elapsed * 1000)
+            query_counts.setdefault(name, []).append(queries[0])
+            statuses.setdefault(name, set()).add(response.status_code)
+
+    return {
+        'seed_seconds': round(seed_seconds, 2),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'routes': {
+            name: {
+                'p50_ms': round(percentile(values, 50), 2),
+                'p95_ms': round(percentile(values, 95), 2),
+                'p99_ms': round(percentile(values, 99), 2),
+                'mean_ms': round(statistics.fmean(values), 2),
+                'queries': round(statistics.fmean(query_counts[name]), 1),
+                'status': sorted(statuses[name]),
+            } for name, values in timings.items()
+        },
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, threshold, min_ms):
+    """Regressions of results against baseline: p95 beyond threshold (and the
+    min_ms noise floor) or more queries per request."""
+    problems = []
+    for size, current in results['sizes'].items():
+        previous = baseline.get('sizes', {}).get(size)
+        if previous is None:
+            continue
+        for name, now in current['routes'].items():
+            before = previous['routes'].get(name)
+            if before is None:
+                continue
+            if now['p95_ms'] > before['p95_ms'] * (1 + threshold) and now['p95_ms'] - before['p95_ms'] > min_ms:
+                problems.append(f"{size} clients, {name}: p95 {before['p95_ms']} -> {now['p95_ms']} ms")
+            if now['queries'] > before['queries']:
+                problems.append(f"{size} clients, {name}: queries {before['queries']} -> {now['queries']}")
+    return problems
+
+def print_table(results):
+    for size, data in results['sizes'].items():
+        print(f"\n{size} clients (seeded in {data['seed_seconds']}s, peak RSS {data['peak_rss_mb']} MB)")
+        print(f"{'route':<38} {'p50':>8} {'p95':>8} {'p99':>8} {'queries':>8}  status")
+        for name, r in data['routes'].items():
+            print(f"{name:<38} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8} {r['queries']:>8}  "
+                  f"{','.join(map(str, r['status']))}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Route latency benchmark at several dataset sizes.')
+    parser.add_argument('--sizes', default='1000,10000', help='comma separated client counts')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--out', help='write results JSON here')
+    parser.add_argument('--baseline', help='results JSON from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed p95 growth, 0.25 = 25%%')
+    parser.add_argument('--min-ms', type=float, default=2.0, help='ignore p95 changes smaller than this')
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)  # child process mode
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.size:
+        json.dump(run_size(args.size, args.repeat, args.workdir), sys.stdout)
+        return
+
+    results = {'commit': git_commit(), 'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'repeat': args.repeat, 'sizes': {}}
+    for size in (int(s) for s in args.sizes.split(',')):
+        # One process per size: a clean import of the app against its own
+        # database, and a peak RSS that belongs to that size alone
+        with tempfile.TemporaryDirectory() as workdir:
+            output = subprocess.run([sys.executable, __file__, '--size', str(size), '--repeat', str(args.repeat),
+                                     '--workdir', workdir], cwd=workdir, capture_output=True, text=True)
+        if output.returncode:
+            sys.exit(f"{size} clients failed:\n{output.stderr}")
+        results['sizes'][str(size)] = json.loads(output.stdout.strip().splitlines()[-1])
+    print_table(results)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(results, json.load(f), args.threshold, args.min_ms)
+        if problems:
+            print('\nRegressions against', args.baseline)
+            print('\n'.join(problems))
+            sys.exit(1)
+        print('\nNo regressions against', args.baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# bench_similarity.py
+# Latency of the in-memory trigram index (storage.py) at registry scale,
+# without a database: builds the index from N synthetic clients, then times
+# typo-tolerant name searches, contact lookups and the registration
+# duplicate check on misspelled copies of existing clients. Names are drawn
+# with a Zipf-like skew from pools of --first-names and --surnames made-up
+# words, so the vocabulary grows like a real registry's rather than with
+# every client.
+#
+#   python benchmarks/bench_similarity.py --clients 1000000
+import argparse
+import itertools
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import FIRST_NAMES, LAST_NAMES
+from storage import ClientIndex
+
+SYLLABLES = ('ka', 'ma', 'wa', 'ji', 'ru', 'ko', 'ne', 'ti', 'mu', 'nyo', 'che', 'bo', 'li', 'sa', 'to', 'ga',
+             'ri', 'do', 'mba', 'nde', 'ki', 'po', 'fu', 'la', 'gi', 'ye', 'zu', 'ho')
+
+def word_pool(rng, size, common):
+    pool = list(common)
+    seen = set(pool)
+    while len(pool) < size:
+        word = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+        if word not in seen:
+            seen.add(word)
+            pool.append(word)
+    return pool, list(itertools.accumulate(1 / rank ** 0.8 for rank in range(1, size + 1)))
+
+def clients(rng, count, first_names=2000, surnames=30000):
+    firsts, first_weights = word_pool(rng, first_names, FIRST_NAMES)
+    lasts, last_weights = word_pool(rng, surnames, LAST_NAMES)
+    for client_id in range(1, count + 1):
+        first = rng.choices(firsts, cum_weights=first_weights)[0]
+        last, middle = rng.choices(lasts, cum_weights=last_weights, k=2)
+        yield (client_id, f"{first} {middle} {last}", f"07{rng.randrange(10 ** 8):08d}",
+               date(1940, 1, 1) + timedelta(days=rng.randrange(30000)))
+
+def typo(rng, name):
+    chars = list(name)
+    i = rng.randrange(1, len(chars))
+    action = rng.choice(('drop', 'swap', 'replace'))
+    if action == 'drop':
+        del chars[i]
+    elif action == 'swap' and i < len(chars) - 1:
+        chars[i], chars[i + 1] = chars[i + 1], chars[i]
+    else:
+        chars[i] = rng.choice('aeiouklmnrst')
+    return ''.join(chars)
+
+def timed(fn, queries):
+    runs = []
+    for query in queries:
+        start = time.perf_counter()
+        fn(query)
+        runs.append((time.perf_counter() - start) * 1000)
+    runs.sort()
+    return statistics.median(runs), runs[int(len(runs) * 0.99) - 1], statistics.mean(runs)
+
+def main():
+    parser = argparse.ArgumentParser(description='Trigram client index benchmark.')
+    parser.add_argument('--clients', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--first-names', type=int, default=2000)
+    parser.add_argument('--surnames', type=int, default=30000)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    rows = list(clients(rng, args.clients, args.first_names, args.surnames))
+    index = ClientIndex()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for i in range(0, len(rows), 10000):
+        index.add(rows[i:i + 10000])
+    build = time.perf_counter() - start
+    rss = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024
+    print(f"{args.clients} clients, {len(index._vocab)} vocabulary entries, indexed in {build:.1f} s, ~{rss:.0f} MB")
+
+    sample = [rng.choice(rows) for _ in range(args.queries)]
+    cases = {
+        'name, exact': (lambda q: index.search(q, 10), [r[1] for r in sample]),
+        'name, one typo': (lambda q: index.search(q, 10), [typo(rng, r[1]) for r in sample]),
+        'name, two words + typo': (lambda q: index.search(q, 10), [typo(rng, ' '.join(r[1].split()[1:])) for r in sample]),
+        'contact': (lambda q: index.search(q, 5, 1.0, 'contact'), [r[2] for r in sample]),
+        'duplicate check': (lambda r: index.possible_duplicates(typo(rng, r[1]), r[2], r[3]), sample),
+    }
+    print(f"{'query':<24} {'p50 ms':>8} {'p99 ms':>8} {'mean ms':>8}")
+    for label, (fn, queries) in cases.items():
+        p50, p99, mean = timed(fn, queries)
+        print(f"{label:<24} {p50:>8.3f} {p99:>8.3f} {mean:>8.3f}")
+
+    hits = sum(1 for r in sample if r[0] in {h[0] for h in index.search(typo(rng, r[1]), 10)})
+    print(f"recall@10 with one typo: {hits / len(sample):.1%}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# bench_startup.py
+# Cold start cost of the app: each run is a fresh interpreter that imports
+# app.py, builds the app (create_app(), or the module-level app on trees
+# from before the factory) against a new or an existing SQLite file, and
+# serves one request. Reports the median of each phase and which heavy
+# optional modules ended up imported.
+#
+#   python benchmarks/bench_startup.py --runs 10
+#   python benchmarks/bench_startup.py --repo /path/to/older/checkout   # compare
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('reportlab', 'flask_mail', 'bcrypt')
+
+CHILD = r'''
+import json, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app as module
+t1 = time.perf_counter()
+application = module.create_app() if hasattr(module, 'create_app') else module.app
+t2 = time.perf_counter()
+response = application.test_client().get('/login')
+t3 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'create': t2 - t1, 'first_request': t3 - t2, 'status': response.status_code,
+                  'loaded': [m for m in sys.argv[2].split(',') if m in sys.modules]}))
+'''
+
+def run_once(repo, database):
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{database}", OUTBOX_SENDER='false')
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', CHILD, repo, ','.join(HEAVY_MODULES)], cwd=repo, env=env,
+                            capture_output=True, text=True)
+    total = time.perf_counter() - start
+    if output.returncode:
+        sys.exit(output.stderr)
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    result['process'] = total
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='App cold start benchmark.')
+    parser.add_argument('--repo', default=ROOT, help='checkout to measure (default: this one)')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{args.repo}, median of {args.runs} runs (ms)")
+    print(f"{'database':<10} {'import':>8} {'create':>8} {'request':>8} {'process':>8}  heavy modules loaded")
+    with tempfile.TemporaryDirectory() as tmp:
+        existing = os.path.join(tmp, 'existing.db')
+        run_once(args.repo, existing)  # create the schema once
+        for label in ('new', 'existing'):
+            runs = []
+            for i in range(args.runs):
+                database = existing if label == 'existing' else os.path.join(tmp, f"new{i}.db")
+                runs.append(run_once(args.repo, database))
+            median = {phase: statistics.median(r[phase] for r in runs) * 1000 for phase in ('import', 'create', 'first_request', 'process')}
+            print(f"{label:<10} {median['import']:>8.0f} {median['create']:>8.0f} {median['first_request']:>8.0f} "
+                  f"{median['process']:>8.0f}  {', '.join(runs[-1]['loaded']) or '-'}")
+
+if __name__ == '__main__':
+    main()
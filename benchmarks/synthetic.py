@@ -0,0 +1,124 @@
+# synthetic.py
+# Seeds the app's database with a realistic-looking registry for benchmarks:
+# doctors, programs whose popularity follows a long tail, clients with a
+# plausible age/gender mix and a few enrollments each. Rows are written with
+# Core bulk inserts, then the derived tables (dashboard aggregates, data
+# versions) are refreshed the way the CLI commands do it.
+#
+#   python benchmarks/synthetic.py --clients 10000 --database-url sqlite:////tmp/registry.db
+import argparse
+import itertools
+import os
+import random
+import sys
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FIRST_NAMES = ('Amina', 'Brian', 'Cynthia', 'David', 'Esther', 'Felix', 'Grace', 'Hassan', 'Irene', 'James',
+               'Kevin', 'Lucy', 'Mercy', 'Njeri', 'Otieno', 'Purity', 'Quentin', 'Ruth', 'Samuel', 'Tabitha',
+               'Umar', 'Violet', 'Wanjiru', 'Yusuf', 'Zawadi')
+LAST_NAMES = ('Achieng', 'Barasa', 'Chebet', 'Daudi', 'Easton', 'Gitau', 'Hamisi', 'Kamau', 'Kiprop', 'Mutua',
+              'Njoroge', 'Ochieng', 'Odhiambo', 'Omondi', 'Otieno', 'Wafula', 'Wambui', 'Wanjala', 'Were')
+TOWNS = ('Nairobi', 'Mombasa', 'Kisumu', 'Nakuru', 'Eldoret', 'Thika', 'Machakos', 'Nyeri', 'Kakamega')
+PROGRAM_AREAS = ('HIV Care', 'TB Treatment', 'Malaria Prevention', 'Maternal Health', 'Diabetes', 'Hypertension',
+                 'Nutrition', 'Immunization', 'Mental Health', 'Family Planning')
+
+def sizes_for(clients):
+    """Doctor/program counts that scale with the number of clients."""
+    return {'clients': clients, 'doctors': max(2, clients // 500), 'programs': max(5, min(200, clients // 100))}
+
+def client_rows(rng, count, today=None):
+    today = today or date.today()
+    for _ in range(count):
+        # Mostly working-age adults, some children and elderly
+        age = min(99, max(0, int(rng.gauss(34, 18))))
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        yield {
+            'name': f"{first} {last}",
+            'dob': today - timedelta(days=age * 365 + rng.randrange(365)),
+            'gender': rng.choices(('Female', 'Male', 'Other'), weights=(52, 47, 1))[0],
+            'contact': f"07{rng.randrange(10 ** 8):08d}",
+            'address': f"{rng.randrange(1, 999)} {last} Road, {rng.choice(TOWNS)}",
+        }
+
+def enrollment_rows(rng, client_ids, program_ids):
+    # Zipf-like popularity: the first programs are much busier than the tail
+    weights = [1 / rank for rank in range(1, len(program_ids) + 1)]
+    for client_id in client_ids:
+        k = min(len(program_ids), rng.choices((0, 1, 2, 3, 4), weights=(15, 45, 25, 10, 5))[0])
+        chosen = set()
+        while len(chosen) < k:
+            chosen.add(rng.choices(program_ids, weights=weights)[0])
+        for program_id in chosen:
+            yield {'client_id': client_id, 'program_id': program_id}
+
+def batches(rows, size):
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, size)):
+        yield chunk
+
+def seed(session, clients, doctors=None, programs=None, password_hash='x', seed_value=42, batch_size=5000):
+    """Insert a synthetic registry through session (app schema already created).
+    The first doctor is 'bench'; password_hash is stored for every doctor."""
+    from sqlalchemy import insert, select
+    from aggregates import rebuild as rebuild_aggregates
+    from analytics import REGISTRY, rebuild as rebuild_analytics
+    from models import Client, Doctor, EnrollmentTrend, ProgramModel, enrollments
+    from pii import cipher
+    from search import reindex
+    from versions import TRACKED_TABLES, bump
+
+    counts = sizes_for(clients)
+    doctors = doctors or counts['doctors']
+    programs = programs or counts['programs']
+    rng = random.Random(seed_value)
+    connection = session.connection()
+
+    connection.execute(insert(Doctor), [
+        {'username': 'bench' if i == 0 else f"doctor{i}", 'password': password_hash, 'name': f"Dr. {rng.choice(LAST_NAMES)} {i}"}
+        for i in range(doctors)
+    ])
+    doctor_ids = session.scalars(select(Doctor.id)).all()
+    connection.execute(insert(ProgramModel), [
+        {'name': f"{PROGRAM_AREAS[i % len(PROGRAM_AREAS)]} {i // len(PROGRAM_AREAS) + 1}", 'created_by': rng.choice(doctor_ids)}
+        for i in range(programs)
+    ])
+    program_ids = session.scalars(select(ProgramModel.id).order_by(ProgramModel.id)).all()
+    for chunk in batches(client_rows(rng, clients), batch_size):
+        connection.execute(insert(Client), chunk)
+    client_ids = session.scalars(select(Client.id)).all()
+    for chunk in batches(enrollment_rows(rng, client_ids, program_ids), batch_size):
+        connection.execute(insert(enrollments), chunk)
+
+    # The search index follows through its triggers (or is rebuilt, over
+    # encrypted columns); aggregates are rebuilt wholesale
+    if cipher.enabled:
+        reindex(connection)
+    rebuild_aggregates(connection)
+    rebuild_analytics(connection)
+    # Two years of monthly trend history (the app only records it as it goes)
+    today = date.today()
+    months = [f"{(today.year * 12 + today.month - 1 - m) // 12}-{(today.month - 1 - m) % 12 + 1:02d}" for m in range(24)]
+    connection.execute(insert(EnrollmentTrend), [
+        {'program_id': program_id, 'month': month, 'enrolled': rng.randint(0, 50), 'unenrolled': rng.randint(0, 10)}
+        for program_id in [REGISTRY] + program_ids for month in months
+    ])
+    bump(connection, *TRACKED_TABLES)
+    session.commit()
+    return {'doctors': doctors, 'programs': programs, 'clients': clients}
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed a synthetic client registry.')
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--database-url', help='defaults to DATABASE_URL / the app default')
+    args = parser.parse_args()
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    from app import create_app
+    from models import db
+    with create_app().app_context():
+        print(seed(db.session, args.clients))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# broadcast.py
+# In-process broadcast hub for Server-Sent Events. Published events go into a
+# short ring buffer with increasing sequence numbers; each subscriber only
+# remembers the last sequence number it sent, so an idle connection costs one
+# waiter on a shared Condition and no per-connection queue. Under the gevent
+# stream server (gunicorn_stream.conf.py) that waiter is a greenlet, so a
+# worker holds thousands; under a threaded server it is a request thread,
+# so subscribers are capped per process (see acquire()).
+import collections
+import json
+import threading
+import time
+
+class Hub:
+    def __init__(self, history=256):
+        self._cond = threading.Condition()
+        self._events = collections.deque(maxlen=history)
+        self._seq = 0
+        self._versions = None
+        self._watcher = None
+        self._subscribers = 0
+
+    @property
+    def seq(self):
+        return self._seq
+
+    @property
+    def subscribers(self):
+        return self._subscribers
+
+    # Take one of `limit` subscriber slots; False when they are all in use
+    def acquire(self, limit):
+        with self._cond:
+            if self._subscribers >= limit:
+                return False
+            self._subscribers += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self._subscribers -= 1
+
+    def publish(self, event, data, versions=None):
+        with self._cond:
+            self._seq += 1
+            self._events.append((self._seq, event, data))
+            if versions:
+                self._versions = dict(versions)
+            self._cond.notify_all()
+        return self._seq
+
+    # Events after `last_seq`, waiting up to `timeout` seconds for one. Returns
+    # None if `last_seq` has already fallen out of the history.
+    def events_since(self, last_seq, timeout=None):
+        with self._cond:
+            if last_seq >= self._seq:
+                self._cond.wait_for(lambda: self._seq > last_seq, timeout)
+            if self._events and self._events[0][0] > last_seq + 1:
+                return None
+            return [e for e in self._events if e[0] > last_seq]
+
+    # SSE stream for one subscriber, resuming after `last_seq` when given
+    def stream(self, last_seq=None, keepalive=15):
+        if last_seq is None or last_seq > self._seq:
+            last_seq = self._seq  # new subscriber, or an id from another process
+        yield "retry: 5000\n\n"
+        while True:
+            events = self.events_since(last_seq, keepalive)
+            if events is None:
+                last_seq = self._seq
+                yield f"id: {last_seq}\nevent: reset\ndata: {{}}\n\n"
+            elif not events:
+                yield ": keepalive\n\n"
+            for seq, event, data in events or ():
+                last_seq = seq
+                yield f"id: {seq}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+    # Writes committed by other worker processes never reach this hub's
+    # publish(); one background thread per process polls the data versions
+    # and publishes a 'change' event when they move.
+    def watch(self, read_versions, interval=2.0):
+        with self._cond:
+            if self._watcher is not None:
+                return
+            self._watcher = threading.Thread(target=self._watch, args=(read_versions, interval), daemon=True)
+        self._watcher.start()
+
+    def _watch(self, read_versions, interval):
+        # The first read is the baseline, taken at once so writes made right
+        # after the first subscriber connects aren't missed
+        while True:
+            try:
+                versions = read_versions()
+            except Exception:
+                versions = None
+            if versions is not None:
+                with self._cond:
+                    previous = self._versions
+                    self._versions = versions
+                if previous is not None and versions != previous:
+                    tables = sorted(t for t in versions if versions[t] != previous.get(t))
+                    self.publish('change', {"tables": tables}, versions)
+            time.sleep(interval)
+
+hub = Hub()
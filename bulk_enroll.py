@@ -0,0 +1,52 @@
+# bulk_enroll.py
+# Set-based enrollment changes for many clients at once. Additions are one
+# INSERT ... SELECT over client x program_model that skips existing pairs, and
+# removals one DELETE; both use RETURNING so the exact pairs changed are
+# reported to changes.record() for the aggregates and live updates.
+import json
+from sqlalchemy import and_, delete, exists, func, insert, select, true
+from changes import ChangeSet, record
+from models import db, Client, ProgramModel, enrollments
+
+# Id list as SQL: a single json_each() parameter on SQLite (no bound-variable
+# limit, one statement), a plain IN list elsewhere
+def _id_values(ids, dialect_name):
+    if dialect_name == 'sqlite':
+        return select(func.json_each(json.dumps(ids)).table_valued('value').c.value)
+    return list(ids)
+
+# Enroll `client_ids` in `add_program_ids` and drop them from
+# `remove_program_ids` in one transaction; returns (added, removed) counts
+def apply_enrollment_delta(client_ids, add_program_ids=(), remove_program_ids=()):
+    session = db.session
+    dialect_name = session.get_bind().dialect.name
+    clients = _id_values(sorted(set(client_ids)), dialect_name)
+    changes = ChangeSet()
+
+    if add_program_ids:
+        programs = _id_values(sorted(set(add_program_ids)), dialect_name)
+        already_enrolled = exists().where(and_(
+            enrollments.c.client_id == Client.id,
+            enrollments.c.program_id == ProgramModel.id,
+        ))
+        pairs = (select(Client.id, ProgramModel.id)
+                 .join(ProgramModel, true())  # every client x every program, filtered below
+                 .where(Client.id.in_(clients), ProgramModel.id.in_(programs), ~already_enrolled))
+        rows = session.execute(
+            insert(enrollments).from_select(['client_id', 'program_id'], pairs)
+            .returning(enrollments.c.client_id, enrollments.c.program_id)
+        )
+        changes.enrolled.update(map(tuple, rows))
+
+    if remove_program_ids:
+        programs = _id_values(sorted(set(remove_program_ids)), dialect_name)
+        rows = session.execute(
+            delete(enrollments)
+            .where(enrollments.c.client_id.in_(clients), enrollments.c.program_id.in_(programs))
+            .returning(enrollments.c.client_id, enrollments.c.program_id)
+        )
+        changes.unenrolled.update(map(tuple, rows))
+
+    record(session, changes)
+    session.commit()
+    return len(changes.enrolled), len(changes.unenrolled)
@@ -0,0 +1,213 @@
+# cache.py
+# Read-through object cache for rarely-changing reads (client profiles,
+# program listings). Two backends:
+#   - MemoryBackend: in-process LRU with per-entry TTL (single process);
+#   - DiskBackend: one SQLite file shared by every gunicorn worker.
+# Entries are dropped precisely from committed changes (see invalidate());
+# the TTL is only a safety net. Only the disk backend's deletes and
+# generations reach other processes, so multi-worker servers use it (the
+# gunicorn profile defaults to it). Disk entries are encrypted while PII
+# encryption is on, since they hold client profiles.
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pii import cipher
+
+class MemoryBackend:
+    name = 'memory'
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    # Counters live outside the LRU so they are never evicted
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def size(self):
+        return len(self._data)
+
+class DiskBackend:
+    name = 'disk'
+
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS ix_cache_expires ON cache (expires)")
+            db.execute("CREATE TABLE IF NOT EXISTS counter (key TEXT PRIMARY KEY, value INTEGER)")
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            self._local.db = db
+        return db
+
+    def get(self, key):
+        row = self._connect().execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(cipher.decrypt(row[0], remember=False) if cipher.enabled else row[0])
+
+    def set(self, key, value, ttl):
+        value = json.dumps(value)
+        if cipher.enabled:
+            value = cipher.encrypt(value, remember=False)
+        db = self._connect()
+        db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)", (key, value, time.time() + ttl))
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self.prune()
+
+    # Drop expired entries, then the ones closest to expiry above the size cap
+    def prune(self):
+        db = self._connect()
+        db.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+        db.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+                   (self.max_entries,))
+
+    def delete_many(self, keys):
+        self._connect().executemany("DELETE FROM cache WHERE key = ?", ((k,) for k in keys))
+
+    def incr(self, key):
+        return self._connect().execute(
+            "INSERT INTO counter VALUES (?, 1) ON CONFLICT (key) DO UPDATE SET value = value + 1 RETURNING value",
+            (key,)
+        ).fetchone()[0]
+
+    def counter(self, key):
+        row = self._connect().execute("SELECT value FROM counter WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def size(self):
+        return self._connect().execute("SELECT count(*) FROM cache").fetchone()[0]
+
+class Cache:
+    def __init__(self, backend=None, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'sets': 0, 'invalidations': 0}
+
+    def _count(self, stat, n=1):
+        with self._lock:
+            self._stats[stat] += n
+
+    # Cached value for `key`, computing and storing it on a miss
+    def get_or_set(self, key, compute, ttl=None):
+        if self.backend is None:
+            return compute()
+        value = self.backend.get(key)
+        if value is not None:
+            self._count('hits')
+            return value
+        self._count('misses')
+        value = compute()
+        if value is not None:
+            self.backend.set(key, value, ttl or self.ttl)
+            self._count('sets')
+        return value
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        if self.backend is not None and keys:
+            self.backend.delete_many(keys)
+            self._count('invalidations', len(keys))
+
+    # Namespaces whose keys can't be enumerated are invalidated by bumping a
+    # generation number that is part of every key in them
+    def generation(self, namespace):
+        if self.backend is None:
+            return 0
+        return self.backend.counter(f'gen:{namespace}')
+
+    def bump(self, *namespaces):
+        if self.backend is not None:
+            for namespace in namespaces:
+                self.backend.incr(f'gen:{namespace}')
+                self._count('invalidations')
+
+    # Invalidate every cached read (data changed behind the ORM's back)
+    def clear(self):
+        self.bump('clients', 'programs')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else None
+        stats['backend'] = self.backend.name if self.backend else 'none'
+        stats['entries'] = self.backend.size() if self.backend else 0
+        return stats
+
+def make_backend(kind, path=None, max_entries=10000):
+    if kind == 'memory':
+        return MemoryBackend(max_entries)
+    if kind == 'disk':
+        return DiskBackend(path, max_entries)
+    if kind in ('none', None, ''):
+        return None
+    raise ValueError(f"Unknown cache backend '{kind}'")
+
+cache = Cache()
+
+# Cache keys for the cached reads
+def client_key(client_id):
+    return f"client:{cache.generation('clients')}:{client_id}"
+
+def programs_key(*parts):
+    return ':'.join(['programs', str(cache.generation('programs'))] + [str(p) for p in parts])
+
+# Drop the entries a committed change made stale
+def invalidate(changes):
+    clients = changes.clients
+    client_ids = clients['updated'] | clients['deleted']
+    client_ids |= {c for c, _ in changes.enrolled | changes.unenrolled}
+    cache.delete_many(client_key(i) for i in client_ids)
+
+    programs = changes.programs
+    if programs['updated'] or programs['deleted']:
+        cache.bump('clients')  # program names appear in every enrolled client's profile
+    if any(programs.values()) or changes.enrolled or changes.unenrolled or clients['updated'] or clients['deleted']:
+        cache.bump('programs')  # listings show creators, counts and enrolled client names
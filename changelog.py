@@ -0,0 +1,177 @@
+# changelog.py
+# Durable change log behind /api/changes. Every change set reported by the
+# change feed (changes.py) is appended to change_log inside the writing
+# transaction, so ORM writes (edit, delete, enroll routes) and Core writers
+# (import, bulk enrollment) are logged the same way, and a rolled back
+# write leaves no entry. Consumers remember the last seq they applied and
+# ask for what came after it: the cost follows the churn, not the registry.
+# (Seqs are handed out in commit order because SQLite serializes writers; a
+# server database with concurrent writers can commit a lower seq late.)
+#
+# Compaction keeps the log bounded. Only the latest entry per client,
+# program or enrollment is needed (the feed serves current rows), so older
+# ones are dropped, except deletes: the feed skips entries for rows that are
+# gone on the promise that a delete follows, and a row deleted and then
+# re-inserted under the same id must still reach consumers as a delete.
+# Past CHANGE_LOG_MAX_ROWS the oldest entries go too, delete tombstones
+# included, and consumers behind that point get 410 and resync from the full
+# dumps.
+import threading
+from sqlalchemy import delete, func, insert, select, update
+from changes import on_commit, on_flush
+from models import db, ChangeLog, ChangeLogState, Doctor, ProgramModel
+import reads
+from utils import utcnow
+
+FEED_BATCH = 500
+
+class ChangesGone(Exception):
+    """The requested position was compacted away."""
+
+class Compactor:
+    """Runs compact() in the background once this process has logged
+    `every` entries since the last run (0 disables it)."""
+
+    def __init__(self):
+        self.max_rows = 100000
+        self.every = 0
+        self._logged = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def logged(self, count):
+        if not self.every:
+            return
+        with self._lock:
+            self._logged += count
+            if self._logged < self.every or (self._thread is not None and self._thread.is_alive()):
+                return
+            self._logged = 0
+            self._thread = threading.Thread(target=self._run, args=(db.engine,), name='change-log-compactor',
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self, engine):
+        with engine.begin() as connection:
+            compact(connection, self.max_rows)
+
+compactor = Compactor()
+
+def init_changelog(app):
+    compactor.max_rows = app.config['CHANGE_LOG_MAX_ROWS']
+    compactor.every = app.config['CHANGE_LOG_COMPACT_EVERY']
+
+def _entries(changes, now):
+    rows = []
+    def add(entity, entity_id, action, related_id=0):
+        rows.append({'entity': entity, 'entity_id': entity_id, 'related_id': related_id,
+                     'action': action, 'changed_at': now})
+    # Rows first, then links between them, deletions last
+    for key, action in (('inserted', 'insert'), ('updated', 'update')):
+        for client_id in sorted(changes.clients[key] - changes.clients['deleted']):
+            add('client', client_id, action)
+        for program_id in sorted(changes.programs[key] - changes.programs['deleted']):
+            add('program', program_id, action)
+    for client_id, program_id in sorted(changes.enrolled - changes.unenrolled):
+        add('enrollment', client_id, 'enroll', program_id)
+    for client_id, program_id in sorted(changes.unenrolled):
+        add('enrollment', client_id, 'unenroll', program_id)
+    for client_id in sorted(changes.clients['deleted']):
+        add('client', client_id, 'delete')
+    for program_id in sorted(changes.programs['deleted']):
+        add('program', program_id, 'delete')
+    return rows
+
+@on_flush
+def _log_changes(connection, changes):
+    rows = _entries(changes, utcnow())
+    if rows:
+        connection.execute(insert(ChangeLog), rows)
+
+@on_commit
+def _count_logged(changes):
+    compactor.logged(len(_entries(changes, None)))
+
+# --- READS ---
+
+def head(connection):
+    return connection.scalar(select(func.max(ChangeLog.seq))) or 0
+
+def truncated_seq(connection):
+    return connection.scalar(select(ChangeLogState.truncated_seq).where(ChangeLogState.id == 1)) or 0
+
+def page_end(connection, since, limit):
+    """(last seq of the page after `since`, log head). Raises ChangesGone
+    when entries after `since` have been dropped."""
+    if since < truncated_seq(connection):
+        raise ChangesGone()
+    last = head(connection)
+    end = connection.scalar(select(ChangeLog.seq).where(ChangeLog.seq > since)
+                            .order_by(ChangeLog.seq).offset(limit - 1).limit(1))
+    return (end if end is not None else last), last
+
+def _clients(session, ids):
+    if not ids:
+        return {}
+    return {c['id']: c for c in reads.clients_by_id(ids, session)}
+
+def _programs(session, ids):
+    if not ids:
+        return {}
+    rows = session.execute(
+        select(ProgramModel.id, ProgramModel.name, Doctor.name)
+        .outerjoin(Doctor, Doctor.id == ProgramModel.created_by).where(ProgramModel.id.in_(ids))
+    ).all()
+    return {program_id: {"id": program_id, "name": name, "created_by": creator} for program_id, name, creator in rows}
+
+def feed(session, since, end):
+    """Feed entries with since < seq <= end, oldest first. Inserts and updates
+    carry the row as it is now (client rows as in /api/clients); entries for
+    rows deleted since are skipped, their delete entry follows."""
+    cursor = since
+    while cursor < end:
+        rows = session.execute(
+            select(ChangeLog.seq, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.related_id, ChangeLog.action,
+                   ChangeLog.changed_at)
+            .where(ChangeLog.seq > cursor, ChangeLog.seq <= end).order_by(ChangeLog.seq).limit(FEED_BATCH)
+        ).all()
+        if not rows:
+            return
+        cursor = rows[-1][0]
+        live = {(row[1], row[2]) for row in rows if row[4] in ('insert', 'update')}
+        clients = _clients(session, [i for entity, i in live if entity == 'client'])
+        programs = _programs(session, [i for entity, i in live if entity == 'program'])
+        for seq, entity, entity_id, related_id, action, changed_at in rows:
+            entry = {"seq": seq, "entity": entity, "action": action, "changed_at": changed_at.isoformat() + 'Z'}
+            if entity == 'enrollment':
+                entry.update(client_id=entity_id, program_id=related_id)
+            else:
+                entry["id"] = entity_id
+                if action != 'delete':
+                    data = (clients if entity == 'client' else programs).get(entity_id)
+                    if data is None:
+                        continue
+                    entry["data"] = data
+            yield entry
+
+# --- COMPACTION ---
+
+def compact(connection, max_rows):
+    """Drop superseded entries (deletes are kept), then the oldest beyond
+    max_rows, moving truncated_seq past them. Returns (superseded, truncated)
+    counts."""
+    latest = (select(func.max(ChangeLog.seq))
+              .group_by(ChangeLog.entity, ChangeLog.entity_id, ChangeLog.related_id))
+    superseded = connection.execute(
+        delete(ChangeLog).where(ChangeLog.seq.not_in(latest), ChangeLog.action != 'delete')
+    ).rowcount
+    truncated = 0
+    excess = connection.scalar(select(func.count()).select_from(ChangeLog)) - max_rows
+    if excess > 0:
+        cut = connection.scalar(select(ChangeLog.seq).order_by(ChangeLog.seq).offset(excess - 1).limit(1))
+        truncated = connection.execute(delete(ChangeLog).where(ChangeLog.seq <= cut)).rowcount
+        # Everything left is newer than any earlier cut
+        if connection.execute(update(ChangeLogState).where(ChangeLogState.id == 1)
+                              .values(truncated_seq=cut)).rowcount == 0:
+            connection.execute(insert(ChangeLogState).values(id=1, truncated_seq=cut))
+    return superseded, truncated
@@ -0,0 +1,161 @@
+# changes.py
+# Collects what each ORM flush wrote to clients, programs and enrollments, and
+# hands it to listeners at two points:
+#   - on_flush listeners run inside the flush's transaction (versions,
+#     aggregates, ...), so whatever they write commits or rolls back together
+#     with the change itself;
+#   - on_commit listeners run once the transaction has committed (push
+#     notifications, cache invalidation, ...), with every change it contained.
+# Code that writes with Core statements instead of the ORM reports its
+# changes through record().
+import itertools
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+from models import Client, ProgramModel, enrollments
+
+_flush_listeners = []
+_commit_listeners = []
+
+class ChangeSet:
+    def __init__(self):
+        self.clients = {'inserted': set(), 'updated': set(), 'deleted': set()}
+        self.programs = {'inserted': set(), 'updated': set(), 'deleted': set()}
+        self.enrolled = set()    # (client_id, program_id) pairs added
+        self.unenrolled = set()  # (client_id, program_id) pairs removed
+        self.client_before = {}  # client_id -> (gender, dob) before an update or delete
+        self.versions = None     # data versions after the change (versions.py)
+
+    def __bool__(self):
+        return bool(self.enrolled or self.unenrolled
+                    or any(self.clients.values()) or any(self.programs.values()))
+
+    @property
+    def tables(self):
+        tables = set()
+        if any(self.clients.values()):
+            tables.add('client')
+        if any(self.programs.values()):
+            tables.add('program_model')
+        if self.enrolled or self.unenrolled:
+            tables.add('enrollments')
+        return tables
+
+    def update(self, other):
+        for action in self.clients:
+            self.clients[action] |= other.clients[action]
+            self.programs[action] |= other.programs[action]
+        self.enrolled |= other.enrolled
+        self.unenrolled |= other.unenrolled
+        for client_id, before in other.client_before.items():
+            self.client_before.setdefault(client_id, before)
+        self.versions = other.versions or self.versions
+
+    # JSON-friendly form; large batches are reduced to counts
+    def summary(self, max_items=100):
+        def items(values):
+            return sorted(values) if len(values) <= max_items else len(values)
+
+        data = {
+            "tables": sorted(self.tables),
+            "clients": {k: items(v) for k, v in self.clients.items() if v},
+            "programs": {k: items(v) for k, v in self.programs.items() if v},
+        }
+        for key, pairs in (('enrolled', self.enrolled), ('unenrolled', self.unenrolled)):
+            if pairs:
+                data[key] = items(pairs)
+        return data
+
+def on_flush(fn):
+    _flush_listeners.append(fn)
+    return fn
+
+def on_commit(fn):
+    _commit_listeners.append(fn)
+    return fn
+
+# Report a change made outside the ORM, inside the session's transaction
+def record(session, changes):
+    if not changes:
+        return
+    connection = session.connection()
+    for listener in _flush_listeners:
+        listener(connection, changes)
+    session.info.setdefault('changes', ChangeSet()).update(changes)
+
+def _history_pairs(obj, key):
+    history = inspect(obj).attrs[key].history
+    return history.added or (), history.deleted or ()
+
+@event.listens_for(Session, 'before_flush')
+def _before_flush(session, flush_context, instances):
+    # Enrollment rows of deleted clients/programs are removed by the flush
+    # itself, so read them while they still exist
+    client_ids = [o.id for o in session.deleted if isinstance(o, Client)]
+    program_ids = [o.id for o in session.deleted if isinstance(o, ProgramModel)]
+    pairs = set()
+    if client_ids or program_ids:
+        query = select(enrollments.c.client_id, enrollments.c.program_id).where(
+            enrollments.c.client_id.in_(client_ids) | enrollments.c.program_id.in_(program_ids)
+        )
+        pairs = set(map(tuple, session.connection().execute(query)))
+    session.info['deleted_pairs'] = pairs
+
+    # Demographics of clients about to be updated or deleted, as stored
+    # (analytics.py moves their counts from the old values to the new ones)
+    before_ids = [o.id for o in itertools.chain(session.dirty, session.deleted)
+                  if isinstance(o, Client) and o.id is not None]
+    before = {}
+    if before_ids:
+        before = {row[0]: (row[1], row[2]) for row in session.connection().execute(
+            select(Client.id, Client.gender, Client.dob).where(Client.id.in_(before_ids)))}
+    session.info['client_before'] = before
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, flush_context):
+    changes = ChangeSet()
+    changes.unenrolled |= session.info.pop('deleted_pairs', set())
+    changes.client_before = session.info.pop('client_before', {})
+
+    for obj in session.new:
+        if isinstance(obj, Client):
+            changes.clients['inserted'].add(obj.id)
+        elif isinstance(obj, ProgramModel):
+            changes.programs['inserted'].add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Client):
+            changes.clients['deleted'].add(obj.id)
+        elif isinstance(obj, ProgramModel):
+            changes.programs['deleted'].add(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, (Client, ProgramModel)) and session.is_modified(obj, include_collections=False):
+            target = changes.clients if isinstance(obj, Client) else changes.programs
+            target['updated'].add(obj.id)
+
+    # Collection history is recorded on both sides of the relationship; the
+    # pair sets remove the duplicates
+    for obj in itertools.chain(session.new, session.dirty):
+        if obj in session.deleted:
+            continue
+        if isinstance(obj, Client):
+            added, removed = _history_pairs(obj, 'programs')
+            changes.enrolled |= {(obj.id, p.id) for p in added}
+            changes.unenrolled |= {(obj.id, p.id) for p in removed}
+        elif isinstance(obj, ProgramModel):
+            added, removed = _history_pairs(obj, 'clients')
+            changes.enrolled |= {(c.id, obj.id) for c in added}
+            changes.unenrolled |= {(c.id, obj.id) for c in removed}
+
+    record(session, changes)
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    changes = session.info.pop('changes', None)
+    if changes:
+        for listener in _commit_listeners:
+            listener(changes)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _after_rollback(session, previous_transaction):
+    session.info.pop('changes', None)
+    session.info.pop('deleted_pairs', None)
+    session.info.pop('client_before', None)
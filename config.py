@@ -0,0 +1,143 @@
+# config.py
+# Application configuration, read from the environment with the defaults the
+# app has always used. The database section picks engine options for the
+# backend in DATABASE_URL: SQLite connections get WAL, a busy timeout and
+# cache/mmap pragmas; server databases get pool sizing and pre-ping.
+import os
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+def env_bool(name, default):
+    return os.environ.get(name, str(default)).strip().lower() in ('1', 'true', 'yes', 'on')
+
+def database_url():
+    url = os.environ.get('DATABASE_URL', 'sqlite:///healthsystem.db')
+    # Heroku/Render style URLs use the scheme SQLAlchemy dropped in 1.4
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+# create_engine() keyword arguments for `url`
+def engine_options(url):
+    if make_url(url).get_backend_name() == 'sqlite':
+        # Python's sqlite3 timeout is the busy timeout, in seconds
+        return {"connect_args": {"timeout": env_int('SQLITE_BUSY_TIMEOUT_MS', 5000) / 1000}}
+    return {
+        "pool_size": env_int('DB_POOL_SIZE', 5),
+        "max_overflow": env_int('DB_MAX_OVERFLOW', 10),
+        "pool_timeout": env_int('DB_POOL_TIMEOUT', 30),
+        "pool_recycle": env_int('DB_POOL_RECYCLE', 1800),
+        "pool_pre_ping": env_bool('DB_POOL_PRE_PING', True),
+    }
+
+# PRAGMAs applied to every new SQLite connection
+def sqlite_pragmas():
+    return {
+        "journal_mode": os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        "synchronous": os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        "busy_timeout": env_int('SQLITE_BUSY_TIMEOUT_MS', 5000),
+        "cache_size": -env_int('SQLITE_CACHE_SIZE_KB', 65536),  # negative = KiB
+        "mmap_size": env_int('SQLITE_MMAP_SIZE_MB', 256) * 1024 * 1024,
+        "temp_store": "MEMORY",
+    }
+
+def install_sqlite_pragmas(engine, pragmas=None):
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = pragmas or sqlite_pragmas()
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+class Config:
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'super_secret_key')
+
+    # Security Configurations
+    SESSION_COOKIE_SECURE = True      # Cookie sent only via HTTPS
+    SESSION_COOKIE_HTTPONLY = True    # Cookie can't be accessed via JavaScript
+    SESSION_COOKIE_SAMESITE = 'Lax'   # Protect against CSRF
+    REMEMBER_COOKIE_SECURE = True     # If using 'Remember Me' login (future-proof)
+    PERMANENT_SESSION_LIFETIME = 3600 # Sessions expire after 1 hour (in seconds)
+
+    # Database Configuration
+    SQLALCHEMY_DATABASE_URI = database_url()
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Configure Flask-Mail
+    MAIL_SERVER = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')   # Or your SMTP server
+    MAIL_PORT = env_int('MAIL_PORT', 587)
+    MAIL_USE_TLS = env_bool('MAIL_USE_TLS', True)
+    MAIL_USERNAME = os.environ.get('MAIL_USERNAME', 'your_email@gmail.com')  # Your email address
+    MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD', 'your_email_password')   # Your app-specific password
+
+    # Background PDF report jobs (see jobs.py)
+    REPORT_WORKERS = env_int('REPORT_WORKERS', 2)                # Size of the local render process pool
+    REPORT_WAIT_SECONDS = env_int('REPORT_WAIT_SECONDS', 5)      # How long the download routes wait before answering 202
+    REPORT_JOB_TIMEOUT = env_int('REPORT_JOB_TIMEOUT', 600)      # A job pending for longer than this is resubmitted
+    REPORT_CACHE_MAX_AGE = env_int('REPORT_CACHE_MAX_AGE', 86400)  # Cached PDFs unused for this long are pruned
+    REPORT_CACHE_DIR = os.environ.get('REPORT_CACHE_DIR')        # Where PDFs are kept, default instance/reports
+
+    # Read-through object cache (see cache.py): 'memory' for a single process,
+    # 'disk' to share one cache file between gunicorn workers, 'none' to disable
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+    CACHE_TTL = env_int('CACHE_TTL', 300)
+    CACHE_MAX_ENTRIES = env_int('CACHE_MAX_ENTRIES', 10000)
+
+    # Change log for /api/changes (see changelog.py)
+    CHANGE_LOG_MAX_ROWS = env_int('CHANGE_LOG_MAX_ROWS', 1000000)        # Oldest entries beyond this are dropped
+    CHANGE_LOG_COMPACT_EVERY = env_int('CHANGE_LOG_COMPACT_EVERY', 10000)  # Compact after this many entries, 0 = only by CLI
+    CHANGES_PAGE_SIZE = env_int('CHANGES_PAGE_SIZE', 10000)               # Feed entries per response (?limit= is capped here)
+
+    # Archive tier for inactive clients and deleted programs (see archive.py)
+    ARCHIVE_PATH = os.environ.get('ARCHIVE_PATH', '')               # Archive SQLite file, default instance/archive.db
+    ARCHIVE_IDLE_DAYS = env_int('ARCHIVE_IDLE_DAYS', 365)           # Unenrolled clients untouched this long are archived
+    ARCHIVE_BATCH_SIZE = env_int('ARCHIVE_BATCH_SIZE', 1000)        # Clients moved per transaction
+
+    # JSON responses: 'auto' uses orjson when installed, 'orjson' requires it, 'stdlib' never does
+    JSON_ENCODER = os.environ.get('JSON_ENCODER', 'auto')
+
+    # Server-rendered client list: rows per page (?limit= is capped at the max)
+    CLIENTS_PAGE_SIZE = env_int('CLIENTS_PAGE_SIZE', 50)
+    CLIENTS_PAGE_MAX = env_int('CLIENTS_PAGE_MAX', 200)
+
+    # Password hashing (see passwords.py); changing the cost rehashes on next login
+    BCRYPT_LOG_ROUNDS = env_int('BCRYPT_LOG_ROUNDS', 12)
+    BCRYPT_WORKERS = env_int('BCRYPT_WORKERS', 0)                    # Hashing threads, 0 = one per CPU
+    BCRYPT_MAX_PENDING = env_int('BCRYPT_MAX_PENDING', 16)           # Queued hashes before answering 503
+    BCRYPT_ADMISSION_WAIT_MS = env_int('BCRYPT_ADMISSION_WAIT_MS', 500)  # How long to wait for a queue slot
+
+    # Client PII encryption at rest (see pii.py): comma separated Fernet keys, newest
+    # first (empty = plaintext), and the HMAC key of the search blind indexes
+    PII_ENCRYPTION_KEYS = os.environ.get('PII_ENCRYPTION_KEYS', '')
+    PII_INDEX_KEY = os.environ.get('PII_INDEX_KEY', '')
+    PII_DECRYPT_CACHE_SIZE = env_int('PII_DECRYPT_CACHE_SIZE', 50000)  # Decrypted values kept per process
+
+    # In-memory trigram index for similarity search and duplicate checks (see storage.py)
+    CLIENT_INDEX = env_bool('CLIENT_INDEX', True)
+    CLIENT_INDEX_SYNC_SECONDS = env_int('CLIENT_INDEX_SYNC_SECONDS', 5)  # How often to pull other workers' registrations
+
+    # Email outbox (see outbox.py)
+    OUTBOX_BATCH_SIZE = env_int('OUTBOX_BATCH_SIZE', 50)             # Messages sent per SMTP connection
+    OUTBOX_MAX_ATTEMPTS = env_int('OUTBOX_MAX_ATTEMPTS', 6)          # Give up and mark failed after this many
+    OUTBOX_BACKOFF_SECONDS = env_int('OUTBOX_BACKOFF_SECONDS', 30)   # First retry delay, doubled on each attempt
+    OUTBOX_BACKOFF_MAX_SECONDS = env_int('OUTBOX_BACKOFF_MAX_SECONDS', 3600)
+    OUTBOX_POLL_SECONDS = env_int('OUTBOX_POLL_SECONDS', 10)         # How often the sender looks for due retries
+    OUTBOX_SENDER = env_bool('OUTBOX_SENDER', True)                  # Run the sender thread inside web workers
+
+    # Request instrumentation (see metrics.py)
+    SLOW_REQUEST_MS = env_int('SLOW_REQUEST_MS', 500)    # Log requests slower than this with their worst statements
+    QUERY_COUNT_WARN = env_int('QUERY_COUNT_WARN', 50)   # Warn when one request runs more queries than this
+
+    # Live updates (Server-Sent Events)
+    STREAM_KEEPALIVE_SECONDS = env_int('STREAM_KEEPALIVE_SECONDS', 15)  # Comment line sent to idle subscribers
+    STREAM_POLL_SECONDS = env_int('STREAM_POLL_SECONDS', 2)             # How often to look for writes made by other workers
+    STREAM_MAX_SUBSCRIBERS = env_int('STREAM_MAX_SUBSCRIBERS', 4)       # Open streams per threaded process (the stream server sets its own)
+    STREAM_RETRY_SECONDS = env_int('STREAM_RETRY_SECONDS', 60)          # Retry-After sent to subscribers turned away
@@ -1,17 +1,18 @@
 # crypto_helper.py
+# Keys for client PII encryption (see pii.py). Print a fresh pair for .env:
+#   python crypto_helper.py
+# To rotate: put a new key in front of PII_ENCRYPTION_KEYS, run
+# `flask --app app pii-rotate`, then remove the old key.
+import secrets
 from cryptography.fernet import Fernet
+from pii import cipher
 
-# Generate key ONCE and save it securely
-# KEY = b'YOUR_GENERATED_KEY_HERE'
-key = Fernet.generate_key()
+def encrypt_data(data):
+    return cipher.encrypt(data)
 
-# cipher = Fernet(KEY)
+def decrypt_data(data):
+    return cipher.decrypt(data)
 
-print(key.decode()) 
-
-
-# def encrypt_data(data):
-#     return cipher.encrypt(data.encode()).decode()
-
-# def decrypt_data(data):
-#     return cipher.decrypt(data.encode()).decode()
+if __name__ == '__main__':
+    print(f"PII_ENCRYPTION_KEYS={Fernet.generate_key().decode()}")
+    print(f"PII_INDEX_KEY={secrets.token_urlsafe(32)}")
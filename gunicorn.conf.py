@@ -0,0 +1,48 @@
+# gunicorn.conf.py
+# Production server profile: gunicorn -c gunicorn.conf.py wsgi:app
+#
+# The app is preloaded in the master, so migrations and table creation run
+# once and workers fork with the code already imported. gthread workers serve
+# each request on one of `threads` threads, so a slow client or a report wait
+# pins a thread rather than the whole process. /api/stream belongs on the
+# gevent stream server (gunicorn_stream.conf.py); if a stream does reach
+# these workers it pins a thread for as long as the tab stays open, so they
+# take at most STREAM_MAX_SUBSCRIBERS each and the thread pool is sized with
+# that many spare threads on top of the ones left for ordinary requests.
+# Every setting can be overridden from the environment.
+import multiprocessing
+import os
+
+# Workers share cached reads (and their invalidations) through the disk
+# backend; the memory backend only ever sees its own process's commits
+os.environ.setdefault('CACHE_BACKEND', 'disk')
+
+from config import Config, env_bool, env_int
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = env_int('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 8))
+worker_class = 'gthread'
+threads = env_int('GUNICORN_THREADS', Config.STREAM_MAX_SUBSCRIBERS + 8)
+if Config.STREAM_MAX_SUBSCRIBERS >= threads:
+    raise RuntimeError('STREAM_MAX_SUBSCRIBERS must be well below GUNICORN_THREADS, '
+                       'or open event streams take every request thread.')
+preload_app = env_bool('GUNICORN_PRELOAD', True)
+timeout = env_int('GUNICORN_TIMEOUT', 60)          # Kill a worker that stops heartbeating for this long
+graceful_timeout = env_int('GUNICORN_GRACEFUL_TIMEOUT', 30)
+keepalive = env_int('GUNICORN_KEEPALIVE', 5)
+max_requests = env_int('GUNICORN_MAX_REQUESTS', 1000)  # Recycle workers to cap slow memory growth
+max_requests_jitter = env_int('GUNICORN_MAX_REQUESTS_JITTER', 100)
+accesslog = '-'
+errorlog = '-'
+
+def post_fork(server, worker):
+    # Connections the master opened while preloading must not be shared with
+    # the children; drop them from each worker's pool without closing them
+    from app import start_outbox_sender
+    from models import db
+    app = server.app.wsgi()
+    with app.app_context():
+        db.engine.dispose(close=False)
+    # Threads don't survive the fork: start the outbox sender here (unless
+    # OUTBOX_SENDER is off), so queued mail and retries go out after a restart
+    start_outbox_sender(app)
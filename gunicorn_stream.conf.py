@@ -0,0 +1,35 @@
+# gunicorn_stream.conf.py
+# Event stream server: gunicorn -c gunicorn_stream.conf.py wsgi:app
+#
+# Serves /api/stream from gevent workers next to the threaded web server
+# (gunicorn.conf.py); the reverse proxy sends /api/stream here and
+# everything else there. Each subscriber is a greenlet parked on the hub's
+# Condition, so one worker holds thousands of idle streams, and the hub's
+# watcher picks up the writes the web workers commit. Needs gevent
+# (requirements-optional.txt).
+# Every setting can be overridden from the environment.
+import os
+
+# Streams cost a greenlet here, not a request thread: cap them at the
+# worker's connections (less a few for the 503s). The process only serves
+# streams, so it skips the similarity index and the email sender. Set
+# before config.py is imported, which reads them once.
+worker_connections = int(os.environ.get('STREAM_WORKER_CONNECTIONS', 10000))
+os.environ['STREAM_MAX_SUBSCRIBERS'] = str(max(worker_connections - 100, 1))
+os.environ.setdefault('CLIENT_INDEX', 'false')
+os.environ.setdefault('OUTBOX_SENDER', 'false')
+
+from config import env_int
+
+bind = f"0.0.0.0:{os.environ.get('STREAM_PORT', '8001')}"
+workers = env_int('STREAM_WORKERS', 1)
+worker_class = 'gevent'
+# gevent patches threading when each worker starts; a preloaded app would
+# have built the hub's Condition and the app's locks unpatched in the master
+preload_app = False
+timeout = env_int('GUNICORN_TIMEOUT', 60)
+graceful_timeout = env_int('GUNICORN_GRACEFUL_TIMEOUT', 30)
+keepalive = env_int('GUNICORN_KEEPALIVE', 5)
+accesslog = '-'
+errorlog = '-'
+
@@ -0,0 +1,101 @@
+# http_cache.py
+# Conditional GETs and response compression for the JSON and export routes.
+#
+# @etag(*tables) derives a strong ETag from the route, its path (so
+# /api/clients/1 and /api/clients/2 differ), its query string and the data
+# versions of the tables the response is built from (versions.py), so a
+# matching If-None-Match is answered with 304 before the view runs and without
+# hashing the body. init_http_cache() compresses large JSON/CSV responses with
+# brotli (when installed) or gzip, streamed ones included.
+import functools
+import gzip
+import hashlib
+import zlib
+from flask import Response, request
+from versions import current_versions
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/csv', 'application/x-ndjson')
+MIN_COMPRESS_SIZE = 1024
+ENCODING_SUFFIX = {'br': '-br', 'gzip': '-gz'}
+
+def _strip_encoding(tag):
+    for suffix in ENCODING_SUFFIX.values():
+        if tag.endswith(suffix):
+            return tag[:-len(suffix)]
+    return tag
+
+def etag(*tables):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            versions = current_versions()
+            key = '|'.join([request.endpoint, request.path, request.query_string.decode()]
+                           + [f"{t}={versions.get(t, 0)}" for t in tables])
+            tag = hashlib.sha1(key.encode()).hexdigest()[:32]
+
+            matched = next((t for t in request.if_none_match if _strip_encoding(t) == tag), None)
+            if matched:
+                # Echo the representation the client holds (plain or encoded)
+                response = Response(status=304)
+                response.set_etag(matched)
+                response.headers['Cache-Control'] = 'no-cache'
+                return response
+
+            response = view(*args, **kwargs)
+            if isinstance(response, tuple) or response.status_code != 200:
+                return response
+            response.set_etag(tag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+def _gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+        yield compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+def _brotli_stream(chunks):
+    compressor = brotli.Compressor(quality=5)
+    for chunk in chunks:
+        yield compressor.process(chunk) + compressor.flush()
+    yield compressor.finish()
+
+def _compress(response):
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    offered = ['br', 'gzip'] if brotli else ['gzip']
+    encoding = request.accept_encodings.best_match(offered)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        stream = _brotli_stream if encoding == 'br' else _gzip_stream
+        response.response = stream(response.iter_encoded())
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return response
+        response.set_data(brotli.compress(data, quality=5) if encoding == 'br' else gzip.compress(data, 6))
+
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    tag, weak = response.get_etag()
+    if tag:
+        response.set_etag(tag + ENCODING_SUFFIX[encoding], weak)
+    return response
+
+def init_http_cache(app):
+    app.after_request(_compress)
@@ -0,0 +1,133 @@
+# importer.py
+# Bulk client import from streamed CSV or NDJSON. Rows are validated against
+# the Client column constraints and inserted in batches with executemany;
+# optional program enrollments are resolved by program name in the same batch.
+# Only one batch is held in memory at a time, whatever the upload size.
+import csv
+import io
+import json
+from sqlalchemy import insert, select
+from changes import ChangeSet, record
+from models import db, Client, ProgramModel, enrollments
+from utils import parse_date
+
+BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+CLIENT_FIELDS = ('name', 'dob', 'gender', 'contact', 'address')
+
+class ImportResult:
+    def __init__(self):
+        self.inserted = 0
+        self.enrolled = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, row_number, errors):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row_number, "errors": errors})
+
+    def as_dict(self):
+        return {
+            "inserted": self.inserted,
+            "enrolled": self.enrolled,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "errors_truncated": self.rejected > len(self.errors),
+        }
+
+# Yield (row_number, record) pairs from a binary stream
+def iter_records(stream, fmt):
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        for number, row in enumerate(csv.DictReader(text_stream), start=2):
+            yield number, {k.strip().lower(): v for k, v in row.items() if k}
+    elif fmt == 'ndjson':
+        for number, line in enumerate(text_stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield number, e
+                continue
+            yield number, row if isinstance(row, dict) else ValueError("expected a JSON object")
+    else:
+        raise ValueError(f"Unsupported import format '{fmt}'")
+
+def _program_names(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [str(name).strip() for name in value if str(name).strip()]
+
+# Map one record onto Client columns; returns (row, program_names, errors)
+def validate(item):
+    if isinstance(item, Exception):
+        return None, [], [f"invalid record: {item}"]
+
+    data = dict(item)
+    if not data.get('name') and (data.get('first_name') or data.get('last_name')):
+        data['name'] = f"{data.get('first_name', '')} {data.get('last_name', '')}".strip()
+    if not data.get('address') and data.get('email'):
+        data['address'] = data['email']
+
+    row, errors = {}, []
+    for field in CLIENT_FIELDS:
+        value = data.get(field)
+        value = '' if value is None else str(value).strip()
+        column = Client.__table__.c[field]
+        if not value and not column.nullable:
+            errors.append(f"{field} is required")
+        elif getattr(column.type, 'length', None) and len(value) > column.type.length:
+            errors.append(f"{field} is longer than {column.type.length} characters")
+        row[field] = value
+    if row['dob']:
+        try:
+            row['dob'] = parse_date(row['dob'])
+        except ValueError:
+            errors.append("dob must be YYYY-MM-DD")
+    return row, _program_names(data.get('programs')), errors
+
+def _flush_batch(batch, program_ids, result):
+    rows = [row for _, row, _ in batch]
+    ids = db.session.execute(
+        insert(Client).returning(Client.id, sort_by_parameter_order=True), rows
+    ).scalars().all()
+
+    pairs = {(client_id, program_ids[name]) for client_id, (_, _, names) in zip(ids, batch) for name in names}
+    if pairs:
+        db.session.execute(insert(enrollments), [{"client_id": c, "program_id": p} for c, p in pairs])
+
+    changes = ChangeSet()
+    changes.clients['inserted'].update(ids)
+    changes.enrolled.update(pairs)
+    record(db.session, changes)
+    db.session.commit()
+    result.inserted += len(ids)
+    result.enrolled += len(pairs)
+
+# Import every record from `stream`; each batch commits on its own
+def import_clients(stream, fmt, batch_size=BATCH_SIZE):
+    result = ImportResult()
+    program_ids = {}
+    for program_id, name in db.session.execute(select(ProgramModel.id, ProgramModel.name).order_by(ProgramModel.id)):
+        program_ids.setdefault(name, program_id)
+
+    batch = []
+    for number, item in iter_records(stream, fmt):
+        row, names, errors = validate(item)
+        unknown = [name for name in names if name not in program_ids]
+        if unknown:
+            errors.append(f"unknown programs: {', '.join(unknown)}")
+        if errors:
+            result.reject(number, errors)
+            continue
+        batch.append((number, row, names))
+        if len(batch) >= batch_size:
+            _flush_batch(batch, program_ids, result)
+            batch = []
+    if batch:
+        _flush_batch(batch, program_ids, result)
+    return result
@@ -0,0 +1,132 @@
+# jobs.py
+# Background report jobs on a local process pool, no external broker needed.
+# A job id is a hash of the report kind, its parameters and the data version,
+# so it doubles as the cache key: once a PDF exists under that id, every
+# worker serves it straight from disk until the underlying data changes.
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from pii import cipher
+from reports import render_report
+
+_executor = None
+_executor_settings = None
+_futures = {}
+_engines = {}
+
+def job_id(kind, params, version):
+    payload = json.dumps([kind, sorted(params.items()), version])
+    return hashlib.sha1(payload.encode()).hexdigest()[:24]
+
+def is_job_id(value):
+    return len(value) == 24 and all(c in '0123456789abcdef' for c in value)
+
+def artifact_path(cache_dir, job):
+    return os.path.join(cache_dir, f"{job}.pdf")
+
+def _marker(cache_dir, job, suffix):
+    return os.path.join(cache_dir, f"{job}.{suffix}")
+
+# Runs once in each worker process: spawned children start from a fresh
+# interpreter, so the PII cipher has to be configured here too
+def _init_worker(pii_settings):
+    if pii_settings is not None:
+        cipher.configure(*pii_settings)
+
+def _get_executor(workers, pii_settings=None):
+    global _executor, _executor_settings
+    if _executor is not None and _executor_settings != pii_settings:
+        _executor.shutdown(wait=False)  # keys changed: new children for new jobs
+        _executor = None
+    if _executor is None:
+        # spawn keeps the children free of the parent's DB connections and threads
+        _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_worker, initargs=(pii_settings,))
+        _executor_settings = pii_settings
+    return _executor
+
+# Runs in the worker process: render to a temp file, then publish it atomically
+def run_job(db_url, kind, params, cache_dir, job):
+    engine = _engines.get(db_url)
+    if engine is None:
+        engine = _engines[db_url] = create_engine(db_url)
+    path = artifact_path(cache_dir, job)
+    tmp_path = _marker(cache_dir, job, f"{os.getpid()}.tmp")
+    try:
+        with Session(engine) as session, open(tmp_path, 'wb') as out:
+            render_report(kind, session, out, params)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        with open(_marker(cache_dir, job, 'err'), 'w') as f:
+            f.write(str(e))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        if os.path.exists(_marker(cache_dir, job, 'pending')):
+            os.remove(_marker(cache_dir, job, 'pending'))
+    return path
+
+# Queue a report unless it is already cached or in flight; returns the job id.
+# pii_settings (pii.settings()) lets the workers decrypt client fields.
+def submit(db_url, kind, params, version, cache_dir, workers=2, timeout=600, pii_settings=None):
+    os.makedirs(cache_dir, exist_ok=True)
+    job = job_id(kind, params, version)
+    if job_status(cache_dir, job, timeout)['status'] in ('done', 'pending'):
+        return job
+
+    err = _marker(cache_dir, job, 'err')
+    if os.path.exists(err):
+        os.remove(err)
+    with open(_marker(cache_dir, job, 'pending'), 'w') as f:
+        f.write(str(time.time()))
+    future = _get_executor(workers, pii_settings).submit(run_job, db_url, kind, params, cache_dir, job)
+    _futures[job] = future
+    future.add_done_callback(lambda f: _forget(job, f))
+    return job
+
+# Finished futures are dropped whether or not anyone wait()ed on them; the
+# markers and artifact on disk carry the result from there
+def _forget(job, future):
+    if _futures.get(job) is future:
+        _futures.pop(job, None)
+
+# Status is read from the cache directory so any gunicorn worker can answer it
+def job_status(cache_dir, job, timeout=600):
+    if os.path.exists(artifact_path(cache_dir, job)):
+        return {"status": "done"}
+    err = _marker(cache_dir, job, 'err')
+    if os.path.exists(err):
+        with open(err) as f:
+            return {"status": "failed", "error": f.read()}
+    pending = _marker(cache_dir, job, 'pending')
+    if os.path.exists(pending) and time.time() - os.path.getmtime(pending) < timeout:
+        return {"status": "pending"}
+    return {"status": "unknown"}
+
+# Block for up to `seconds` on a job started by this process
+def wait(job, seconds):
+    future = _futures.get(job)
+    if future is None:
+        return
+    try:
+        future.result(timeout=seconds)
+    except Exception:
+        pass
+
+# Drop cached reports that haven't been written for `max_age` seconds, along
+# with the .pending and .tmp markers a killed worker left behind (max_age is
+# far longer than any render, so live jobs keep theirs)
+def prune(cache_dir, max_age):
+    if not os.path.isdir(cache_dir):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith(('.pdf', '.err', '.pending', '.tmp')) and os.path.getmtime(path) < cutoff:
+            os.remove(path)
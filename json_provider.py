@@ -0,0 +1,44 @@
+# json_provider.py
+# Pluggable JSON encoding for jsonify() and the other JSON responses. With
+# JSON_ENCODER=auto (the default) orjson is used when it is installed, and
+# the standard library encoder otherwise; 'orjson' requires it, 'stdlib'
+# keeps Flask's own provider. The orjson provider produces the same
+# documents: keys sorted, and dates, decimals and other types orjson would
+# encode differently handed to Flask's default() hook.
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+class OrjsonProvider(DefaultJSONProvider):
+    def _options(self):
+        options = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.compact is False or (self.compact is None and self._app.debug):
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:  # callers asking for stdlib options get the stdlib encoder
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._options()).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        data = orjson.dumps(obj, default=self.default, option=self._options())
+        return self._app.response_class(data + b'\n', mimetype=self.mimetype)
+
+def init_json(app):
+    encoder = app.config['JSON_ENCODER']
+    if encoder == 'orjson' and orjson is None:
+        raise RuntimeError("JSON_ENCODER=orjson but the orjson package is not installed")
+    if encoder not in ('auto', 'orjson', 'stdlib'):
+        raise ValueError(f"Unknown JSON_ENCODER '{encoder}'")
+    if encoder != 'stdlib' and orjson is not None:
+        app.json = OrjsonProvider(app)
@@ -0,0 +1,182 @@
+# metrics.py
+# Per-request instrumentation. SQLAlchemy engine events time every statement
+# and charge it to the request running on that thread (flask.g), so each
+# request ends up with its wall time, statement count, SQL time and response
+# size. Those feed Prometheus histograms served by render() in the text
+# exposition format, labelled by route pattern, so /metrics shows which
+# routes are slow and which run too many queries. Slow requests are logged
+# with their worst statements; requests past the query threshold are logged
+# with the statement they repeated most, which is usually an N+1 loop.
+#
+# Numbers are per process: with several gunicorn workers, scrape each one
+# (or aggregate in Prometheus).
+import heapq
+import re
+import threading
+import time
+from collections import Counter
+from flask import g, has_app_context, request
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+WORST_STATEMENTS = 3
+
+class Histogram:
+    def __init__(self, name, help_text, labels, buckets):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(labels, list(counts), total, count) for labels, (counts, total, count) in sorted(self._series.items())]
+        for label_values, counts, total, count in snapshot:
+            labels = ','.join(f'{k}="{_escape(v)}"' for k, v in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return '\n'.join(lines)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Wall time per request, streaming included.',
+                             ('method', 'route', 'status'), LATENCY_BUCKETS)
+REQUEST_QUERIES = Histogram('http_request_sql_queries', 'SQL statements executed per request.',
+                            ('method', 'route'), QUERY_BUCKETS)
+REQUEST_SQL_TIME = Histogram('http_request_sql_duration_seconds', 'Time spent in SQL per request.',
+                             ('method', 'route'), LATENCY_BUCKETS)
+RESPONSE_SIZE = Histogram('http_response_size_bytes', 'Response body size as sent.',
+                          ('method', 'route'), SIZE_BUCKETS)
+HISTOGRAMS = (REQUEST_DURATION, REQUEST_QUERIES, REQUEST_SQL_TIME, RESPONSE_SIZE)
+
+class RequestStats:
+    __slots__ = ('start', 'route', 'queries', 'sql_seconds', 'worst', 'repeats', 'size')
+
+    def __init__(self, route):
+        self.start = time.perf_counter()
+        self.route = route
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.worst = []        # min-heap of (seconds, statement), the slowest few
+        self.repeats = Counter()  # normalized statement -> executions
+        self.size = 0
+
+    def add_statement(self, statement, seconds):
+        self.queries += 1
+        self.sql_seconds += seconds
+        self.repeats[_normalize(statement)] += 1
+        entry = (seconds, statement)
+        if len(self.worst) < WORST_STATEMENTS:
+            heapq.heappush(self.worst, entry)
+        elif entry > self.worst[0]:
+            heapq.heapreplace(self.worst, entry)
+
+def _normalize(statement):
+    # Collapse IN (?, ?, ...) lists so batches of different sizes count as one statement
+    return re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?...)', ' '.join(statement.split()))
+
+def _current_stats():
+    return g.get('_request_stats') if has_app_context() else None
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_metrics_start', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['_metrics_start'].pop()
+    stats = _current_stats()
+    if stats is not None:
+        stats.add_statement(statement, time.perf_counter() - started)
+
+def _handle_error(exception_context):
+    # after_cursor_execute doesn't fire for a failed statement
+    starts = exception_context.connection.info.get('_metrics_start') if exception_context.connection else None
+    if starts:
+        starts.pop()
+
+def _counting(chunks, stats, done):
+    try:
+        for chunk in chunks:
+            stats.size += len(chunk)
+            yield chunk
+    finally:
+        done()
+
+def _shorten(statement, limit=300):
+    statement = ' '.join(statement.split())
+    return statement if len(statement) <= limit else statement[:limit] + '...'
+
+def init_metrics(app, engine):
+    """Hook the engine and the request cycle. Call before other after_request
+    hooks are registered, so the size measured is what goes on the wire."""
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+
+    @app.before_request
+    def start_request_metrics():
+        g._request_stats = RequestStats(request.url_rule.rule if request.url_rule else 'unmatched')
+
+    @app.after_request
+    def finish_request_metrics(response):
+        stats = g.get('_request_stats')
+        if stats is None or response.mimetype == 'text/event-stream':
+            return response  # long-lived by design, would swamp the latency histogram
+        method, status = request.method, str(response.status_code)
+
+        def record():
+            elapsed = time.perf_counter() - stats.start
+            REQUEST_DURATION.observe(elapsed, method, stats.route, status)
+            REQUEST_QUERIES.observe(stats.queries, method, stats.route)
+            REQUEST_SQL_TIME.observe(stats.sql_seconds, method, stats.route)
+            RESPONSE_SIZE.observe(stats.size, method, stats.route)
+            summary = (f"{method} {stats.route} {status} took {elapsed * 1000:.0f} ms, "
+                       f"{stats.queries} queries in {stats.sql_seconds * 1000:.0f} ms, {stats.size} bytes")
+            if elapsed * 1000 >= app.config['SLOW_REQUEST_MS']:
+                worst = '\n'.join(f"  {seconds * 1000:.1f} ms: {_shorten(sql)}"
+                                  for seconds, sql in sorted(stats.worst, reverse=True))
+                app.logger.warning('Slow request: %s\n%s', summary, worst)
+            if stats.queries > app.config['QUERY_COUNT_WARN']:
+                statement, count = stats.repeats.most_common(1)[0]
+                app.logger.warning('Too many queries: %s; most repeated (%d times): %s',
+                                   summary, count, _shorten(statement))
+
+        if response.is_streamed and not response.direct_passthrough:
+            # The body (and its queries) is produced after this hook: record
+            # once the server has drained or closed the stream
+            response.response = _counting(response.response, stats, record)
+        else:
+            stats.size = response.calculate_content_length() or 0
+            record()
+        return response
+
+def render():
+    """All histograms in the Prometheus text exposition format."""
+    return '\n'.join(h.render() for h in HISTOGRAMS) + '\n'
+
+def reset():
+    for histogram in HISTOGRAMS:
+        histogram.clear()
@@ -0,0 +1,187 @@
+# migrations.py
+# In-place schema upgrades for existing database files. A fresh database is
+# built by db.create_all() and stamped with the latest version; an older one
+# is brought forward one numbered migration at a time, each in a single
+# transaction, before the app touches it.
+from datetime import datetime
+from sqlalchemy import inspect, select, text
+from models import Client, SchemaVersion
+from pii import cipher
+from utils import utcnow
+
+LEGACY_DOB_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y', '%m/%d/%Y', '%Y/%m/%d', '%d-%m-%Y')
+
+class MigrationError(Exception):
+    pass
+
+def _legacy_date(value):
+    for fmt in LEGACY_DOB_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), fmt).date()
+        except (AttributeError, ValueError):
+            continue
+    return None
+
+# Rewrite client.dob values that aren't already YYYY-MM-DD
+def _normalize_dob(connection):
+    rows = connection.execute(text(
+        "SELECT id, dob FROM client WHERE dob IS NULL OR dob NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'"
+    )).all()
+    updates, bad = [], []
+    for client_id, dob in rows:
+        parsed = _legacy_date(dob)
+        if parsed is None:
+            bad.append(client_id)
+        else:
+            updates.append({"id": client_id, "dob": parsed.isoformat()})
+    if bad:
+        raise MigrationError(f"Unrecognised dob values for client ids {bad[:20]}; fix them and rerun the upgrade.")
+    if updates:
+        connection.execute(text("UPDATE client SET dob = :dob WHERE id = :id"), updates)
+
+# SQLite can't alter columns or add primary keys: create the table again
+# from `ddl` (a CREATE TABLE for the placeholder name {table}) and copy the
+# rows across. The DDL is written out in each migration rather than taken
+# from models.py, so a migration builds the same schema however the models
+# have changed since.
+def _rebuild_sqlite_table(connection, name, ddl, columns, select_sql):
+    connection.exec_driver_sql(ddl.format(table=f"_{name}_new"))
+    connection.exec_driver_sql(f"INSERT OR IGNORE INTO _{name}_new ({', '.join(columns)}) {select_sql}")
+    connection.exec_driver_sql(f"DROP TABLE {name}")
+    connection.exec_driver_sql(f"ALTER TABLE _{name}_new RENAME TO {name}")
+
+# Schema version 1 of the rebuilt tables
+V1_CLIENT = (
+    "CREATE TABLE {table} (id INTEGER NOT NULL, name VARCHAR(100) NOT NULL, dob DATE NOT NULL, "
+    "gender VARCHAR(20) NOT NULL, contact VARCHAR(50) NOT NULL, address VARCHAR(255) NOT NULL, "
+    "PRIMARY KEY (id))"
+)
+V1_ENROLLMENTS = (
+    "CREATE TABLE {table} (client_id INTEGER NOT NULL, program_id INTEGER NOT NULL, "
+    "PRIMARY KEY (client_id, program_id), FOREIGN KEY(client_id) REFERENCES client (id), "
+    "FOREIGN KEY(program_id) REFERENCES program_model (id))"
+)
+
+CLIENT_NAME_INDEX = "CREATE INDEX IF NOT EXISTS ix_client_name ON client (name)"
+
+# 1: enrollments primary key + reverse index, client name/dob indexes, dob as
+# DATE. With PII encryption on, client.name holds ciphertext and an index on
+# it can't serve any lookup, so it is left out.
+def _upgrade_1(connection):
+    dialect = connection.dialect.name
+    indexes = ["CREATE INDEX IF NOT EXISTS ix_enrollments_program_id ON enrollments (program_id, client_id)",
+               "CREATE INDEX IF NOT EXISTS ix_client_dob ON client (dob)"]
+    if not cipher.enabled:
+        indexes.append(CLIENT_NAME_INDEX)
+    if dialect == 'sqlite':
+        _normalize_dob(connection)
+        columns = ('id', 'name', 'dob', 'gender', 'contact', 'address')
+        _rebuild_sqlite_table(connection, 'client', V1_CLIENT, columns,
+                              f"SELECT {', '.join(columns)} FROM client")
+        _rebuild_sqlite_table(connection, 'enrollments', V1_ENROLLMENTS, ('client_id', 'program_id'),
+                              "SELECT client_id, program_id FROM enrollments "
+                              "WHERE client_id IS NOT NULL AND program_id IS NOT NULL")
+        for statement in indexes:
+            connection.exec_driver_sql(statement)
+    elif dialect == 'postgresql':
+        for statement in (
+            "DELETE FROM enrollments WHERE client_id IS NULL OR program_id IS NULL",
+            "DELETE FROM enrollments a USING enrollments b WHERE a.ctid < b.ctid "
+            "AND a.client_id = b.client_id AND a.program_id = b.program_id",
+            "ALTER TABLE enrollments ALTER COLUMN client_id SET NOT NULL, ALTER COLUMN program_id SET NOT NULL",
+            "ALTER TABLE enrollments ADD PRIMARY KEY (client_id, program_id)",
+            "ALTER TABLE client ALTER COLUMN dob TYPE DATE USING dob::date",
+            *indexes,
+        ):
+            connection.exec_driver_sql(statement)
+    else:
+        raise MigrationError(f"No upgrade path for {dialect} databases.")
+
+# 2: blind index columns for encrypted PII; PII columns as TEXT (ciphertext
+# outgrows the old VARCHAR limits). SQLite doesn't enforce those, and the
+# client_token table is created by create_all().
+def _upgrade_2(connection):
+    dialect = connection.dialect.name
+    # Skip columns the client table already has (a rerun after a partial upgrade)
+    existing = {c['name'] for c in inspect(connection).get_columns('client')}
+    statements = [f"ALTER TABLE client ADD COLUMN {name} VARCHAR(32)"
+                  for name in ('name_bidx', 'contact_bidx') if name not in existing]
+    statements += [
+        "CREATE INDEX IF NOT EXISTS ix_client_name_bidx ON client (name_bidx)",
+        "CREATE INDEX IF NOT EXISTS ix_client_contact_bidx ON client (contact_bidx)",
+    ]
+    if dialect == 'postgresql':
+        statements += [
+            "ALTER TABLE client ALTER COLUMN name TYPE TEXT, ALTER COLUMN contact TYPE TEXT, "
+            "ALTER COLUMN address TYPE TEXT",
+            "ALTER TABLE recent_registration ALTER COLUMN name TYPE TEXT",
+        ]
+    elif dialect != 'sqlite':
+        raise MigrationError(f"No upgrade path for {dialect} databases.")
+    for statement in statements:
+        connection.exec_driver_sql(statement)
+
+# 3: client.updated_at, which the archive job reads as the client's last
+# activity. Nothing recorded it before, so existing clients start from now
+# rather than looking idle since forever.
+def _upgrade_3(connection):
+    dialect = connection.dialect.name
+    if dialect not in ('sqlite', 'postgresql'):
+        raise MigrationError(f"No upgrade path for {dialect} databases.")
+    column = 'DATETIME' if dialect == 'sqlite' else 'TIMESTAMP'
+    # SQLite can't add a column with a CURRENT_TIMESTAMP default; new rows
+    # get theirs from the INSERT (models.py)
+    connection.exec_driver_sql(f"ALTER TABLE client ADD COLUMN updated_at {column}")
+    connection.execute(text("UPDATE client SET updated_at = :now"), {"now": utcnow()})
+
+# 4: outbox_message.attachment_report, the report job an email attaches
+# when it is sent. Databases from before the outbox get the table, column
+# included, from create_all().
+def _upgrade_4(connection):
+    if inspect(connection).has_table('outbox_message'):
+        connection.exec_driver_sql("ALTER TABLE outbox_message ADD COLUMN attachment_report TEXT")
+
+MIGRATIONS = {
+    1: _upgrade_1,
+    2: _upgrade_2,
+    3: _upgrade_3,
+    4: _upgrade_4,
+}
+LATEST = max(MIGRATIONS)
+
+def current_version(connection):
+    if not inspect(connection).has_table(SchemaVersion.__tablename__):
+        return 0
+    return connection.scalar(select(SchemaVersion.version).where(SchemaVersion.id == 1)) or 0
+
+def _set_version(connection, version):
+    SchemaVersion.__table__.create(connection, checkfirst=True)
+    if connection.execute(SchemaVersion.__table__.update().where(SchemaVersion.id == 1)
+                          .values(version=version)).rowcount == 0:
+        connection.execute(SchemaVersion.__table__.insert().values(id=1, version=version))
+
+# Apply pending migrations to an existing database; returns the versions applied
+def upgrade(engine):
+    with engine.connect() as connection:
+        if not inspect(connection).has_table(Client.__tablename__):
+            return []  # fresh database, create_all() builds the current schema
+        if connection.dialect.name == 'sqlite':
+            connection.exec_driver_sql("PRAGMA foreign_keys = OFF")
+        version_now = current_version(connection)
+        connection.commit()
+        applied = []
+        for version in range(version_now + 1, LATEST + 1):
+            with connection.begin():
+                MIGRATIONS[version](connection)
+                _set_version(connection, version)
+            applied.append(version)
+        return applied
+
+# Record a freshly created database as up to date, adding the indexes
+# create_all() leaves to the migrations
+def stamp(engine):
+    with engine.begin() as connection:
+        if current_version(connection) == 0:
+            if not cipher.enabled:
+                connection.exec_driver_sql(CLIENT_NAME_INDEX)
+            _set_version(connection, LATEST)
@@ -1,12 +1,16 @@
 from flask_sqlalchemy import SQLAlchemy
+from pii import EncryptedText
 
 # Initialize SQLAlchemy
 db = SQLAlchemy()
 
-# Many-to-many relationship between clients and programs
+# Many-to-many relationship between clients and programs. The composite
+# primary key covers lookups by client; the reverse index covers "clients in
+# program X" (export filters, counts).
 enrollments = db.Table('enrollments',
-    db.Column('client_id', db.Integer, db.ForeignKey('client.id')),
-    db.Column('program_id', db.Integer, db.ForeignKey('program_model.id'))
+    db.Column('client_id', db.Integer, db.ForeignKey('client.id'), primary_key=True),
+    db.Column('program_id', db.Integer, db.ForeignKey('program_model.id'), primary_key=True),
+    db.Index('ix_enrollments_program_id', 'program_id', 'client_id')
 )
 
 # Doctor Model
@@ -19,18 +23,42 @@ class Doctor(db.Model):
     # A doctor can create many programs
     programs = db.relationship('ProgramModel', backref='creator', lazy=True)
 
-# Client Model
+# Client Model. Name, contact and address are encrypted at rest when
+# PII_ENCRYPTION_KEYS is set (pii.py); the *_bidx columns and client_token
+# rows are their blind indexes, maintained by search.py.
 class Client(db.Model):
+    # ix_client_name is owned by migrations.py: it only exists while names
+    # are stored in plaintext
+    __table_args__ = (
+        db.Index('ix_client_dob', 'dob'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    dob = db.Column(db.String(20), nullable=False)
+    name = db.Column(EncryptedText(100), nullable=False)
+    dob = db.Column(db.Date, nullable=False)
     gender = db.Column(db.String(20), nullable=False)
-    contact = db.Column(db.String(50), nullable=False)
-    address = db.Column(db.String(255), nullable=False)
+    contact = db.Column(EncryptedText(50), nullable=False)
+    address = db.Column(EncryptedText(255), nullable=False)
+    name_bidx = db.Column(db.String(32), index=True)
+    contact_bidx = db.Column(db.String(32), index=True)
+    # Last write to the client or its enrollments (UTC), maintained by
+    # archive.py to tell idle clients apart. Stamped by the INSERT itself, as
+    # columns added by a migration have no DEFAULT in SQLite.
+    updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(),
+                           server_default=db.func.current_timestamp())
 
     # A client can enroll into multiple programs
     programs = db.relationship('ProgramModel', secondary=enrollments, back_populates='clients')
 
+# Word prefix tokens of each client's PII fields, for search over ciphertext.
+# Derived data like the aggregates below: no foreign key, so it can be
+# cleaned up after the client row is gone.
+client_tokens = db.Table('client_token',
+    db.Column('token', db.BigInteger, primary_key=True),
+    db.Column('client_id', db.Integer, primary_key=True),
+    db.Index('ix_client_token_client_id', 'client_id')
+)
+
 # Program Model
 class ProgramModel(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -39,3 +67,89 @@ class ProgramModel(db.Model):
 
     # A program can have multiple enrolled clients
     clients = db.relationship('Client', secondary=enrollments, back_populates='programs')
+
+# Data version counters, one row per tracked table. Bumped in the same
+# transaction as every write so caches can key on them (see versions.py).
+class DataVersion(db.Model):
+    table_name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+# Precomputed dashboard aggregates, maintained by aggregates.py in the same
+# transaction as the client/program/enrollment writes they summarize
+class ProgramStat(db.Model):
+    program_id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    client_count = db.Column(db.Integer, nullable=False, default=0)
+
+class RegistryStat(db.Model):
+    key = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class RecentRegistration(db.Model):
+    client_id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(EncryptedText(100), nullable=False)
+
+# Cohort rollups maintained by analytics.py: enrolled clients per program by
+# gender and birth year (program_id 0 counts every registered client), and
+# enrollments per program and calendar month ('YYYY-MM'; program_id 0 counts
+# registrations)
+class DemographicStat(db.Model):
+    program_id = db.Column(db.Integer, primary_key=True)
+    gender = db.Column(db.String(20), primary_key=True)
+    birth_year = db.Column(db.Integer, primary_key=True)
+    client_count = db.Column(db.Integer, nullable=False, default=0)
+
+class EnrollmentTrend(db.Model):
+    program_id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.String(7), primary_key=True)
+    enrolled = db.Column(db.Integer, nullable=False, default=0)
+    unenrolled = db.Column(db.Integer, nullable=False, default=0)
+
+# Append-only log of client, program and enrollment changes for downstream
+# sync (/api/changes), written in the same transaction as the change by
+# changelog.py. Enrollment rows carry the program id in related_id.
+class ChangeLog(db.Model):
+    __table_args__ = (
+        db.Index('ix_change_log_entity', 'entity', 'entity_id', 'related_id'),
+        {'sqlite_autoincrement': True},  # a seq is never handed out twice
+    )
+    seq = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)   # client, program, enrollment
+    entity_id = db.Column(db.Integer, nullable=False)
+    related_id = db.Column(db.Integer, nullable=False, default=0)
+    action = db.Column(db.String(10), nullable=False)   # insert, update, delete, enroll, unenroll
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+# Highest seq dropped from the change log by compaction: consumers that last
+# synced before it have missed changes and must resync from the full dumps
+class ChangeLogState(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    truncated_seq = db.Column(db.Integer, nullable=False, default=0)
+
+# Schema version of the database file, maintained by migrations.py
+class SchemaVersion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+# Outgoing email, persisted so the request only queues it; outbox.py sends
+# it in the background and records the delivery status here
+class OutboxMessage(db.Model):
+    __table_args__ = (
+        db.Index('ix_outbox_message_due', 'status', 'next_attempt_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(200), nullable=False)
+    sender = db.Column(db.String(200), nullable=False)
+    recipients = db.Column(db.Text, nullable=False)  # comma separated
+    body = db.Column(db.Text, nullable=False, default='')
+    attachment_name = db.Column(db.String(200))
+    attachment_type = db.Column(db.String(100))
+    attachment = db.Column(db.LargeBinary)
+    attachment_report = db.Column(db.Text)  # JSON report job whose PDF is attached at send time (outbox.py)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, nullable=False)
+    claimed_at = db.Column(db.DateTime)
+    sent_at = db.Column(db.DateTime)
@@ -0,0 +1,193 @@
+# outbox.py
+# Asynchronous email. Routes only insert an OutboxMessage row and return; a
+# background sender claims due rows in batches, sends each batch over one
+# SMTP connection (Flask-Mail's mail.connect()), and records the result on
+# the row. Failures are retried with exponential backoff until
+# OUTBOX_MAX_ATTEMPTS, then the message is marked failed. Claiming is a
+# single UPDATE, so several workers (or `flask send-outbox`) can share one
+# outbox without sending a message twice.
+#
+# A message can attach a report job instead of a file (enqueue(report=)):
+# the sender reads the finished PDF when it sends, and a job still
+# rendering holds the message back without using up an attempt.
+import json
+import smtplib
+import threading
+from datetime import timedelta
+from sqlalchemy import and_, func, or_, select, update
+from models import OutboxMessage
+from utils import utcnow
+
+SENDING_TIMEOUT = timedelta(minutes=10)  # a claim older than this belongs to a dead sender
+
+_report_loader = None
+
+class NotReady(Exception):
+    """Raised by the report loader while the report is still rendering."""
+
+def report_loader(fn):
+    """Register fn(report) -> bytes, which reads a report attachment when its
+    message is sent. It may move report['job'] (a job that had to be queued
+    again) and raises NotReady until the PDF exists."""
+    global _report_loader
+    _report_loader = fn
+    return fn
+
+def enqueue(session, subject, sender, recipients, body='', attachment=None, report=None):
+    """Add a message to the outbox; the caller commits.
+    attachment is an optional (filename, content_type, data) tuple; with
+    report ({"kind", "params", "job"}) its data is left out and the
+    report's PDF is attached when the message is sent."""
+    now = utcnow()
+    row = OutboxMessage(subject=subject, sender=sender, recipients=','.join(recipients), body=body,
+                        status='queued', attempts=0, created_at=now, next_attempt_at=now)
+    if attachment:
+        row.attachment_name, row.attachment_type, row.attachment = attachment
+    if report:
+        row.attachment_report = json.dumps(report)
+    session.add(row)
+    return row
+
+def to_message(row):
+    from flask_mail import Message
+    msg = Message(row.subject, sender=row.sender, recipients=row.recipients.split(','))
+    msg.body = row.body
+    if row.attachment_report is not None:
+        report = json.loads(row.attachment_report)
+        try:
+            data = _report_loader(report)
+        finally:
+            row.attachment_report = json.dumps(report)
+        msg.attach(row.attachment_name, row.attachment_type, data)
+    elif row.attachment is not None:
+        msg.attach(row.attachment_name, row.attachment_type, row.attachment)
+    return msg
+
+def message_json(row):
+    def iso(value):
+        return value.isoformat() + 'Z' if value else None
+    return {
+        'id': row.id,
+        'subject': row.subject,
+        'recipients': row.recipients.split(','),
+        'status': row.status,
+        'attempts': row.attempts,
+        'last_error': row.last_error,
+        'created_at': iso(row.created_at),
+        'next_attempt_at': iso(row.next_attempt_at) if row.status == 'queued' else None,
+        'sent_at': iso(row.sent_at),
+    }
+
+def backoff_delay(attempts, base, cap):
+    """Seconds to wait before retry number `attempts` (1, 2, ...): base, 2*base, 4*base ... up to cap."""
+    return min(cap, base * 2 ** (attempts - 1))
+
+def claim(session, batch_size, now=None):
+    """Mark up to batch_size due messages as being sent by us and return them."""
+    now = now or utcnow()
+    due = or_(
+        and_(OutboxMessage.status == 'queued', OutboxMessage.next_attempt_at <= now),
+        and_(OutboxMessage.status == 'sending', OutboxMessage.claimed_at < now - SENDING_TIMEOUT),
+    )
+    ids = select(OutboxMessage.id).where(due).order_by(OutboxMessage.next_attempt_at).limit(batch_size)
+    claimed = session.execute(
+        update(OutboxMessage).where(OutboxMessage.id.in_(ids), due)
+        .values(status='sending', claimed_at=now)
+        .returning(OutboxMessage.id)
+    ).scalars().all()
+    session.commit()
+    if not claimed:
+        return []
+    return session.scalars(select(OutboxMessage).where(OutboxMessage.id.in_(claimed))
+                           .order_by(OutboxMessage.id)).all()
+
+# Back in the queue for the next poll, without counting an attempt
+def _not_ready(row, delay, now):
+    row.status = 'queued'
+    row.claimed_at = None
+    row.next_attempt_at = now + timedelta(seconds=delay)
+
+def _failed(row, error, max_attempts, base, cap, now):
+    row.attempts += 1
+    row.last_error = str(error)[:1000] or error.__class__.__name__
+    row.claimed_at = None
+    if row.attempts >= max_attempts:
+        row.status = 'failed'
+    else:
+        row.status = 'queued'
+        row.next_attempt_at = now + timedelta(seconds=backoff_delay(row.attempts, base, cap))
+
+def deliver_pending(mail, session, config):
+    """Send one batch of due messages over a single SMTP connection.
+    Returns the number of messages claimed (0 when the outbox is idle)."""
+    rows = claim(session, config['OUTBOX_BATCH_SIZE'])
+    if not rows:
+        return 0
+    retry = (config['OUTBOX_MAX_ATTEMPTS'], config['OUTBOX_BACKOFF_SECONDS'], config['OUTBOX_BACKOFF_MAX_SECONDS'])
+    try:
+        with mail.connect() as conn:
+            for row in rows:
+                try:
+                    conn.send(to_message(row))
+                except NotReady:
+                    _not_ready(row, config['OUTBOX_POLL_SECONDS'], utcnow())
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    raise  # the connection is gone, retry the rest of the batch later
+                except Exception as e:
+                    # Rejected by the server (bad recipient, too large...): only this message fails
+                    _failed(row, e, *retry, utcnow())
+                else:
+                    row.status = 'sent'
+                    row.sent_at = utcnow()
+                    row.claimed_at = None
+                # Commit per message so a crash never resends what was delivered
+                session.commit()
+    except Exception as e:
+        # Could not connect, log in, or the connection dropped mid-batch
+        for row in rows:
+            if row.status == 'sending':
+                _failed(row, e, *retry, utcnow())
+        session.commit()
+    return len(rows)
+
+def outbox_stats(session):
+    counts = dict(session.execute(select(OutboxMessage.status, func.count()).group_by(OutboxMessage.status)).all())
+    return {status: counts.get(status, 0) for status in ('queued', 'sending', 'sent', 'failed')}
+
+class OutboxSender:
+    """Background thread draining the outbox. wake() after enqueueing skips
+    the poll wait; the poll also picks up retries and other workers' mail."""
+
+    def __init__(self):
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self, app, mail, db):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, args=(app, mail, db),
+                                                name='outbox-sender', daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def join(self):
+        self._thread.join()
+
+    def _run(self, app, mail, db):
+        while True:
+            with app.app_context():
+                try:
+                    claimed = deliver_pending(mail, db.session, app.config)
+                except Exception:
+                    app.logger.exception('Outbox sender failed')
+                    claimed = 0
+                finally:
+                    db.session.remove()
+            if not claimed:
+                self._wake.wait(app.config['OUTBOX_POLL_SECONDS'])
+                self._wake.clear()
+
+sender = OutboxSender()
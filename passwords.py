@@ -0,0 +1,120 @@
+# passwords.py
+# Password hashing off the request path. bcrypt burns ~250 ms of CPU per call;
+# running it inline lets a login rush starve every other route on the worker.
+# Here hashes run on a small bounded thread pool (the bcrypt C code releases
+# the GIL, so threads get real parallelism) behind an admission limit: when
+# the pool and its queue are full the caller gets PoolSaturated right away,
+# which the app turns into 503 + Retry-After instead of queueing forever.
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_ROUNDS = 12
+
+class PoolSaturated(Exception):
+    """Raised when no hashing slot frees up within the admission wait."""
+    def __init__(self, retry_after):
+        super().__init__('Password hashing pool is saturated')
+        self.retry_after = retry_after
+
+def hash_rounds(hashed):
+    """Cost factor encoded in a bcrypt hash ('$2b$12$...' -> 12), None if unreadable."""
+    try:
+        return int(hashed.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+# bcrypt is imported by the pool threads on first use, not at app import
+def _hashpw(password, rounds):
+    import bcrypt
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def _checkpw(password, hashed):
+    import bcrypt
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+class PasswordHasher:
+    def __init__(self, workers=None, max_pending=None, rounds=DEFAULT_ROUNDS, admission_wait=0.5):
+        self._executor = None
+        self._lock = threading.Lock()
+        self._avg_seconds = 0.25  # running estimate of one hash, used for Retry-After
+        self._dummy_hash = None
+        self.calls = 0
+        self.rejected = 0
+        self.configure(workers, max_pending, rounds, admission_wait)
+
+    def configure(self, workers=None, max_pending=None, rounds=DEFAULT_ROUNDS, admission_wait=0.5):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = self.workers * 4 if max_pending is None else max_pending
+        self.rounds = rounds
+        self.admission_wait = admission_wait
+        self._slots = threading.BoundedSemaphore(self.workers + self.max_pending)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._dummy_hash = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bcrypt')
+            return self._executor
+
+    def retry_after(self):
+        """Seconds until the current backlog should have drained, at least 1."""
+        backlog = self.workers + self.max_pending
+        return max(1, math.ceil(backlog / self.workers * self._avg_seconds))
+
+    def _run(self, fn, *args):
+        slots = self._slots
+        if not slots.acquire(timeout=self.admission_wait):
+            self.rejected += 1
+            raise PoolSaturated(self.retry_after())
+        try:
+            future = self._get_executor().submit(self._timed, fn, *args)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        return future.result()
+
+    def _timed(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.calls += 1
+            self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * elapsed
+
+    def hash(self, password):
+        """bcrypt hash of password at the configured cost, as text."""
+        return self._run(_hashpw, password, self.rounds)
+
+    def verify(self, password, hashed):
+        """Check password against hashed. hashed=None still spends the same time,
+        so unknown usernames can't be told apart by response latency."""
+        if hashed is None:
+            if self._dummy_hash is None:
+                self._dummy_hash = self.hash(os.urandom(16).hex())
+            self._run(_checkpw, password, self._dummy_hash)
+            return False
+        return self._run(_checkpw, password, hashed)
+
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
+
+    def stats(self):
+        return {'workers': self.workers, 'max_pending': self.max_pending, 'rounds': self.rounds,
+                'calls': self.calls, 'rejected': self.rejected, 'avg_ms': round(self._avg_seconds * 1000, 1)}
+
+hasher = PasswordHasher()
+
+def init_passwords(app):
+    """Size the shared hasher from app config."""
+    hasher.configure(workers=app.config['BCRYPT_WORKERS'] or None,
+                     max_pending=app.config['BCRYPT_MAX_PENDING'],
+                     rounds=app.config['BCRYPT_LOG_ROUNDS'],
+                     admission_wait=app.config['BCRYPT_ADMISSION_WAIT_MS'] / 1000)
@@ -0,0 +1,221 @@
+# pii.py
+# Field-level encryption of client PII (name, contact, address). Columns
+# typed EncryptedText are encrypted with Fernet on the way into the database
+# and decrypted on the way out, so the ORM and Core code above them see
+# plaintext. Keys come from PII_ENCRYPTION_KEYS (newest first): new values are
+# written with the first key, older keys still decrypt until `flask pii-rotate`
+# has re-encrypted every row. Without keys the columns stay plaintext, and
+# rows written before encryption was turned on still read back.
+#
+# Ciphertext can't be searched, so the cipher also derives HMAC blind
+# indexes keyed by PII_INDEX_KEY: one per field value for exact lookups and
+# one per word prefix (up to MAX_PREFIX characters) for prefix search.
+# search.py stores and queries them.
+import hashlib
+import hmac
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from functools import lru_cache
+from sqlalchemy import Text, select, type_coerce, update
+from sqlalchemy.types import TypeDecorator
+
+MAX_PREFIX = 8
+TOKEN_PREFIX = 'gAAAAA'  # every Fernet token starts with its version byte and timestamp
+ROTATE_BATCH = 1000
+
+class PiiConfigError(Exception):
+    pass
+
+def normalize(value):
+    """Case, accent and whitespace insensitive form used for the blind indexes."""
+    value = unicodedata.normalize('NFKD', value or '')
+    value = ''.join(ch for ch in value if not unicodedata.combining(ch))
+    return ' '.join(value.casefold().split())
+
+def words(value):
+    return re.findall(r'\w+', normalize(value))
+
+class _LRU:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class PiiCipher:
+    """Process-wide cipher, configured from the app config by init_pii().
+    The Fernet objects are built once; decrypted values are kept in an LRU so
+    hot rows (list pages, recent registrations) decrypt once per process."""
+
+    def __init__(self):
+        self.configure([])
+
+    def configure(self, keys, index_key=None, cache_size=50000):
+        keys = [k.strip() for k in keys if k and k.strip()]
+        self.enabled = bool(keys)
+        self._fernets = []
+        self._primary = None
+        self._index_key = None
+        self._preferred = 0  # the key that decrypted the last token, tried first next time
+        self._cache = _LRU(cache_size)
+        self.prefix_token = lru_cache(maxsize=65536)(self._prefix_token)
+        if not keys:
+            return
+        if not index_key:
+            raise PiiConfigError('PII_INDEX_KEY must be set when PII_ENCRYPTION_KEYS is.')
+        from cryptography.fernet import Fernet
+        try:
+            self._fernets = [Fernet(k.encode()) for k in keys]
+        except ValueError as e:
+            raise PiiConfigError(f'Invalid key in PII_ENCRYPTION_KEYS: {e}')
+        self._primary = self._fernets[0]
+        self._index_key = index_key.encode()
+
+    def encrypt(self, value, remember=True):
+        token = self._primary.encrypt(value.encode('utf-8')).decode('ascii')
+        if remember:
+            self._cache.set(token, value)  # whoever wrote it is likely to read it back
+        return token
+
+    def decrypt(self, value, remember=True):
+        if not value.startswith(TOKEN_PREFIX):
+            return value  # written before encryption was enabled
+        plain = self._cache.get(value)
+        if plain is None:
+            plain = self._decrypt(value, remember)
+        return plain
+
+    def _decrypt(self, token, remember):
+        from cryptography.fernet import InvalidToken
+        raw = token.encode('ascii')
+        # Like MultiFernet, but starting from the key that worked last: after a
+        # rotation most rows share one key, so this is usually the first try
+        order = [self._preferred] + [i for i in range(len(self._fernets)) if i != self._preferred]
+        for i in order:
+            try:
+                plain = self._fernets[i].decrypt(raw).decode('utf-8')
+            except InvalidToken:
+                continue
+            self._preferred = i
+            if remember:
+                self._cache.set(token, plain)
+            return plain
+        raise InvalidToken(f'No PII key decrypts this value ({len(self._fernets)} keys configured)')
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def decrypt_many(self, values):
+        """Decrypt a batch (None passes through); duplicates are decrypted once."""
+        seen = {}
+        for value in values:
+            if value is not None and value not in seen:
+                seen[value] = self.decrypt(value)
+        return [None if value is None else seen[value] for value in values]
+
+    def needs_rotation(self, value):
+        if not value.startswith(TOKEN_PREFIX):
+            return True
+        try:
+            self._primary.decrypt(value.encode('ascii'))
+        except Exception:
+            return True
+        return False
+
+    def _digest(self, domain, value):
+        return hmac.new(self._index_key, f"{domain}\0{value}".encode('utf-8'), hashlib.sha256).digest()
+
+    def blind_index(self, field, value):
+        """Equality index of a field value: equal after normalize() <=> equal index."""
+        return self._digest(field, normalize(value)).hex()[:32]
+
+    def _prefix_token(self, prefix):
+        return int.from_bytes(self._digest('prefix', prefix)[:8], 'big', signed=True)
+
+    def tokens(self, *values):
+        """Prefix tokens of every word in values (1..MAX_PREFIX characters)."""
+        tokens = set()
+        for value in values:
+            for word in words(value):
+                for n in range(1, min(len(word), MAX_PREFIX) + 1):
+                    tokens.add(self.prefix_token(word[:n]))
+        return tokens
+
+cipher = PiiCipher()
+
+# Arguments of cipher.configure() for an app config; also handed to the
+# report worker processes, which don't build an app
+def settings(config):
+    return (config['PII_ENCRYPTION_KEYS'].split(','), config['PII_INDEX_KEY'],
+            config['PII_DECRYPT_CACHE_SIZE'])
+
+def init_pii(app):
+    cipher.configure(*settings(app.config))
+
+class EncryptedText(TypeDecorator):
+    """Text column encrypted with the process-wide cipher while it is enabled.
+    Comparisons against the column compare ciphertext: use the blind indexes."""
+    impl = Text
+    cache_ok = True
+
+    def __init__(self, length=None):
+        super().__init__()
+        self.length = length  # of the plaintext: checked by validation, not by the database
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not cipher.enabled:
+            return value
+        return cipher.encrypt(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None or not cipher.enabled:
+            return value
+        return cipher.decrypt(value)
+
+def raw(column):
+    """The stored (possibly encrypted) value of an EncryptedText column, for
+    reading in bulk and decrypting with cipher.decrypt_many()."""
+    return type_coerce(column, Text)
+
+def rotate(connection, batch_size=ROTATE_BATCH):
+    """Re-encrypt every client value not already under the primary key
+    (legacy plaintext included). Returns the number of rows rewritten; the
+    caller rebuilds the blind indexes and recent registrations afterwards."""
+    from models import Client
+    rewritten, cursor = 0, 0
+    while True:
+        rows = connection.execute(
+            select(Client.id, raw(Client.name), raw(Client.contact), raw(Client.address))
+            .where(Client.id > cursor).order_by(Client.id).limit(batch_size)
+        ).all()
+        if not rows:
+            return rewritten
+        cursor = rows[-1][0]
+        for client_id, *fields in rows:
+            if any(v is not None and cipher.needs_rotation(v) for v in fields):
+                name, contact, address = cipher.decrypt_many(fields)
+                # Bound through EncryptedText, so written with the primary key
+                connection.execute(update(Client).where(Client.id == client_id)
+                                   .values(name=name, contact=contact, address=address))
+                rewritten += 1
@@ -0,0 +1,73 @@
+# reads.py
+# Read-only query layer for the JSON API hot paths. Plain Core select()s:
+# rows come back as tuples (no ORM objects, identity map or change
+# tracking), and the program names of each client, or the enrolled client
+# names of each program, are aggregated in SQL, one string per row. The
+# dicts built here have exactly the shapes the ORM-based helpers produced.
+from sqlalchemy import func, select
+from models import db, Client, Doctor, ProgramModel, enrollments
+from pii import cipher, raw
+
+SEPARATOR = '\x1f'  # ASCII unit separator: can't be typed into a name
+
+def _names(value):
+    return value.split(SEPARATOR) if value else []
+
+def _client_programs():
+    return (select(func.aggregate_strings(ProgramModel.name, SEPARATOR))
+            .select_from(enrollments.join(ProgramModel, ProgramModel.id == enrollments.c.program_id))
+            .where(enrollments.c.client_id == Client.id)
+            .scalar_subquery())
+
+def _clients_query():
+    return select(Client.id, Client.name, Client.dob, Client.gender, Client.contact, Client.address,
+                  _client_programs())
+
+def _client_dict(row):
+    client_id, name, dob, gender, contact, address, programs = row
+    return {"id": client_id, "name": name, "dob": dob.isoformat(), "gender": gender,
+            "contact": contact, "address": address, "programs": _names(programs)}
+
+# One keyset page of clients as client_json() dicts: (items, next_cursor);
+# `filters` are extra WHERE clauses on the client table
+def client_page(cursor, limit, session=None, filters=()):
+    session = session or db.session
+    rows = session.execute(
+        _clients_query().where(Client.id > cursor, *filters).order_by(Client.id).limit(limit + 1)
+    ).all()
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    return [_client_dict(row) for row in rows[:limit]], next_cursor
+
+# One client as a client_json() dict, None if it doesn't exist
+def client_profile(client_id, session=None):
+    session = session or db.session
+    row = session.execute(_clients_query().where(Client.id == client_id)).first()
+    return _client_dict(row) if row else None
+
+# Several clients as client_json() dicts, in id order (missing ones left out)
+def clients_by_id(ids, session=None):
+    session = session or db.session
+    rows = session.execute(_clients_query().where(Client.id.in_(ids)).order_by(Client.id)).all()
+    return [_client_dict(row) for row in rows]
+
+# One keyset page of programs with their creator and enrolled client names
+def program_page(cursor, limit, session=None):
+    session = session or db.session
+    # Names are aggregated as stored; encrypted ones are decrypted piecewise
+    enrolled = (select(func.aggregate_strings(raw(Client.name), SEPARATOR))
+                .select_from(enrollments.join(Client, Client.id == enrollments.c.client_id))
+                .where(enrollments.c.program_id == ProgramModel.id)
+                .scalar_subquery())
+    rows = session.execute(
+        select(ProgramModel.id, ProgramModel.name, Doctor.name, enrolled)
+        .outerjoin(Doctor, Doctor.id == ProgramModel.created_by)
+        .where(ProgramModel.id > cursor).order_by(ProgramModel.id).limit(limit + 1)
+    ).all()
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    items = []
+    for program_id, name, creator, clients in rows[:limit]:
+        clients = _names(clients)
+        if cipher.enabled:
+            clients = cipher.decrypt_many(clients)
+        items.append({"id": program_id, "name": name, "created_by": creator, "enrolled_clients": clients})
+    return items, next_cursor
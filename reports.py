@@ -0,0 +1,276 @@
+# reports.py
+# PDF report rendering. Works on a plain SQLAlchemy session so the same code
+# runs inside a request or in a background worker process (see jobs.py).
+#
+# Reports are tables. Rows are read in keyset chunks of CHUNK_SIZE and laid
+# out as short reportlab Tables under a header row repeated on every page;
+# cells wrap only when their text is too wide. reportlab keeps every page of
+# a document (about 15 KB each) until it is saved, so pages are drawn in
+# parts of PART_PAGES pages, each a document of its own that is saved and
+# appended to the output as soon as it is full (_PdfJoiner). Memory is
+# bounded by one chunk and one part, whatever the row count.
+import io
+import re
+from array import array
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+from sqlalchemy import func, select
+from models import Client, Doctor, ProgramModel, enrollments
+from utils import parse_date
+import reads
+
+CHUNK_SIZE = 500
+TABLE_ROWS = 24
+PART_PAGES = 50
+MARGIN = 36
+PADDING = 4
+FONT_SIZE = 8
+
+# Shared ?program= / ?after= filters for the client list and exports, as
+# WHERE clauses. The exports take ?program= as an exact program name and
+# ignore one no program has. The list page passes program_contains=True to
+# match any part of a name, ignoring case (like the client-side filter it
+# used to have), where a name no program contains matches no clients.
+def client_filters(session, program_filter, after_date, program_contains=False):
+    filters = []
+    if program_filter and program_contains:
+        pattern = '%' + re.sub(r'([\\%_])', r'\\\1', program_filter) + '%'
+        # Semi-join through ix_enrollments_program_id
+        filters.append(Client.id.in_(
+            select(enrollments.c.client_id)
+            .join(ProgramModel, ProgramModel.id == enrollments.c.program_id)
+            .where(ProgramModel.name.ilike(pattern, escape='\\'))
+        ))
+    elif program_filter:
+        program_id = session.scalar(select(ProgramModel.id).where(ProgramModel.name == program_filter).limit(1))
+        if program_id is not None:
+            # Semi-join through ix_enrollments_program_id
+            filters.append(Client.id.in_(
+                select(enrollments.c.client_id).where(enrollments.c.program_id == program_id)
+            ))
+
+    if after_date:
+        try:
+            filters.append(Client.dob >= parse_date(after_date))
+        except ValueError:
+            pass  # Ignore bad dates
+    return filters
+
+def filter_clients(session, program_filter, after_date, program_contains=False):
+    return session.query(Client).filter(*client_filters(session, program_filter, after_date, program_contains))
+
+# --- TABLE ENGINE ---
+
+_REF = re.compile(rb'\b(\d+) 0 R\b')
+_ROOT, _INFO, _PAGES = (re.compile(rb'/%s (\d+) 0 R' % key) for key in (b'Root', b'Info', b'Pages'))
+
+class _PdfJoiner:
+    """Writes the pages of whole PDFs saved by reportlab to `out` as one
+    document. Each part's page tree is hung under a shared root and its
+    objects are copied through renumbered, so all that is kept between
+    parts is the file offset of every object written."""
+
+    def __init__(self, out):
+        self.out = out
+        self.position = 0
+        self.offsets = array('Q')  # objects 3.. in number order; 1 is the catalog, 2 the page tree root
+        self.trees, self.pages, self.info = [], 0, None
+        self._write(b'%PDF-1.4\n%\x93\x8c\x8b\x9e\n')
+
+    def _write(self, data):
+        self.out.write(data)
+        self.position += len(data)
+
+    def add(self, data):
+        # reportlab writes objects 1..n in order, then the xref and trailer
+        xref = int(data[data.rindex(b'startxref') + 9:].split()[0])
+        trailer = data.index(b'trailer', xref)
+        lines = data[xref:trailer].split(b'\n')
+        starts = [int(line[:10]) for line in lines[3:2 + int(lines[1].split()[1])]]
+        ends = starts[1:] + [xref]
+        root = int(_ROOT.search(data, trailer).group(1))
+        info = int(_INFO.search(data, trailer).group(1))
+        tree = int(_PAGES.search(data, starts[root - 1]).group(1))
+
+        # The part's catalog is replaced by the shared one, and only the
+        # first part's document info is kept
+        keep = [n for n in range(1, len(starts) + 1) if n != root and (n != info or self.info is None)]
+        numbers = {n: len(self.offsets) + 3 + i for i, n in enumerate(keep)}
+        renumber = lambda m: b'%d 0 R' % numbers[int(m.group(1))]
+        for n in keep:
+            body = data[data.index(b'obj', starts[n - 1]) + 3:data.rindex(b'endobj', 0, ends[n - 1])]
+            head, stream, content = body.partition(b'stream')
+            head = _REF.sub(renumber, head)
+            if n == tree:
+                head = head.replace(b'/Type /Pages', b'/Parent 2 0 R /Type /Pages', 1)
+                self.pages += int(re.search(rb'/Count (\d+)', head).group(1))
+            self.offsets.append(self.position)
+            self._write(b'%d 0 obj' % numbers[n] + head + stream + content + b'endobj\n')
+        self.trees.append(numbers[tree])
+        if self.info is None:
+            self.info = numbers[info]
+
+    def finish(self):
+        catalog = self.position
+        self._write(b'1 0 obj\n<< /Pages 2 0 R /Type /Catalog >>\nendobj\n')
+        pages = self.position
+        kids = b' '.join(b'%d 0 R' % n for n in self.trees)
+        self._write(b'2 0 obj\n<< /Count %d /Kids [ %s ] /Type /Pages >>\nendobj\n' % (self.pages, kids))
+        xref, size = self.position, len(self.offsets) + 3
+        self._write(b'xref\n0 %d\n0000000000 65535 f \n%010d 00000 n \n%010d 00000 n \n' % (size, catalog, pages))
+        for start in range(0, len(self.offsets), 1000):
+            self._write(b''.join(b'%010d 00000 n \n' % o for o in self.offsets[start:start + 1000]))
+        self._write(b'trailer\n<< /Info %d 0 R /Root 1 0 R /Size %d >>\nstartxref\n%d\n%%%%EOF\n'
+                    % (self.info, size, xref))
+
+class _Layout:
+    """Page geometry, styles and the header of one table report, and the
+    part documents its pages are drawn on."""
+
+    def __init__(self, out, pagesize, title, subtitle, columns, widths, part_pages):
+        # reportlab is imported on first render, so importing this module (and
+        # the app) stays cheap for processes that never draw a PDF
+        from reportlab.lib import colors
+        from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+        from reportlab.pdfbase.pdfmetrics import stringWidth
+        from reportlab.pdfgen.canvas import Canvas
+        from reportlab.platypus import Frame, Paragraph, Table, TableStyle
+        self.Canvas, self.Frame, self.Paragraph, self.Table = Canvas, Frame, Paragraph, Table
+        self.stringWidth = stringWidth
+        self.pagesize, self.part_pages, self.page = pagesize, part_pages, 0
+        self.joiner = _PdfJoiner(out)
+        self._new_part()
+        self.width, self.height = pagesize
+        available = self.width - 2 * MARGIN
+        self.widths = [available * w for w in widths]
+        styles = getSampleStyleSheet()
+        self.title = [Paragraph(escape(title), styles['Title']), Paragraph(escape(subtitle), styles['Normal'])]
+        self.cell = ParagraphStyle('cell', parent=styles['Normal'], fontSize=FONT_SIZE, leading=FONT_SIZE + 2)
+        head = ParagraphStyle('head', parent=self.cell, fontName='Helvetica-Bold', textColor=colors.white)
+        grid = [('GRID', (0, 0), (-1, -1), 0.25, colors.grey), ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+                ('FONT', (0, 0), (-1, -1), 'Helvetica', FONT_SIZE, FONT_SIZE + 2),
+                ('LEFTPADDING', (0, 0), (-1, -1), PADDING), ('RIGHTPADDING', (0, 0), (-1, -1), PADDING),
+                ('TOPPADDING', (0, 0), (-1, -1), 2), ('BOTTOMPADDING', (0, 0), (-1, -1), 2)]
+        self.header = Table([[Paragraph(escape(c), head) for c in columns]], colWidths=self.widths,
+                            style=TableStyle(grid + [('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#0d6efd'))]))
+        self.body_style = TableStyle(grid + [('ROWBACKGROUNDS', (0, 0), (-1, -1), [colors.white, colors.HexColor('#f2f4f7')])])
+
+    def _cell(self, value, width):
+        # Plain strings are drawn as they are; only text too wide for its
+        # column pays for a wrapping Paragraph
+        value = str(value)
+        if self.stringWidth(value, 'Helvetica', FONT_SIZE) <= width - 2 * PADDING:
+            return value
+        return self.Paragraph(escape(value), self.cell)
+
+    def tables(self, rows):
+        """The rows as tables of at most TABLE_ROWS rows: splitting a table
+        across pages measures every row left in it again, so keep them short."""
+        for start in range(0, len(rows), TABLE_ROWS):
+            yield self.Table([[self._cell(v, w) for v, w in zip(row, self.widths)]
+                              for row in rows[start:start + TABLE_ROWS]],
+                             colWidths=self.widths, style=self.body_style)
+
+    def new_page(self, first=False):
+        frame = self.Frame(MARGIN, MARGIN, self.width - 2 * MARGIN, self.height - 2 * MARGIN,
+                           leftPadding=0, rightPadding=0, topPadding=0, bottomPadding=0)
+        for flowable in (self.title if first else []) + [self.header]:
+            frame.add(flowable, self.pdf)
+        return frame
+
+    def _new_part(self):
+        self.part = io.BytesIO()
+        self.pdf = self.Canvas(self.part, pagesize=self.pagesize, pageCompression=1)
+
+    def end_page(self, last=False):
+        self.page += 1
+        self.pdf.setFont('Helvetica', FONT_SIZE)
+        self.pdf.drawRightString(self.width - MARGIN, MARGIN / 2, f"Page {self.page}")
+        self.pdf.showPage()
+        if last or self.page % self.part_pages == 0:
+            # The part is full: write it out and let reportlab forget its pages
+            self.pdf.save()
+            self.joiner.add(self.part.getvalue())
+            if last:
+                self.joiner.finish()
+            else:
+                self._new_part()
+
+def render_table(out, title, subtitle, columns, widths, chunks, part_pages=PART_PAGES):
+    """Write a PDF table of the rows in `chunks` (an iterable of row lists)
+    to the binary file `out`, part_pages pages at a time. widths are
+    fractions of the usable page width."""
+    from reportlab.lib.pagesizes import letter
+    layout = _Layout(out, letter, title, subtitle, columns, widths, part_pages)
+    frame, fresh, rows = layout.new_page(first=True), True, 0
+    for chunk in chunks:
+        rows += len(chunk)
+        pending = list(layout.tables(chunk))
+        while pending:
+            flowable = pending.pop(0)
+            if frame.add(flowable, layout.pdf):
+                fresh = False
+                continue
+            # Fill the rest of the page with the rows that fit, then turn it
+            parts = frame.split(flowable, layout.pdf)
+            if parts and frame.add(parts[0], layout.pdf):
+                pending[:0] = parts[1:]
+            elif fresh:
+                raise ValueError('A report row is taller than a page.')
+            else:
+                pending.insert(0, flowable)
+            layout.end_page()
+            frame, fresh = layout.new_page(), True
+    if not rows:
+        frame.add(layout.Paragraph('No records.', layout.cell), layout.pdf)
+    layout.end_page(last=True)
+    return rows
+
+def _generated():
+    return f"Generated {datetime.now(timezone.utc):%Y-%m-%d %H:%M} UTC"
+
+# --- REPORTS ---
+
+def _client_chunks(session, filters, chunk_size):
+    cursor = 0
+    while cursor is not None:
+        clients, cursor = reads.client_page(cursor, chunk_size, session, filters)
+        if clients:
+            yield [(c['name'], c['dob'], c['gender'], c['contact'], ', '.join(c['programs'])) for c in clients]
+
+def render_clients_pdf(session, out, program=None, after=None, chunk_size=CHUNK_SIZE):
+    filters = client_filters(session, program, after)
+    applied = ', '.join(a for a in (program and f"program {program}", after and f"born on or after {after}") if a)
+    subtitle = f"Filters: {applied}. {_generated()}" if applied else _generated()
+    return render_table(out, "Client Registry Report", subtitle,
+                        ["Name", "DOB", "Gender", "Contact", "Programs"], [0.24, 0.11, 0.1, 0.17, 0.38],
+                        _client_chunks(session, filters, chunk_size))
+
+def _program_chunks(session, chunk_size):
+    counts = (select(func.count()).select_from(enrollments)
+              .where(enrollments.c.program_id == ProgramModel.id).scalar_subquery())
+    cursor = 0
+    while True:
+        rows = session.execute(
+            select(ProgramModel.id, ProgramModel.name, Doctor.name, counts)
+            .outerjoin(Doctor, Doctor.id == ProgramModel.created_by)
+            .where(ProgramModel.id > cursor).order_by(ProgramModel.id).limit(chunk_size)
+        ).all()
+        if not rows:
+            return
+        cursor = rows[-1][0]
+        yield [(name, creator or 'Unknown', count) for _, name, creator, count in rows]
+
+def render_programs_pdf(session, out, chunk_size=CHUNK_SIZE):
+    return render_table(out, "Programs Report", _generated(), ["Program", "Created by", "Clients"],
+                        [0.5, 0.35, 0.15], _program_chunks(session, chunk_size))
+
+# Report kinds accepted by the job endpoints, with the query parameters each one takes
+REPORTS = {
+    'clients': (render_clients_pdf, ('program', 'after')),
+    'programs': (render_programs_pdf, ()),
+}
+
+def render_report(kind, session, out, params):
+    render, _ = REPORTS[kind]
+    render(session, out, **params)
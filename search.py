@@ -0,0 +1,208 @@
+# search.py
+# Full-text client search backed by an SQLite FTS5 index over name, contact and
+# address. The index is an external-content table kept in sync with `client`
+# by triggers, so every write path (ORM or bulk SQL) updates it in the same
+# transaction. Databases without FTS5 fall back to a LIKE scan.
+#
+# With PII encryption on (pii.py) neither works on ciphertext: the FTS index is
+# dropped and search runs on HMAC blind indexes instead. Every client gets
+# name_bidx / contact_bidx for exact lookups and one client_token row per word
+# prefix of name, contact and address, written by an on_flush listener in the
+# same transaction as the client. A query intersects its tokens in SQL and
+# only decrypts the candidates when a term is longer than pii.MAX_PREFIX.
+import re
+from sqlalchemy import DDL, bindparam, delete, event, func, insert, or_, select, text, update
+from sqlalchemy.exc import OperationalError
+from changes import on_flush
+from models import db, Client, client_tokens
+from pii import MAX_PREFIX, cipher, raw, words
+
+SEARCH_LIMIT = 100
+
+FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS client_fts USING fts5(
+        name, contact, address,
+        content='client', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS client_fts_ai AFTER INSERT ON client BEGIN
+        INSERT INTO client_fts(rowid, name, contact, address)
+        VALUES (new.id, new.name, new.contact, new.address);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS client_fts_ad AFTER DELETE ON client BEGIN
+        INSERT INTO client_fts(client_fts, rowid, name, contact, address)
+        VALUES ('delete', old.id, old.name, old.contact, old.address);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS client_fts_au AFTER UPDATE OF name, contact, address ON client BEGIN
+        INSERT INTO client_fts(client_fts, rowid, name, contact, address)
+        VALUES ('delete', old.id, old.name, old.contact, old.address);
+        INSERT INTO client_fts(rowid, name, contact, address)
+        VALUES (new.id, new.name, new.contact, new.address);
+    END""",
+]
+
+# Fresh databases get the index together with the client table
+for statement in FTS_DDL:
+    event.listen(Client.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Client.__table__, 'before_drop', DDL("DROP TABLE IF EXISTS client_fts").execute_if(dialect='sqlite'))
+
+def _fts_exists(connection):
+    return connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'client_fts'")
+    ).first() is not None
+
+# Create the index on an existing database if needed; returns whether FTS is usable
+def init_search(engine):
+    if cipher.enabled:
+        # The index would hold plaintext copies of encrypted columns
+        if engine.dialect.name == 'sqlite':
+            with engine.begin() as connection:
+                drop_fts(connection)
+        init_blind_index(engine)
+        return False
+    if engine.dialect.name != 'sqlite':
+        return False
+    try:
+        with engine.begin() as connection:
+            created = not _fts_exists(connection)
+            for statement in FTS_DDL:
+                connection.exec_driver_sql(statement)
+            if created:
+                rebuild(connection)
+    except OperationalError:
+        return False  # SQLite built without FTS5
+    return True
+
+# Re-index every client from the content table (backfill)
+def rebuild(connection):
+    connection.exec_driver_sql("INSERT INTO client_fts(client_fts) VALUES ('rebuild')")
+
+def drop_fts(connection):
+    for name in ('client_fts_ai', 'client_fts_ad', 'client_fts_au'):
+        connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+    connection.exec_driver_sql("DROP TABLE IF EXISTS client_fts")
+
+# Turn free text into an FTS5 query: every word must match as a prefix
+def match_expression(query):
+    terms = re.findall(r'\w+', query)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+# Ranked client ids for `query`, best match first
+def search_client_ids(query, limit=SEARCH_LIMIT, use_fts=True):
+    if use_fts:
+        expression = match_expression(query)
+        if not expression:
+            return []
+        rows = db.session.execute(
+            text("SELECT rowid FROM client_fts WHERE client_fts MATCH :q ORDER BY rank LIMIT :limit"),
+            {"q": expression, "limit": limit}
+        )
+        return [row[0] for row in rows]
+    if cipher.enabled:
+        return blind_search_ids(db.session.connection(), query, limit)
+    # Like the FTS index: every word must appear in the name, contact or address
+    terms = re.findall(r'\w+', query)
+    if not terms:
+        return []
+    rows = db.session.query(Client.id).filter(*(
+        or_(*(column.icontains(term, autoescape=True) for column in (Client.name, Client.contact, Client.address)))
+        for term in terms
+    )).order_by(Client.id).limit(limit)
+    return [row[0] for row in rows]
+
+# Matching Client objects in rank order
+def search_clients(query, limit=SEARCH_LIMIT, use_fts=True, options=()):
+    ids = search_client_ids(query, limit, use_fts)
+    if not ids:
+        return []
+    by_id = {c.id: c for c in Client.query.options(*options).filter(Client.id.in_(ids))}
+    return [by_id[i] for i in ids if i in by_id]
+
+# --- BLIND INDEXES ---
+
+INDEX_BATCH = 1000
+
+def _index_rows(connection, ids):
+    ids = sorted(ids)
+    for start in range(0, len(ids), INDEX_BATCH):
+        chunk = ids[start:start + INDEX_BATCH]
+        rows = connection.execute(
+            select(Client.id, raw(Client.name), raw(Client.contact), raw(Client.address)).where(Client.id.in_(chunk))
+        ).all()
+        updates, tokens = [], []
+        for client_id, *fields in rows:
+            name, contact, address = cipher.decrypt_many(fields)
+            updates.append({'_id': client_id, 'name_bidx': cipher.blind_index('name', name),
+                            'contact_bidx': cipher.blind_index('contact', contact)})
+            tokens.extend({'token': t, 'client_id': client_id} for t in cipher.tokens(name, contact, address))
+        connection.execute(delete(client_tokens).where(client_tokens.c.client_id.in_(chunk)))
+        if updates:
+            connection.execute(update(Client.__table__).where(Client.__table__.c.id == bindparam('_id'))
+                               .values(name_bidx=bindparam('name_bidx'), contact_bidx=bindparam('contact_bidx')),
+                               updates)
+        if tokens:
+            connection.execute(insert(client_tokens), tokens)
+
+# Keep the indexes in step with every client write, in the same transaction
+@on_flush
+def _apply_changes(connection, changes):
+    if not cipher.enabled:
+        return
+    clients = changes.clients
+    if clients['deleted']:
+        connection.execute(delete(client_tokens).where(client_tokens.c.client_id.in_(clients['deleted'])))
+    fresh = (clients['inserted'] | clients['updated']) - clients['deleted']
+    if fresh:
+        _index_rows(connection, fresh)
+
+def reindex(connection):
+    """Rebuild every blind index (after enabling encryption or changing PII_INDEX_KEY)."""
+    connection.execute(delete(client_tokens))
+    ids = connection.scalars(select(Client.id)).all()
+    _index_rows(connection, ids)
+    return len(ids)
+
+def init_blind_index(engine):
+    """Backfill the indexes on startup when encryption is on and they are missing."""
+    with engine.begin() as connection:
+        if (connection.scalar(select(Client.id).limit(1)) is not None
+                and connection.scalar(select(client_tokens.c.client_id).limit(1)) is None):
+            reindex(connection)
+
+# Equality filter on an encrypted field ('name' or 'contact'), compared after
+# pii.normalize() through its blind index; a plain comparison without encryption
+def exact_match(field, value):
+    if cipher.enabled:
+        return getattr(Client, f"{field}_bidx") == cipher.blind_index(field, value)
+    return getattr(Client, field) == value
+
+def blind_search_ids(connection, query, limit):
+    """Client ids matching every word of query as a prefix of some word of
+    name, contact or address, in id order. Only rows that pass the token
+    intersection are decrypted, and only when a term exceeds MAX_PREFIX."""
+    terms = sorted(set(words(query)))
+    if not terms:
+        return []
+    tokens = {cipher.prefix_token(t[:MAX_PREFIX]) for t in terms}
+    long_terms = [t for t in terms if len(t) > MAX_PREFIX]
+    candidates = (select(client_tokens.c.client_id).where(client_tokens.c.token.in_(tokens))
+                  .group_by(client_tokens.c.client_id).having(func.count() == len(tokens))
+                  .order_by(client_tokens.c.client_id))
+    if not long_terms:
+        return connection.scalars(candidates.limit(limit)).all()
+
+    found, cursor = [], 0
+    while len(found) < limit:
+        ids = connection.scalars(candidates.where(client_tokens.c.client_id > cursor).limit(limit * 4)).all()
+        if not ids:
+            break
+        cursor = ids[-1]
+        rows = connection.execute(
+            select(Client.id, raw(Client.name), raw(Client.contact), raw(Client.address))
+            .where(Client.id.in_(ids)).order_by(Client.id)
+        ).all()
+        for client_id, *fields in rows:
+            row_words = [w for value in cipher.decrypt_many(fields) for w in words(value)]
+            if all(any(w.startswith(t) for w in row_words) for t in long_terms):
+                found.append(client_id)
+    return found[:limit]
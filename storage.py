@@ -1,4 +1,423 @@
-# In-memory storage of health programs and clients
+# storage.py
+# In-memory trigram index over client names and contacts, for typo-tolerant
+# lookups ("Wanjru Kamua" finds "Wanjiru Kamau") and for flagging possible
+# duplicate registrations during registration.
+#
+# Two levels, so a query never scans per-client trigram lists:
+#   - a vocabulary of the distinct name words (and contact numbers, as their
+#     last 9 digits, so "+254712345678" and "0712345678" are one entry), with
+#     a trigram inverted index over it (padded like pg_trgm: "  w", " wa", ...);
+#   - per vocabulary entry, the ids of the clients whose name or contact
+#     contains it, in compact int arrays.
+# A query word is matched against the vocabulary first (tens of thousands of
+# entries rather than millions of clients); the clients of its similar words
+# are then scored word by word from their stored word ids.
+#
+# Each worker warms its own copy from the database in a background thread
+# started by its first request, then follows its own commits through the
+# change feed. The same thread pulls clients registered by other workers;
+# for their edits and deletes, results are read back from the database,
+# which drops deleted clients and rescores names (see app.indexed_clients).
+import math
+import re
+import threading
+import time
+from array import array
+from collections import Counter
+from sqlalchemy import select
+from changes import on_commit
+from models import db, Client, DataVersion
+from pii import normalize
 
-clients = {}  # Dictionary to store clients with client_id as key
-health_programs = []  # List of available health programs
+CONTACT_DIGITS = 9
+NAME_THRESHOLD = 0.3   # default for search(): mean similarity of the query words
+WORD_THRESHOLD = 0.3   # vocabulary words at least this close count as a match
+DRIVER_LIMIT = 5000    # candidate postings read before narrowing by a second word
+MATCH_CACHE_SIZE = 20000  # query words whose similar vocabulary entries are remembered
+_WORD = re.compile(r'\w+')
+
+def name_words(value):
+    return _WORD.findall(normalize(value))
+
+def contact_digits(value):
+    return re.sub(r'\D', '', value or '')[-CONTACT_DIGITS:]
+
+def _contact_token(digits):
+    return f"#{digits}"
+
+def grams(token):
+    """Trigrams of a vocabulary entry: padded for words, plain for numbers."""
+    padded = token if token.startswith('#') else f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def similarity(a, b):
+    """Jaccard similarity of two trigram sets."""
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+def _name_score(matches, words):
+    # Each query word's best match among the client's words, averaged over
+    # the longer of the two names
+    if not words:
+        return 0.0
+    total = 0.0
+    for m in matches:
+        best = 0.0
+        for word in words:
+            score = m.get(word)
+            if score is not None and score > best:
+                best = score
+        total += best
+    return total / max(len(matches), len(words))
+
+def name_similarity(query, name):
+    """Score of a client name against a query, as search() computes it."""
+    words = list(dict.fromkeys(name_words(name)))
+    matches = []
+    for token in dict.fromkeys(name_words(query)):
+        scores = {word: similarity(grams(token), grams(word)) for word in words}
+        matches.append({word: score for word, score in scores.items() if score >= WORD_THRESHOLD})
+    return _name_score(matches, words) if matches else 0.0
+
+class ClientIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+        self.enabled = False
+        self.ready = threading.Event()
+        self.version = None    # client data version last seen by catch_up()
+        self.watermark = 0     # highest client id catch_up() has loaded
+        self._warming = False
+        self._pending = set()  # ids committed while a warm was running
+        self._sync = None
+
+    def _reset(self):
+        self._vocab = {}       # word or '#digits' -> entry id
+        self._tokens = []      # entry id -> word or '#digits'
+        self._sizes = array('i')  # entry id -> number of trigrams
+        self._gram_entries = {}   # trigram -> entry ids
+        self._clients = []     # entry id -> client ids (may hold stale ids until compacted)
+        self._records = {}     # client id -> (name entry ids, contact entry id, dob ordinal)
+        self._matches = {}     # (token, threshold) -> (vocabulary size, similar_entries)
+        self._garbage = 0
+        self._entries = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+            self.watermark = 0
+            self.version = None
+
+    # --- WRITES ---
+
+    def _entry(self, token):
+        entry = self._vocab.get(token)
+        if entry is None:
+            entry = self._vocab[token] = len(self._clients)
+            self._tokens.append(token)
+            token_grams = grams(token)
+            self._sizes.append(len(token_grams))
+            self._clients.append(array('i'))
+            for gram in token_grams:
+                posting = self._gram_entries.get(gram)
+                if posting is None:
+                    posting = self._gram_entries[gram] = array('i')
+                posting.append(entry)
+        return entry
+
+    def _add(self, client_id, name, contact, dob):
+        digits = contact_digits(contact)
+        words = tuple(dict.fromkeys(self._entry(w) for w in name_words(name)))
+        record = (words, self._entry(_contact_token(digits)) if digits else -1, dob.toordinal() if dob else 0)
+        entries = set(words) | {record[1]} - {-1}
+        previous = self._records.get(client_id)
+        if previous is not None:
+            old = set(previous[0]) | {previous[1]} - {-1}
+            self._garbage += len(old - entries)
+            entries -= old  # still listed from before
+        self._records[client_id] = record
+        for entry in entries:
+            self._clients[entry].append(client_id)
+        self._entries += len(entries)
+
+    def add(self, rows):
+        """Insert or replace (id, name, contact, dob) rows."""
+        with self._lock:
+            for row in rows:
+                self._add(*row)
+            self._maybe_compact()
+
+    def remove(self, ids):
+        with self._lock:
+            for client_id in ids:
+                record = self._records.pop(client_id, None)
+                if record is not None:
+                    self._garbage += len(record[0]) + (record[1] >= 0)
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        # Stale client ids only cost a lookup each; rebuild once they pile up
+        if self._garbage > max(10000, self._entries // 2):
+            clients = [array('i') for _ in self._clients]
+            for client_id, (words, contact, _) in self._records.items():
+                for entry in words:
+                    clients[entry].append(client_id)
+                if contact >= 0:
+                    clients[contact].append(client_id)
+            self._clients = clients
+            self._entries = sum(len(c) for c in clients)
+            self._garbage = 0
+
+    # --- READS ---
+
+    def similar_entries(self, token, threshold=WORD_THRESHOLD):
+        """{entry id: similarity} of the vocabulary entries close to token."""
+        entry = self._vocab.get(token)
+        if threshold >= 1:
+            return {entry: 1.0} if entry is not None else {}
+        # Names follow a long tail, but the common words recur in most queries.
+        # The vocabulary only grows, so a remembered answer just needs the
+        # entries added since checking.
+        size = len(self._tokens)
+        cached = self._matches.get((token, threshold))
+        if cached is not None and size - cached[0] < 1000:
+            found = dict(cached[1])
+            query = grams(token)
+            for candidate in range(cached[0], size):
+                score = similarity(query, grams(self._tokens[candidate]))
+                if score >= threshold:
+                    found[candidate] = score
+        else:
+            found = self._similar_entries(token, threshold)
+        if cached is None or cached[0] != size:
+            if len(self._matches) >= MATCH_CACHE_SIZE:
+                self._matches.clear()
+            self._matches[(token, threshold)] = (size, found)
+        return found
+
+    def _similar_entries(self, token, threshold):
+        query = grams(token)
+        postings = sorted((self._gram_entries.get(g, ()) for g in query), key=len)
+        # An entry with Jaccard >= threshold shares at least `need` trigrams
+        # with the query, so it is listed under one of the len - need + 1 rarest
+        n = len(query)
+        need = max(1, math.ceil(threshold * n))
+        skipped = need - 1
+        counts = Counter()
+        for posting in postings[:n - skipped]:
+            counts.update(posting)
+        common = None  # the lists not scanned, as sets, to complete the exact overlap
+        sizes, found = self._sizes, {}
+        for candidate, seen in counts.items():
+            size = sizes[candidate]
+            # Bound from the lists scanned before computing the exact score
+            best = seen + skipped if seen + skipped < size else size
+            if best < threshold * (n + size - best):
+                continue
+            if common is None:
+                common = [set(posting) for posting in postings[n - skipped:]]
+            shared = seen + sum(1 for posting in common if candidate in posting)
+            score = shared / (n + size - shared)
+            if score >= threshold:
+                found[candidate] = score
+        return found
+
+    def _candidates(self, matches):
+        """Client ids listed under the matches of the most selective query word
+        (narrowed by the next one when that is still a long list)."""
+        clients = self._clients
+        by_size = sorted(matches, key=lambda m: sum(len(clients[e]) for e in m))
+        driver = by_size[0]
+        if sum(len(clients[e]) for e in driver) > DRIVER_LIMIT and len(by_size) > 1:
+            second = set()
+            for entry in by_size[1]:
+                second.update(clients[entry])
+            return {c for e in driver for c in clients[e] if c in second}
+        return {c for e in driver for c in clients[e]}
+
+    def search(self, query, limit=10, threshold=NAME_THRESHOLD, field='name'):
+        """[(client_id, score)] best first. A name scores the mean, over the
+        longer of query and client name, of each word's best word match."""
+        if field == 'contact':
+            digits = contact_digits(query)
+            if len(digits) < 3:
+                return []
+            matches = self.similar_entries(_contact_token(digits), threshold)
+            records = self._records
+            results = {}
+            for entry, score in matches.items():
+                for client_id in self._clients[entry]:
+                    record = records.get(client_id)
+                    if record is not None and record[1] == entry:
+                        results[client_id] = score
+            return sorted(results.items(), key=lambda r: (-r[1], r[0]))[:limit]
+        return self._search_name(name_words(query), threshold, limit)
+
+    def _search_name(self, words, threshold, limit, exclude=()):
+        words = list(dict.fromkeys(words))
+        if not words:
+            return []
+        matches = [self.similar_entries(w) for w in words]
+        # Words without any close vocabulary entry score 0 for every client
+        if sum(1 for m in matches if m) / len(words) < threshold:
+            return []
+        candidates = self._candidates([m for m in matches if m])
+        records, results = self._records, []
+        for client_id in candidates:
+            record = records.get(client_id)
+            if record is None or client_id in exclude:
+                continue
+            score = _name_score(matches, record[0])
+            if score >= threshold:
+                results.append((client_id, score))
+        results.sort(key=lambda r: (-r[1], r[0]))
+        return results[:limit]
+
+    def possible_duplicates(self, name, contact=None, dob=None, limit=5, exclude=()):
+        """Clients that look like the same person: same contact number, a very
+        similar name, or a similar name with the same date of birth.
+        Returns [(client_id, score, reasons)], most likely first."""
+        words = name_words(name)
+        found = {client_id: [score, []] for client_id, score in self._search_name(words, 0.5, limit * 4, exclude)}
+        digits = contact_digits(contact)
+        if len(digits) >= 7:
+            matches = [self.similar_entries(w) for w in dict.fromkeys(words)]
+            for client_id, _ in self.search(digits, limit * 4, 1.0, 'contact'):
+                record = self._records.get(client_id)
+                if record is not None and client_id not in exclude:
+                    found.setdefault(client_id, [_name_score(matches, record[0]), []])[1].append('contact')
+        ordinal = dob.toordinal() if dob else None
+        results = []
+        for client_id, (score, reasons) in found.items():
+            record = self._records.get(client_id)
+            if record is None:
+                continue
+            if ordinal and record[2] == ordinal:
+                reasons.append('dob')
+            if score >= 0.8:
+                reasons.append('name')
+            elif score >= 0.5 and 'dob' in reasons:
+                reasons.append('similar name')
+            if 'contact' in reasons or 'name' in reasons or 'similar name' in reasons:
+                weight = score + 0.5 * ('contact' in reasons) + 0.3 * ('dob' in reasons)
+                results.append((client_id, round(score, 3), sorted(reasons), weight))
+        results.sort(key=lambda r: (-r[3], r[0]))
+        return [r[:3] for r in results[:limit]]
+
+    # --- LOADING ---
+
+    def warm(self, engine, batch_size=5000):
+        """(Re)build from the database, then swap in. Commits that land
+        meanwhile are replayed from the database afterwards."""
+        fresh = ClientIndex()
+        with self._lock:
+            self._warming = True
+            self._pending = set()
+        try:
+            with engine.connect() as connection:
+                version = _client_version(connection)
+                result = connection.execution_options(yield_per=batch_size).execute(_rows_query())
+                for rows in result.partitions():
+                    fresh.add(rows)
+            with self._lock:
+                for name in ('_vocab', '_tokens', '_sizes', '_gram_entries', '_clients', '_records',
+                             '_matches', '_garbage', '_entries'):
+                    setattr(self, name, getattr(fresh, name))
+                self.watermark = max(fresh._records, default=0)
+                self.version = version
+                pending, self._pending, self._warming = self._pending, set(), False
+        except BaseException:
+            with self._lock:
+                self._warming = False
+            raise
+        if pending:
+            self.refresh(engine, pending)
+        self.ready.set()
+        return len(self._records)
+
+    def refresh(self, engine, ids):
+        """Reload the given clients from the database (missing ones are removed)."""
+        ids = sorted(ids)
+        with self._lock:
+            if self._warming:
+                self._pending.update(ids)
+                return
+        rows = []
+        with engine.connect() as connection:
+            for start in range(0, len(ids), 1000):
+                rows.extend(connection.execute(_rows_query().where(Client.id.in_(ids[start:start + 1000]))).all())
+        with self._lock:
+            self.remove(set(ids) - {row[0] for row in rows})
+            self.add(rows)
+
+    def catch_up(self, engine):
+        """Load clients registered since the last look, by any process."""
+        with engine.connect() as connection:
+            version = _client_version(connection)
+            if version == self.version or self._warming:
+                return 0
+            rows = connection.execute(_rows_query().where(Client.id > self.watermark)).all()
+        self.add(rows)
+        self.watermark = max([self.watermark] + [row[0] for row in rows])
+        self.version = version
+        return len(rows)
+
+    def start(self, engine, sync_seconds):
+        """Warm and then keep up with other workers from a background thread
+        (one per process: a thread started before a fork doesn't survive it)."""
+        with self._lock:
+            if self._sync is not None and self._sync.is_alive():
+                return
+            self.ready.clear()
+            self._sync = threading.Thread(target=self._run, args=(engine, sync_seconds),
+                                          name='client-index', daemon=True)
+            self._sync.start()
+
+    def _run(self, engine, sync_seconds):
+        while not self.ready.is_set():
+            try:
+                self.warm(engine)
+            except Exception:
+                time.sleep(sync_seconds)
+        while True:
+            time.sleep(sync_seconds)
+            try:
+                self.catch_up(engine)
+            except Exception:
+                continue
+
+def _rows_query():
+    return select(Client.id, Client.name, Client.contact, Client.dob)
+
+def _client_version(connection):
+    return connection.scalar(select(DataVersion.version).where(DataVersion.table_name == 'client')) or 0
+
+client_index = ClientIndex()
+
+def init_client_index(app):
+    """Tests warm synchronously; served apps warm on their first request
+    (see start_client_index), in each worker rather than the preloading master."""
+    client_index.enabled = app.config['CLIENT_INDEX']
+    if client_index.enabled and app.testing:
+        client_index.warm(db.engine)
+
+def start_client_index(app):
+    if client_index.enabled and not app.testing:
+        client_index.start(db.engine, app.config['CLIENT_INDEX_SYNC_SECONDS'])
+
+# Follow this process's own writes as soon as they commit
+@on_commit
+def _apply_changes(changes):
+    if not client_index.enabled:
+        return
+    clients = changes.clients
+    if clients['deleted']:
+        client_index.remove(clients['deleted'])
+    fresh = (clients['inserted'] | clients['updated']) - clients['deleted']
+    if fresh:
+        client_index.refresh(db.engine, fresh)
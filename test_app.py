@@ -1,23 +1,37 @@
 import pytest
-from app import app, db
-from models import Doctor
+import json
+import os
+import tempfile
+import time
+from app import create_app, get_mail
+from models import db, Doctor
+from cache import cache
+from storage import client_index
+from archive import init_archive, store as archive_store
+
+# Configure app for testing
+app = create_app({
+    'TESTING': True,
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',  # Use in-memory DB for testing
+    'WTF_CSRF_ENABLED': False,
+    'ARCHIVE_PATH': os.path.join(tempfile.mkdtemp(), 'archive.db'),
+})
 
 @pytest.fixture
 def client():
-    # Setup: configure app for testing
-    app.config['TESTING'] = True
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'  # Use in-memory DB for testing
-    app.config['WTF_CSRF_ENABLED'] = False
-
     # Create test client
     with app.test_client() as client:
         with app.app_context():
             db.create_all()
+        client_index.clear()
+        init_archive(app)  # apps built by other tests repoint the process-wide archive
         yield client  # provide client to tests
 
     # Teardown: clean up
     with app.app_context():
         db.drop_all()
+    cache.clear()
+    archive_store.clear()
 
 def test_home_redirect(client):
     """Test if '/' redirects to login page."""
@@ -92,3 +106,1085 @@ def test_generate_pdf(client):
     response = client.get('/download-clients-pdf')
     assert response.status_code == 200
     assert response.mimetype == 'application/pdf'
+
+def test_api_clients_keyset_pagination(client):
+    """Test paging through /api/clients with limit and cursor."""
+    for i in range(5):
+        client.post('/api/create-client', json={
+            'first_name': 'Page', 'last_name': f'Client{i}', 'dob': '1990-01-01',
+            'gender': 'Female', 'contact': '0700000000', 'address': 'page@example.com'
+        })
+
+    response = client.get('/api/clients?limit=2')
+    assert response.status_code == 200
+    assert len(response.get_json()) == 2
+    page = response.get_json()
+
+    while 'X-Next-Cursor' in response.headers:
+        response = client.get(f"/api/clients?limit=2&cursor={response.headers['X-Next-Cursor']}")
+        page += response.get_json()
+    ids = [c['id'] for c in page]
+    assert ids == sorted(ids)
+    assert len([c for c in page if c['name'].startswith('Page ')]) == 5
+
+    assert client.get('/api/clients?limit=abc').status_code == 400
+
+def test_download_clients_csv_streams(client):
+    """Test the CSV export is streamed and honours the program filter."""
+    client.post('/api/create-client', json={
+        'first_name': 'Csv', 'last_name': 'Row', 'dob': '1990-01-01',
+        'gender': 'Male', 'contact': '0711111111', 'address': 'csv@example.com'
+    })
+    response = client.get('/download-clients-csv')
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == 'text/csv'
+    body = response.get_data(as_text=True)
+    assert body.startswith('Name,DOB,Gender,Contact,Address,Programs')
+    assert 'Csv Row' in body
+
+    response = client.get('/download-clients-csv?program=No Such Program&after=not-a-date')
+    assert response.status_code == 200
+
+def test_report_job_cached_by_data_version(client):
+    """Test report jobs reuse the cached PDF until the data changes."""
+    response = client.post('/api/reports/programs')
+    assert response.status_code in (200, 202)
+    job = response.get_json()['job_id']
+    assert client.post('/api/reports/programs').get_json()['job_id'] == job
+
+    for _ in range(50):
+        status = client.get(f'/api/reports/jobs/{job}').get_json()['status']
+        if status == 'done':
+            break
+        time.sleep(0.2)
+    assert status == 'done'
+    response = client.get(f'/api/reports/jobs/{job}/download')
+    assert response.mimetype == 'application/pdf'
+    response.close()
+
+    client.post('/api/create-client', json={
+        'first_name': 'New', 'last_name': 'Version', 'dob': '1990-01-01',
+        'gender': 'Male', 'contact': '0722222222', 'address': 'v@example.com'
+    })
+    assert client.post('/api/reports/programs').get_json()['job_id'] != job
+    assert client.get('/api/reports/jobs/not-a-job').status_code == 404
+
+def test_pending_report_download_redirects_browsers_and_prune_drops_stale_markers(client, monkeypatch):
+    """Test a browser waiting on a slow render gets the polling page and old job markers are pruned."""
+    import app as app_module
+    import jobs
+    with app.test_request_context():
+        cache_dir = app_module.report_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    job = 'ab' * 12
+    with open(os.path.join(cache_dir, f'{job}.pending'), 'w') as f:
+        f.write(str(time.time()))
+    monkeypatch.setattr(app_module, 'start_report', lambda kind, params: job)
+
+    response = client.get('/download-clients-pdf', headers={'Accept': 'text/html,application/xhtml+xml,*/*;q=0.8'})
+    assert response.status_code == 302
+    assert f'/reports/jobs/{job}' in response.location
+    page = client.get(response.location)
+    assert page.status_code == 200
+    assert f'/api/reports/jobs/{job}'.encode() in page.data
+    assert client.get('/download-clients-pdf').status_code == 202
+
+    stale = [os.path.join(cache_dir, name) for name in (f'{job}.pending', f'{job}.123.tmp')]
+    open(stale[1], 'w').close()
+    fresh = os.path.join(cache_dir, f"{'cd' * 12}.pending")
+    open(fresh, 'w').close()
+    for path in stale:
+        os.utime(path, (time.time() - 7200, time.time() - 7200))
+    jobs.prune(cache_dir, 3600)
+    assert not any(os.path.exists(path) for path in stale)
+    assert os.path.exists(fresh)
+    os.remove(fresh)
+
+def test_api_search_clients_prefix(client):
+    """Test full-text client search with prefix matching."""
+    client.post('/api/create-client', json={
+        'first_name': 'Wanjiru', 'last_name': 'Kamau', 'dob': '1985-06-01',
+        'gender': 'Female', 'contact': '+254700123456', 'address': 'wanjiru@example.com'
+    })
+    response = client.get('/api/clients/search?q=wanj')
+    assert response.status_code == 200
+    assert [c['name'] for c in response.get_json()] == ['Wanjiru Kamau']
+    assert client.get('/api/clients/search?q=kam wan').get_json()[0]['name'] == 'Wanjiru Kamau'
+    assert client.get('/api/clients/search?q=nobodyhere').get_json() == []
+
+    # Without FTS5 the LIKE scan covers the same columns
+    from search import search_client_ids
+    with app.app_context():
+        client_id = search_client_ids('wanj')[0]
+        assert search_client_ids('kamau', use_fts=False) == [client_id]
+        assert search_client_ids('700123', use_fts=False) == [client_id]
+        assert search_client_ids('example.com wanjiru', use_fts=False) == [client_id]
+        assert search_client_ids('kamau 0799', use_fts=False) == []
+        assert search_client_ids('wan_iru', use_fts=False) == []
+
+def test_dashboard_data_aggregates(client):
+    """Test dashboard aggregates follow client, program and enrollment writes."""
+    client.post('/signup', data={'username': 'aggdoc', 'name': 'Agg Doctor', 'password': 'password123'})
+    before = client.get('/api/dashboard-data').get_json()
+
+    client.post('/api/create-program', json={'name': 'Aggregate Program'})
+    client.post('/api/create-client', json={
+        'first_name': 'Agg', 'last_name': 'Client', 'dob': '1990-01-01',
+        'gender': 'Male', 'contact': '0733333333', 'address': 'agg@example.com'
+    })
+    data = client.get('/api/dashboard-data').get_json()
+    assert data['total_clients'] == before['total_clients'] + 1
+    assert data['total_programs'] == before['total_programs'] + 1
+    assert data['recent_clients'][0]['name'] == 'Agg Client'
+
+    program_id = client.get('/api/programs?limit=1000').get_json()[-1]['id']
+    client_id = data['recent_clients'][0]['id']
+    client.post('/api/enroll-client', json={'client_id': client_id, 'program_ids': [program_id]})
+    programs = {p['name']: p['client_count'] for p in client.get('/api/dashboard-data').get_json()['programs']}
+    assert programs['Aggregate Program'] == 1
+
+    client.delete(f'/api/delete-client/{client_id}')
+    data = client.get('/api/dashboard-data').get_json()
+    assert {p['name']: p['client_count'] for p in data['programs']}['Aggregate Program'] == 0
+    assert data['total_clients'] == before['total_clients']
+
+def test_stream_requires_login_and_commits_publish(client):
+    """Test the SSE endpoint is login-only and committed writes reach the hub."""
+    from broadcast import hub
+
+    assert client.get('/api/stream').status_code == 401
+
+    last_seq = hub.seq
+    client.post('/api/create-client', json={
+        'first_name': 'Live', 'last_name': 'Update', 'dob': '1990-01-01',
+        'gender': 'Female', 'contact': '0744444444', 'address': 'live@example.com'
+    })
+    events = hub.events_since(last_seq, timeout=1)
+    assert events and events[-1][1] == 'change'
+    assert events[-1][2]['clients']['inserted']
+
+    stream = hub.stream(last_seq)
+    assert next(stream).startswith('retry:')
+    assert next(stream).startswith(f'id: {last_seq + 1}\nevent: change')
+
+    # Each open stream holds a request thread: past the cap, 503 and poll
+    with client.session_transaction() as sess:
+        sess['logged_in'] = True
+    limit = app.config['STREAM_MAX_SUBSCRIBERS']
+    app.config['STREAM_MAX_SUBSCRIBERS'] = hub.subscribers + 1
+    try:
+        first = client.get('/api/stream')
+        assert first.status_code == 200
+        second = client.get('/api/stream')
+        assert second.status_code == 503
+        assert second.headers['Retry-After'] == str(app.config['STREAM_RETRY_SECONDS'])
+        first.close()
+        third = client.get('/api/stream')
+        assert third.status_code == 200
+        third.close()
+    finally:
+        app.config['STREAM_MAX_SUBSCRIBERS'] = limit
+
+def test_stream_server_holds_many_idle_subscribers(tmp_path):
+    """Test the gevent stream server keeps hundreds of streams open in one worker and fans writes out to them."""
+    pytest.importorskip('gevent')
+    import socket
+    import subprocess
+    import sys
+    from sqlalchemy import create_engine, inspect
+    from versions import bump
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    url = f"sqlite:///{tmp_path / 'stream.db'}"
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, DATABASE_URL=url, SECRET_KEY=app.config['SECRET_KEY'], STREAM_PORT=str(port),
+               STREAM_POLL_SECONDS='1', GUNICORN_GRACEFUL_TIMEOUT='1')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn_stream.conf.py', 'wsgi:app'],
+                              cwd=here, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    cookie = app.session_interface.get_signing_serializer(app).dumps({'logged_in': True})
+    engine, streams = create_engine(url), []
+    try:
+        for _ in range(100):  # the worker creates the tables before it listens
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        def read_until(stream, marker):
+            data = b''
+            while marker not in data:
+                data += stream.recv(4096)
+            return data
+
+        # Far more than the threaded server's per-process cap
+        for _ in range(200):
+            stream = socket.create_connection(('127.0.0.1', port), timeout=10)
+            stream.sendall(f"GET /api/stream HTTP/1.1\r\nHost: x\r\nCookie: session={cookie}\r\n\r\n".encode())
+            streams.append(stream)
+        for stream in streams:
+            assert read_until(stream, b'retry:').startswith(b'HTTP/1.1 200')
+
+        # A write committed by a web worker reaches every subscriber
+        assert 'data_version' in inspect(engine).get_table_names()
+        with engine.begin() as connection:
+            bump(connection, 'client')
+        for stream in streams:
+            assert b'"tables": ["client"]' in read_until(stream, b'event: change')
+    finally:
+        for stream in streams:
+            stream.close()
+        server.terminate()
+        server.wait(timeout=30)
+        engine.dispose()
+
+def test_bulk_import_clients(client):
+    """Test bulk NDJSON and CSV import with per-row errors and enrollments."""
+    client.post('/signup', data={'username': 'importdoc', 'name': 'Import Doctor', 'password': 'password123'})
+    client.post('/api/create-program', json={'name': 'Import Program'})
+
+    ndjson = '\n'.join([
+        '{"first_name": "Bulk", "last_name": "One", "dob": "1991-02-03", "gender": "Female", "contact": "0755555555", "email": "one@example.com", "programs": ["Import Program"]}',
+        '{"name": "Bulk Two", "dob": "03/02/1991", "gender": "Male", "contact": "0755555556", "address": "two@example.com"}',
+        '{"name": "Bulk Three", "dob": "1991-02-03", "gender": "Male", "contact": "0755555557", "address": "three@example.com", "programs": ["Nope"]}',
+        'not json',
+    ])
+    response = client.post('/api/clients/import', data=ndjson, content_type='application/x-ndjson')
+    result = response.get_json()
+    assert response.status_code == 200
+    assert (result['inserted'], result['enrolled'], result['rejected']) == (1, 1, 3)
+    assert [e['row'] for e in result['errors']] == [2, 3, 4]
+
+    csv_body = 'name,dob,gender,contact,address,programs\nBulk Csv,1992-01-01,Male,0766666666,csv@example.com,Import Program\n'
+    result = client.post('/api/clients/import', data=csv_body, content_type='text/csv').get_json()
+    assert (result['inserted'], result['enrolled'], result['rejected']) == (1, 1, 0)
+
+    programs = {p['name']: p['client_count'] for p in client.get('/api/dashboard-data').get_json()['programs']}
+    assert programs['Import Program'] == 2
+    assert client.get('/api/clients/search?q=bulk').get_json()
+
+def test_bulk_enrollment_delta(client):
+    """Test bulk enroll/unenroll skips duplicates and reports affected counts."""
+    client.post('/signup', data={'username': 'bulkdoc', 'name': 'Bulk Doctor', 'password': 'password123'})
+    client.post('/api/create-program', json={'name': 'Cohort A'})
+    client.post('/api/create-program', json={'name': 'Cohort B'})
+    programs = {p['name']: p['id'] for p in client.get('/api/programs?limit=1000').get_json()}
+    ndjson = '\n'.join(
+        f'{{"name": "Cohort Member {i}", "dob": "1990-01-01", "gender": "Male", "contact": "07{i}", "address": "c{i}@example.com"}}'
+        for i in range(3)
+    )
+    client.post('/api/clients/import', data=ndjson, content_type='application/x-ndjson')
+    client_ids = [c['id'] for c in client.get('/api/clients/search?q=cohort').get_json()]
+
+    body = {'client_ids': client_ids, 'add': [programs['Cohort A'], programs['Cohort B']]}
+    assert client.post('/api/enrollments/bulk', json=body).get_json() == {'enrolled': 6, 'unenrolled': 0}
+    assert client.post('/api/enrollments/bulk', json=body).get_json() == {'enrolled': 0, 'unenrolled': 0}
+
+    body = {'client_ids': client_ids[:2], 'remove': [programs['Cohort B']]}
+    assert client.post('/api/enrollments/bulk', json=body).get_json() == {'enrolled': 0, 'unenrolled': 2}
+    counts = {p['name']: p['client_count'] for p in client.get('/api/dashboard-data').get_json()['programs']}
+    assert (counts['Cohort A'], counts['Cohort B']) == (3, 1)
+
+    body = {'client_ids': client_ids, 'add': [programs['Cohort A']], 'remove': [programs['Cohort A']]}
+    assert client.post('/api/enrollments/bulk', json=body).status_code == 400
+
+def test_upgrade_legacy_database(tmp_path):
+    """Test migrating a legacy database: enrollments key, indexes and DATE dob."""
+    import sqlite3
+    from cryptography.fernet import Fernet
+    from sqlalchemy import create_engine, inspect
+    from migrations import LATEST, current_version, stamp, upgrade
+    from pii import cipher
+
+    def legacy_engine(name):
+        path = tmp_path / name
+        legacy = sqlite3.connect(path)
+        legacy.executescript("""
+            CREATE TABLE doctor (id INTEGER PRIMARY KEY, username VARCHAR(50), password VARCHAR(128), name VARCHAR(100));
+            CREATE TABLE client (id INTEGER PRIMARY KEY, name VARCHAR(100), dob VARCHAR(20), gender VARCHAR(20),
+                                 contact VARCHAR(50), address VARCHAR(200));
+            CREATE TABLE program_model (id INTEGER PRIMARY KEY, name VARCHAR(100), created_by INTEGER);
+            CREATE TABLE enrollments (client_id INTEGER, program_id INTEGER);
+            INSERT INTO client VALUES (1, 'Old Client', '1990-05-06', 'Male', '0700', 'a@example.com');
+            INSERT INTO client VALUES (2, 'Slash Date', '06/05/1991', 'Female', '0701', 'b@example.com');
+            INSERT INTO program_model VALUES (1, 'TB', 1);
+            INSERT INTO enrollments VALUES (1, 1), (1, 1), (2, 1);
+        """)
+        legacy.commit()
+        legacy.close()
+        return create_engine(f'sqlite:///{path}')
+
+    engine = legacy_engine('legacy.db')
+    assert upgrade(engine) == list(range(1, LATEST + 1))
+    assert upgrade(engine) == []
+
+    with engine.connect() as connection:
+        assert current_version(connection) == LATEST
+        assert connection.exec_driver_sql('SELECT count(*) FROM enrollments').scalar() == 2
+        assert connection.exec_driver_sql('SELECT dob FROM client WHERE id = 2').scalar() == '1991-05-06'
+        inspector = inspect(connection)
+        assert inspector.get_pk_constraint('enrollments')['constrained_columns'] == ['client_id', 'program_id']
+        assert {'ix_client_name', 'ix_client_dob'} <= {i['name'] for i in inspector.get_indexes('client')}
+        assert 'ix_enrollments_program_id' in {i['name'] for i in inspector.get_indexes('enrollments')}
+        # Clients of an upgraded database count as active from the upgrade on
+        assert connection.exec_driver_sql('SELECT count(*) FROM client WHERE updated_at IS NULL').scalar() == 0
+        # Migration 1 builds its own schema; later columns come from later migrations
+        v1_sql = connection.exec_driver_sql("SELECT sql FROM sqlite_master WHERE name = 'client'").scalar()
+        assert v1_sql.startswith('CREATE TABLE "client" (id INTEGER NOT NULL, name VARCHAR(100) NOT NULL')
+
+    # Under encryption client.name is ciphertext: no index on it
+    cipher.configure([Fernet.generate_key().decode()], 'index-secret')
+    try:
+        engine = legacy_engine('encrypted.db')
+        upgrade(engine)
+        with engine.connect() as connection:
+            indexes = {i['name'] for i in inspect(connection).get_indexes('client')}
+        assert 'ix_client_dob' in indexes and 'ix_client_name' not in indexes
+    finally:
+        cipher.configure([])
+
+    # create_all() leaves ix_client_name to the migrations; a fresh database gets it when stamped
+    engine = create_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+    db.metadata.create_all(engine)
+    assert 'ix_client_name' not in {i['name'] for i in inspect(engine).get_indexes('client')}
+    stamp(engine)
+    assert 'ix_client_name' in {i['name'] for i in inspect(engine).get_indexes('client')}
+
+def test_client_profile_cache_invalidation(client, tmp_path):
+    """Test cached client profiles are served until a commit changes them."""
+    client.post('/api/create-client', json={
+        'first_name': 'Cached', 'last_name': 'Client', 'dob': '1990-01-01',
+        'gender': 'Male', 'contact': '0777777777', 'address': 'cache@example.com'
+    })
+    client_id = client.get('/api/clients/search?q=cached').get_json()[0]['id']
+
+    hits = cache.stats()['hits']
+    assert client.get(f'/api/clients/{client_id}').get_json()['name'] == 'Cached Client'
+    assert client.get(f'/api/clients/{client_id}').get_json()['name'] == 'Cached Client'
+    assert cache.stats()['hits'] == hits + 1
+
+    client.post(f'/edit-client/{client_id}', data={
+        'first_name': 'Renamed', 'last_name': 'Client', 'dob': '1990-01-01',
+        'gender': 'Male', 'contact': '0777777777', 'address': 'cache@example.com'
+    })
+    assert client.get(f'/api/clients/{client_id}').get_json()['name'] == 'Renamed Client'
+
+    # On the shared disk backend another worker's cached copy goes too
+    from cache import Cache, DiskBackend, client_key
+    memory, path = cache.backend, str(tmp_path / 'cache.db')
+    cache.backend, other_worker = DiskBackend(path), Cache(DiskBackend(path))
+    try:
+        assert client.get(f'/api/clients/{client_id}').get_json()['name'] == 'Renamed Client'
+        assert other_worker.get_or_set(client_key(client_id), dict)['name'] == 'Renamed Client'
+        client.post(f'/edit-client/{client_id}', data={
+            'first_name': 'Shared', 'last_name': 'Client', 'dob': '1990-01-01',
+            'gender': 'Male', 'contact': '0777777777', 'address': 'cache@example.com'
+        })
+        assert other_worker.get_or_set(client_key(client_id), dict) == {}
+    finally:
+        cache.backend = memory
+
+    client.delete(f'/api/delete-client/{client_id}')
+    assert client.get(f'/api/clients/{client_id}').status_code == 404
+    assert client.get('/api/cache-stats').get_json()['backend'] == 'memory'
+
+def test_disk_cache_backend(tmp_path):
+    """Test the shared on-disk backend round-trips values and generations."""
+    from cache import Cache, DiskBackend
+
+    shared = Cache(DiskBackend(str(tmp_path / 'cache.db')))
+    other_worker = Cache(DiskBackend(str(tmp_path / 'cache.db')))
+    assert shared.get_or_set('k', lambda: {'v': 1}) == {'v': 1}
+    assert other_worker.get_or_set('k', lambda: {'v': 2}) == {'v': 1}
+    other_worker.delete_many(['k'])
+    assert shared.get_or_set('k', lambda: {'v': 3}) == {'v': 3}
+    shared.bump('programs')
+    assert other_worker.generation('programs') == 1
+
+def test_etag_304_and_gzip(client):
+    """Test conditional GETs answer 304 until data changes, and gzip negotiation."""
+    import gzip
+
+    response = client.get('/api/dashboard-data')
+    tag = response.headers['ETag']
+    assert client.get('/api/dashboard-data', headers={'If-None-Match': tag}).status_code == 304
+
+    client.post('/api/create-client', json={
+        'first_name': 'Etag', 'last_name': 'Client', 'dob': '1990-01-01',
+        'gender': 'Male', 'contact': '0788888888', 'address': 'etag@example.com'
+    })
+    response = client.get('/api/dashboard-data', headers={'If-None-Match': tag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != tag
+
+    for i in range(20):
+        client.post('/api/create-client', json={
+            'first_name': 'Gzip', 'last_name': f'Client{i}', 'dob': '1990-01-01',
+            'gender': 'Female', 'contact': '0799999999', 'address': f'gzip{i}@example.com'
+        })
+    response = client.get('/api/clients', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'].endswith('-gz"')
+    assert isinstance(json.loads(gzip.decompress(response.data)), list)
+    response = client.get('/api/clients', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+    response = client.get('/download-clients-csv', headers={'Accept-Encoding': 'gzip'})
+    assert gzip.decompress(response.data).startswith(b'Name,DOB')
+
+    # Validators are per resource: one client's ETag doesn't match another's
+    first, second = [c['id'] for c in client.get('/api/clients?limit=2').get_json()]
+    tag = client.get(f'/api/clients/{first}').headers['ETag']
+    assert client.get(f'/api/clients/{first}', headers={'If-None-Match': tag}).status_code == 304
+    assert client.get(f'/api/clients/{second}', headers={'If-None-Match': tag}).status_code == 200
+    assert client.get('/api/clients/999999', headers={'If-None-Match': tag}).status_code == 404
+
+def test_database_config_from_environment(monkeypatch):
+    """Test DATABASE_URL normalisation and per-backend engine options."""
+    from config import database_url, engine_options
+
+    monkeypatch.setenv('DATABASE_URL', 'postgres://user:pw@db/cema')
+    monkeypatch.setenv('DB_POOL_SIZE', '12')
+    assert database_url() == 'postgresql://user:pw@db/cema'
+    options = engine_options(database_url())
+    assert options['pool_size'] == 12 and options['pool_pre_ping'] is True
+
+    assert engine_options('sqlite:///healthsystem.db') == {'connect_args': {'timeout': 5.0}}
+    with app.app_context():
+        if db.engine.url.database not in (None, '', ':memory:'):
+            assert db.session.execute(db.text('PRAGMA journal_mode')).scalar() == 'wal'
+
+def test_login_rehashes_password_when_cost_changes(client):
+    """Test that login upgrades a hash made at an older bcrypt cost factor."""
+    from passwords import hasher, hash_rounds
+    rounds = hasher.rounds
+    try:
+        hasher.rounds = 4
+        client.post('/signup', data={'username': 'rehash', 'name': 'Re Hash', 'password': 'pw123456'})
+        hasher.rounds = 5
+        response = client.post('/login', data={'username': 'rehash', 'password': 'pw123456'},
+                               follow_redirects=True)
+        assert b'Welcome Re Hash' in response.data
+        with app.app_context():
+            assert hash_rounds(Doctor.query.filter_by(username='rehash').one().password) == 5
+    finally:
+        hasher.rounds = rounds
+
+def test_login_returns_503_when_hashing_pool_is_saturated(client):
+    """Test that a full hashing pool answers 503 with Retry-After instead of queueing."""
+    from passwords import hasher
+    slots, wait = hasher._slots, hasher.admission_wait
+    while slots.acquire(blocking=False):
+        pass  # take every slot, as a login rush would
+    hasher.admission_wait = 0
+    try:
+        response = client.post('/login', data={'username': 'nobody', 'password': 'x'})
+        assert response.status_code == 503
+        assert int(response.headers['Retry-After']) >= 1
+    finally:
+        hasher.admission_wait = wait
+        hasher.configure(hasher.workers, hasher.max_pending, hasher.rounds, wait)
+
+@pytest.fixture
+def smtp_server():
+    """Minimal local stand-in SMTP server; records connections and delivered messages."""
+    import socketserver
+    import threading
+    mail = get_mail(app)
+    received = {'connections': 0, 'messages': []}
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            received['connections'] += 1
+            self.wfile.write(b'220 localhost ESMTP\r\n')
+            for line in self.rfile:
+                command = line.strip().upper()
+                if command == b'DATA':
+                    self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                    data = b''.join(iter(self.rfile.readline, b'.\r\n'))
+                    received['messages'].append(data)
+                elif command == b'QUIT':
+                    self.wfile.write(b'221 Bye\r\n')
+                    return
+                self.wfile.write(b'250 OK\r\n')
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    saved = {key: app.config.get(key) for key in ('MAIL_SERVER', 'MAIL_PORT', 'MAIL_USE_TLS', 'MAIL_PASSWORD',
+                                                  'MAIL_SUPPRESS_SEND')}
+    app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=server.server_address[1],
+                      MAIL_USE_TLS=False, MAIL_PASSWORD=None, MAIL_SUPPRESS_SEND=False)
+    mail.state = mail.init_app(app)
+    yield received
+    server.shutdown()
+    server.server_close()
+    app.config.update(saved)
+    if saved['MAIL_SUPPRESS_SEND'] is None:
+        del app.config['MAIL_SUPPRESS_SEND']
+    mail.state = mail.init_app(app)
+
+def test_email_outbox_queues_and_sends_batch_over_one_connection(client, smtp_server):
+    """Test that emailing the PDF only queues it, and the sender batches delivery."""
+    import outbox
+    mail = get_mail(app)
+    client.post('/signup', data={'username': 'mailer', 'name': 'Mail Doc', 'password': 'pw'})
+    for to in ('a@example.com', 'b@example.com, c@example.com'):
+        response = client.post('/email-clients-pdf', data={'emails': to})
+        assert response.status_code == 202
+    assert smtp_server['messages'] == []  # nothing sent inside the request
+    status_url = response.get_json()['status_url']
+    assert client.get(status_url).get_json()['status'] == 'queued'
+
+    with app.app_context():
+        assert outbox.deliver_pending(mail, db.session, app.config) == 2
+    assert smtp_server['connections'] == 1 and len(smtp_server['messages']) == 2
+    assert b'client_registry.pdf' in smtp_server['messages'][1]
+    body = client.get(status_url).get_json()
+    assert body['status'] == 'sent' and body['recipients'] == ['b@example.com', 'c@example.com']
+    assert client.get('/api/outbox').get_json()['sent'] == 2
+
+def test_email_outbox_retries_with_backoff_when_smtp_is_down(client, smtp_server):
+    """Test that a failed connection requeues the message with a backoff delay."""
+    import outbox
+    mail = get_mail(app)
+    client.post('/signup', data={'username': 'mailer2', 'name': 'Mail Doc', 'password': 'pw'})
+    status_url = client.post('/email-clients-pdf', data={'emails': 'a@example.com'}).get_json()['status_url']
+    app.config['MAIL_PORT'] = 1  # nothing listens there
+    mail.state = mail.init_app(app)
+    with app.app_context():
+        outbox.deliver_pending(mail, db.session, app.config)
+        # Not due again yet, so a second pass claims nothing
+        assert outbox.deliver_pending(mail, db.session, app.config) == 0
+    body = client.get(status_url).get_json()
+    assert body['status'] == 'queued' and body['attempts'] == 1 and body['last_error']
+    assert body['next_attempt_at'] > body['created_at']
+
+def test_emailed_report_waits_for_its_job_and_requeues_a_lost_one(client, smtp_server):
+    """Test a report email is held back while its job renders, and a lost job is queued again."""
+    import outbox
+    from datetime import timedelta
+    from app import report_cache_dir
+    from models import OutboxMessage
+    from utils import utcnow
+    mail = get_mail(app)
+    lost = 'f' * 24
+    with app.app_context():
+        os.makedirs(report_cache_dir(), exist_ok=True)
+        marker = os.path.join(report_cache_dir(), f'{lost}.pending')
+        with open(marker, 'w') as f:
+            f.write(str(time.time()))
+        row = outbox.enqueue(db.session, 'Report', 'from@example.com', ['a@example.com'],
+                             attachment=('client_registry.pdf', 'application/pdf', None),
+                             report={"kind": 'clients', "params": {}, "job": lost})
+        db.session.commit()
+        message_id = row.id
+
+        # Still rendering: back in the queue without using an attempt
+        assert outbox.deliver_pending(mail, db.session, app.config) == 1
+        row = db.session.get(OutboxMessage, message_id)
+        assert (row.status, row.attempts) == ('queued', 0) and row.next_attempt_at > utcnow()
+        assert smtp_server['messages'] == []
+
+        # The worker died with the job: the next pass queues it again and sends
+        os.remove(marker)
+        row.next_attempt_at = utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        assert outbox.deliver_pending(mail, db.session, app.config) == 1
+        row = db.session.get(OutboxMessage, message_id)
+        assert row.status == 'sent' and json.loads(row.attachment_report)['job'] != lost
+    assert b'client_registry.pdf' in smtp_server['messages'][0]
+
+def test_synthetic_registry_and_benchmark_regression_check(client):
+    """Test the benchmark data generator and the regression comparison."""
+    import os
+    import sys
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+    from synthetic import seed
+    from bench_routes import compare
+
+    with app.app_context():
+        counts = seed(db.session, 300)
+    client.post('/signup', data={'username': 'seeded', 'name': 'Seed Doc', 'password': 'pw'})
+    data = client.get('/api/dashboard-data').get_json()
+    assert data['total_clients'] == 300 and data['total_programs'] == counts['programs']
+    assert sum(p['client_count'] for p in data['programs']) > 300  # most clients are in 1+ programs
+
+    def run(p95, queries):
+        return {'sizes': {'1000': {'routes': {'GET /clients': {'p95_ms': p95, 'queries': queries}}}}}
+    assert compare(run(11, 3), run(10, 3), threshold=0.25, min_ms=2) == []
+    assert len(compare(run(20, 3), run(10, 3), threshold=0.25, min_ms=2)) == 1
+    assert len(compare(run(10, 4), run(10, 3), threshold=0.25, min_ms=2)) == 1
+
+def test_request_metrics_and_query_count_warning(client, caplog):
+    """Test /metrics histograms and the too-many-queries warning."""
+    import metrics
+    metrics.reset()
+    client.post('/signup', data={'username': 'metric', 'name': 'Metric Doc', 'password': 'pw'})
+    for i in range(3):
+        client.post('/api/create-client', json={'first_name': 'M', 'last_name': str(i), 'dob': '1990-01-01',
+                                                'gender': 'Male', 'contact': '1', 'address': 'x'})
+    client.get('/api/clients')
+    client.get('/download-clients-csv').get_data()  # streamed: recorded once drained
+
+    warn = app.config['QUERY_COUNT_WARN']
+    app.config['QUERY_COUNT_WARN'] = 0
+    try:
+        client.get('/api/programs')
+    finally:
+        app.config['QUERY_COUNT_WARN'] = warn
+    assert 'Too many queries: GET /api/programs' in caplog.text
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/clients",status="200"} 1' in text
+    assert 'http_request_sql_queries_count{method="POST",route="/api/create-client"} 3' in text
+    assert 'http_response_size_bytes_count{method="GET",route="/download-clients-csv"} 1' in text
+    assert '# TYPE http_request_sql_duration_seconds histogram' in text
+
+def test_app_factory_builds_isolated_apps_without_heavy_imports(tmp_path):
+    """Test create_app() overrides and that importing app.py stays side-effect free."""
+    import os
+    import subprocess
+    import sys
+    other = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'other.db'}", 'TESTING': True})
+    assert other is not app and (tmp_path / 'other.db').exists()
+    with other.test_request_context():
+        from flask import url_for
+        assert url_for('login') == '/login'  # endpoint names are not blueprint-prefixed
+    assert 'send-outbox' in other.cli.commands
+
+    code = ("import sys, app; print(sorted(m for m in ('reportlab', 'flask_mail', 'bcrypt') if m in sys.modules), "
+            "'_default_app' in vars(app) and app._default_app is None)")
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                         cwd=str(tmp_path), env={'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))}).stdout
+    assert out.strip() == '[] True'
+
+def test_pii_encrypted_at_rest_with_blind_index_search_and_rotation(tmp_path):
+    """Test encrypted client columns, search over blind indexes and key rotation."""
+    from cryptography.fernet import Fernet
+    from sqlalchemy import text
+    from pii import cipher
+    from search import exact_match, search_client_ids
+    from models import Client
+    old_key, new_key = Fernet.generate_key().decode(), Fernet.generate_key().decode()
+    config = {'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'pii.db'}",
+              'PII_ENCRYPTION_KEYS': old_key, 'PII_INDEX_KEY': 'index-secret'}
+    try:
+        encrypted = create_app(config)
+        with encrypted.app_context():
+            import datetime
+            db.session.add_all([
+                Client(name='Wanjiru Kamau', dob=datetime.date(1990, 1, 1), gender='Female',
+                       contact='0712345678', address='12 Kenyatta Avenue, Nairobi'),
+                Client(name='Otieno Wafula', dob=datetime.date(1985, 5, 5), gender='Male',
+                       contact='0798765432', address='4 Oginga Road, Kisumu'),
+            ])
+            db.session.commit()
+            stored = db.session.execute(text("SELECT name, contact FROM client ORDER BY id")).all()
+            assert all(value.startswith('gAAAAA') for row in stored for value in row)
+            assert Client.query.order_by(Client.id).first().name == 'Wanjiru Kamau'
+
+            assert search_client_ids('wanj kam', use_fts=encrypted.config['CLIENT_SEARCH_FTS']) == [1]
+            assert search_client_ids('kenyatta nairobi', use_fts=False) == [1]  # terms past the prefix length
+            assert search_client_ids('kenyattax', use_fts=False) == []
+            assert search_client_ids('0798', use_fts=False) == [2]
+            assert Client.query.filter(exact_match('name', '  otieno WAFULA ')).one().id == 2
+
+        config['PII_ENCRYPTION_KEYS'] = f"{new_key},{old_key}"
+        rotated = create_app(config)
+        result = rotated.test_cli_runner().invoke(args=['pii-rotate'])
+        assert 'Re-encrypted 2 clients' in result.output
+        config['PII_ENCRYPTION_KEYS'] = new_key  # the old key can now be retired
+        with create_app(config).app_context():
+            assert [c.name for c in Client.query.order_by(Client.id)] == ['Wanjiru Kamau', 'Otieno Wafula']
+            assert search_client_ids('otie', use_fts=False) == [2]
+    finally:
+        cipher.configure([])
+
+def test_similarity_search_and_duplicate_check_on_registration(client):
+    """Test the trigram index: typo-tolerant search and the possible-duplicate check."""
+    client.post('/signup', data={'username': 'dupdoc', 'name': 'Dup Doc', 'password': 'pw'})
+    client.post('/login', data={'username': 'dupdoc', 'password': 'pw'})
+    client.post('/api/create-client', json={'first_name': 'Wanjiru', 'last_name': 'Kamau', 'dob': '1990-04-01',
+                                            'gender': 'Female', 'contact': '+254712345678', 'address': 'Nairobi'})
+    client.post('/api/create-client', json={'first_name': 'Otieno', 'last_name': 'Wafula', 'dob': '1985-01-01',
+                                            'gender': 'Male', 'contact': '0798765432', 'address': 'Kisumu'})
+
+    hits = client.get('/api/clients/similar?q=wanjru kamua').get_json()
+    assert [h['name'] for h in hits] == ['Wanjiru Kamau'] and 0 < hits[0]['score'] < 1
+    assert client.get('/api/clients/similar?q=0712345678&field=contact').get_json()[0]['name'] == 'Wanjiru Kamau'
+    dups = client.get('/api/clients/duplicates?name=Otieno Wafula&contact=254798765432').get_json()
+    assert dups[0]['name'] == 'Otieno Wafula' and dups[0]['reasons'] == ['contact', 'name']
+
+    form = {'first_name': 'Wanjiru', 'last_name': 'Kamawu', 'dob': '1990-04-01', 'gender': 'Female',
+            'country_code': '+254', 'contact': '700000001', 'email': 'w@example.com'}
+    response = client.post('/register-client', data=form)
+    assert b'Possible duplicate' in response.data and b'Wanjiru Kamau' in response.data
+    response = client.post('/register-client', data=dict(form, allow_duplicate='1'), follow_redirects=True)
+    assert b'Client registered successfully' in response.data
+    assert len(client_index) == 3
+    # The API registers anyway and reports what it matched
+    created = client.post('/api/create-client', json={'first_name': 'Otieno', 'last_name': 'Wafula', 'dob': '1985-01-01',
+                                                      'gender': 'Male', 'contact': '0700000002', 'address': 'Kisumu'})
+    assert created.status_code == 201 and created.get_json()['possible_duplicates'][0]['reasons'] == ['dob', 'name']
+
+def test_clients_page_is_paginated_and_fragments_cached(client):
+    """The client list renders one capped page of rows, appends the next over XHR and caches fragments."""
+    with client.session_transaction() as sess:
+        sess['logged_in'] = True
+    for i in range(5):
+        client.post('/api/create-client', json={
+            'first_name': 'Paged', 'last_name': f'Client{i}', 'dob': f'199{i}-01-01',
+            'gender': 'Female', 'contact': f'07000000{i:02d}', 'address': 'paged@example.com'
+        })
+
+    page = client.get('/clients?limit=2').get_data(as_text=True)
+    assert page.count('<tr data-id=') == 2
+    next_url = page.split('data-next-url="')[1].split('"')[0].replace('&amp;', '&')
+    assert 'cursor=' in next_url and 'limit=2' in next_url
+
+    xhr = {'X-Requested-With': 'XMLHttpRequest'}
+    rows = client.get(next_url, headers=xhr).get_data(as_text=True)
+    assert rows.count('<tr data-id=') == 2 and '<html' not in rows
+    hits = cache.stats()['hits']
+    assert client.get(next_url, headers=xhr).get_data(as_text=True) == rows
+    assert cache.stats()['hits'] == hits + 1
+
+    # Search and filters are applied on the server, ranked pages use offsets
+    rows = client.get('/clients?search=paged&limit=3', headers=xhr).get_data(as_text=True)
+    assert rows.count('<tr data-id=') == 3 and 'cursor=3' in rows
+    rows = client.get('/clients?after=1993-01-01', headers=xhr).get_data(as_text=True)
+    assert rows.count('<tr data-id=') == 2 and 'load-more' not in rows
+
+    # A new registration changes the data version, so the cached first page is redone
+    client.post('/api/create-client', json={
+        'first_name': 'Late', 'last_name': 'Arrival', 'dob': '1999-01-01',
+        'gender': 'Male', 'contact': '0700000099', 'address': 'late@example.com'
+    })
+    assert 'Late Arrival' in client.get('/clients?after=1993-01-01', headers=xhr).get_data(as_text=True)
+    assert client.get('/clients?limit=100000').status_code == 200
+    assert client.get('/clients?cursor=abc').status_code == 400
+
+    # On the list page ?program= matches part of a program name, ignoring case;
+    # the exports keep the exact name
+    client.post('/signup', data={'username': 'pagedoc', 'name': 'Page Doctor', 'password': 'password123'})
+    client.post('/api/create-program', json={'name': 'Malaria 100% Control'})
+    paged_id = client.get('/api/clients/search?q=paged').get_json()[0]['id']
+    program_id = client.get('/api/programs').get_json()[0]['id']
+    client.post('/api/enroll-client', json={'client_id': paged_id, 'program_ids': [program_id]})
+    assert client.get('/clients?program=malaria', headers=xhr).get_data(as_text=True).count('<tr data-id=') == 1
+    assert client.get('/clients?program=100%25', headers=xhr).get_data(as_text=True).count('<tr data-id=') == 1
+    assert client.get('/clients?program=10_%25', headers=xhr).get_data(as_text=True).count('<tr data-id=') == 0
+    assert client.get('/download-clients-csv?program=malaria').get_data(as_text=True).count('Paged') == 5
+    assert client.get('/download-clients-csv?program=Malaria 100%25 Control').get_data(as_text=True).count('Paged') == 1
+
+def test_core_read_path_matches_orm_shapes_and_orjson_encoding(client):
+    """The Core read layer returns the same documents as the ORM helpers, and the orjson provider encodes like Flask's."""
+    from datetime import date
+    from flask.json.provider import DefaultJSONProvider
+    from app import client_json
+    from models import Client, ProgramModel
+    client.post('/signup', data={'username': 'readdoc', 'name': 'Read Doctor', 'password': 'password123'})
+    client.post('/api/create-program', json={'name': 'HIV, Care'})
+    client.post('/api/create-program', json={'name': 'Empty Program'})
+    for i in range(3):
+        client.post('/api/create-client', json={
+            'first_name': 'Reader', 'last_name': f'Núñez{i}', 'dob': '1990-01-01',
+            'gender': 'Female', 'contact': f'07000001{i:02d}', 'address': 'read@example.com'
+        })
+    with app.app_context():
+        client_ids = [c.id for c in Client.query.order_by(Client.id)]
+        program_id = ProgramModel.query.filter_by(name='HIV, Care').one().id
+    client.post('/api/enrollments/bulk', json={'client_ids': client_ids[:2], 'add': [program_id]})
+
+    clients = client.get('/api/clients').get_json()
+    with app.app_context():
+        expected = [client_json(c) for c in Client.query.order_by(Client.id)]
+    assert clients == expected and clients[0]['programs'] == ['HIV, Care'] and clients[2]['programs'] == []
+    assert client.get(f'/api/clients/{client_ids[0]}').get_json() == expected[0]
+
+    programs = {p['name']: p for p in client.get('/api/programs').get_json()}
+    assert programs['HIV, Care']['created_by'] == 'Read Doctor'
+    assert sorted(programs['HIV, Care']['enrolled_clients']) == ['Reader Núñez0', 'Reader Núñez1']
+    assert programs['Empty Program']['enrolled_clients'] == []
+
+    if app.json.__class__.__name__ == 'OrjsonProvider':
+        document = {'b': [1, 2.5, None], 'a': date(2024, 1, 31), 'name': 'Núñez'}
+        assert json.loads(app.json.dumps(document)) == json.loads(DefaultJSONProvider(app).dumps(document))
+
+def read_changes(client, since, **params):
+    response = client.get('/api/changes', query_string={'since': since, **params})
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    return response, lines
+
+def test_change_feed_records_route_writes_and_compacts(client):
+    """Route writes are logged atomically, served as NDJSON after a seq, and compaction bounds the log."""
+    from changelog import compact
+    from models import ChangeLog, ProgramModel
+    client.post('/signup', data={'username': 'feeddoc', 'name': 'Feed Doctor', 'password': 'password123'})
+    with client.session_transaction() as sess:
+        sess['logged_in'] = True
+    client.post('/api/create-program', json={'name': 'Feed Program'})
+    client.post('/api/create-client', json={
+        'first_name': 'Feed', 'last_name': 'Client', 'dob': '1990-01-01',
+        'gender': 'Female', 'contact': '0700000200', 'address': 'feed@example.com'
+    })
+    client_id = client.get('/api/clients').get_json()[0]['id']
+    with app.app_context():
+        program_id = ProgramModel.query.one().id
+
+    response, entries = read_changes(client, 0)
+    assert response.mimetype == 'application/x-ndjson'
+    assert [(e['entity'], e['action']) for e in entries] == [('program', 'insert'), ('client', 'insert')]
+    assert entries[1]['data'] == client.get(f'/api/clients/{client_id}').get_json()
+    seq = int(response.headers['X-Change-Seq'])
+
+    client.post(f'/edit-client/{client_id}', data={'first_name': 'Fed', 'last_name': 'Client', 'dob': '1990-01-01',
+                                                   'gender': 'Female', 'contact': '0700000200', 'address': 'x'})
+    client.post(f'/enroll-client/{client_id}', data={'programs': [program_id]})
+    response, entries = read_changes(client, seq)
+    assert [(e['entity'], e['action']) for e in entries] == [('client', 'update'), ('enrollment', 'enroll')]
+    assert entries[0]['data']['name'] == 'Fed Client' and entries[1]['program_id'] == program_id
+
+    # Paged by ?limit=, then deletes; the update above now has no row to carry
+    response, page = read_changes(client, 0, limit=1)
+    assert len(page) == 1 and response.headers['X-Next-Cursor'] == str(page[0]['seq'])
+    client.get(f'/programs/delete/{program_id}')
+    client.get(f'/delete-client/{client_id}')
+    _, entries = read_changes(client, seq)
+    assert [(e['entity'], e['action']) for e in entries][-3:] == [
+        ('enrollment', 'unenroll'), ('program', 'delete'), ('client', 'delete')]
+    assert not any(e['entity'] == 'client' and e['action'] == 'update' for e in entries)
+    unenrolled_at = entries[-3]['seq']
+
+    # Compaction keeps the latest entry per row, then caps the log
+    with app.app_context():
+        with db.engine.begin() as connection:
+            superseded, truncated = compact(connection, max_rows=2)
+        assert superseded == 4 and truncated == 1
+        assert ChangeLog.query.count() == 2
+    assert client.get(f'/api/changes?since={seq}').status_code == 410
+    _, entries = read_changes(client, unenrolled_at)
+    assert [(e['entity'], e['action']) for e in entries] == [('program', 'delete'), ('client', 'delete')]
+    assert client.get('/api/changes?since=abc').status_code == 400
+
+    # A delete survives compaction even when the id is used again after it
+    from datetime import datetime
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(ChangeLog.__table__.insert(), [
+                {'entity': 'client', 'entity_id': 500, 'related_id': 0, 'action': action,
+                 'changed_at': datetime(2024, 1, 1)} for action in ('insert', 'update', 'delete', 'insert')])
+            compact(connection, max_rows=100)
+        assert [e.action for e in ChangeLog.query.filter_by(entity_id=500).order_by(ChangeLog.seq)] == ['delete', 'insert']
+
+def test_analytics_rollups_follow_writes_and_match_rebuild(client):
+    """Demographic rollups move with registrations, edits, enrollments and deletes, as a rebuild would count them."""
+    from datetime import date
+    import analytics
+    from models import DemographicStat, ProgramModel
+    client.post('/signup', data={'username': 'statsdoc', 'name': 'Stats Doctor', 'password': 'password123'})
+    with client.session_transaction() as sess:
+        sess['logged_in'] = True
+    client.post('/api/create-program', json={'name': 'Cohort Program'})
+    for first, dob, gender in (('Ann', '1990-03-01', 'Female'), ('Ben', '2020-06-01', 'Male'), ('Cal', '1950-01-01', 'Male')):
+        client.post('/api/create-client', json={'first_name': first, 'last_name': 'Stats', 'dob': dob, 'gender': gender,
+                                                'contact': f'07{len(first)}{dob[:4]}', 'address': f'{first}@example.com'})
+    ids = {c['name'].split()[0]: c['id'] for c in client.get('/api/clients').get_json()}
+    with app.app_context():
+        program_id = ProgramModel.query.one().id
+    for name in ('Ann', 'Ben', 'Cal'):
+        client.post(f"/enroll-client/{ids[name]}", data={'programs': [program_id]})
+    client.post(f"/edit-client/{ids['Ben']}", data={'first_name': 'Ben', 'last_name': 'Stats', 'dob': '2015-06-01',
+                                                   'gender': 'Female', 'contact': '0700000301', 'address': 'x'})
+    client.get(f"/delete-client/{ids['Cal']}")
+
+    def age(year):
+        return next(label for low, label in reversed(analytics.AGE_BANDS) if date.today().year - year >= low)
+
+    data = client.get('/api/analytics?months=3').get_json()
+    assert data['registry']['total'] == 2 and data['genders'] == ['Female']
+    assert data['registry']['by_age_band'][age(1990)] == 1 and data['registry']['by_age_band'][age(2015)] == 1
+    program = data['programs'][0]
+    assert program['name'] == 'Cohort Program' and program['by_gender'] == {'Female': 2}
+    assert data['trends']['registrations'][-1] == 3 and data['trends']['removals'][-1] == 1
+    assert data['trends']['programs'][0]['enrolled'][-1] == 3 and len(data['trends']['months']) == 3
+    assert client.get('/api/analytics?months=0').status_code == 400
+
+    with app.app_context():
+        incremental = {(r.program_id, r.gender, r.birth_year): r.client_count
+                       for r in DemographicStat.query.all() if r.client_count}
+        analytics.rebuild(db.session.connection())
+        db.session.commit()
+        assert incremental == {(r.program_id, r.gender, r.birth_year): r.client_count for r in DemographicStat.query.all()}
+
+    page = client.get('/summary').get_data(as_text=True)
+    assert 'Cohort Program' in page and age(1990) in page
+
+def test_archive_moves_inactive_clients_and_deleted_programs_and_restores_them(client):
+    """Inactive clients and deleted programs leave the hot tables for the archive and come back on restore."""
+    import archive
+    from models import ProgramModel
+    client.post('/signup', data={'username': 'archdoc', 'name': 'Arch Doctor', 'password': 'password123'})
+    with client.session_transaction() as sess:
+        sess['logged_in'] = True
+    client.post('/api/create-program', json={'name': 'Archive Program'})
+    for first in ('Active', 'Idle', 'Newest'):
+        client.post('/api/create-client', json={'first_name': first, 'last_name': 'Person', 'dob': '1990-01-01',
+                                                'gender': 'Female', 'contact': f'07000{len(first)}', 'address': 'x'})
+    ids = {c['name'].split()[0]: c['id'] for c in client.get('/api/clients').get_json()}
+    with app.app_context():
+        program_id = ProgramModel.query.one().id
+    client.post(f"/enroll-client/{ids['Active']}", data={'programs': [program_id]})
+    idle = client.get(f"/api/clients/{ids['Idle']}").get_json()
+
+    with app.app_context():
+        assert archive.archive_clients(idle_days=30) == 0  # everyone was active just now
+        from datetime import timedelta
+        from sqlalchemy import update
+        from models import Client
+        from utils import utcnow
+        db.session.execute(update(Client).values(updated_at=utcnow() - timedelta(days=60)))
+        db.session.commit()
+    # Unenrolling is activity too
+    client.post(f"/enroll-client/{ids['Active']}", data={'programs': []})
+    with app.app_context():
+        assert archive.archive_clients(idle_days=30, batch_size=1) == 1  # the newest client stays hot
+    client.post(f"/enroll-client/{ids['Active']}", data={'programs': [program_id]})
+    assert [c['name'] for c in client.get('/api/clients').get_json()] == ['Active Person', 'Newest Person']
+    assert client.get(f"/api/clients/{ids['Idle']}").status_code == 404
+    assert client.get('/api/dashboard-data').get_json()['total_clients'] == 2
+    archived = client.get('/api/archive/clients').get_json()
+    assert len(archived) == 1 and archived[0]['archived_at']
+    assert {k: v for k, v in archived[0].items() if k != 'archived_at'} == idle
+
+    response = client.post(f"/api/archive/clients/{ids['Idle']}/restore")
+    assert response.get_json() == {"id": ids['Idle']}
+    assert client.get(f"/api/clients/{ids['Idle']}").get_json() == idle
+    assert client.get('/api/archive/clients').get_json() == []
+    assert client.post(f"/api/archive/clients/{ids['Idle']}/restore").status_code == 404
+
+    # Deleting a program archives it with its enrollments
+    client.get(f'/programs/delete/{program_id}')
+    assert client.get('/api/programs').get_json() == []
+    programs = client.get('/api/archive/programs').get_json()
+    assert [(p['name'], p['client_ids']) for p in programs] == [('Archive Program', [ids['Active']])]
+    response = client.post(f'/api/archive/programs/{program_id}/restore')
+    assert response.get_json() == {"id": program_id, "enrolled": 1}
+    assert client.get(f"/api/clients/{ids['Active']}").get_json()['programs'] == ['Archive Program']
+    assert client.get('/api/archive/programs').get_json() == []
+
+def pdf_pages_and_text(data):
+    """Page count and decompressed page contents of a PDF written by reports.py."""
+    import base64
+    import re
+    import zlib
+    streams = re.findall(rb'stream\r?\n(.*?)~>endstream', data, re.S)  # ASCII85 + Flate page contents
+    text = b''.join(zlib.decompress(base64.a85decode(m.replace(b'\n', b''))) for m in streams)
+    return len(re.findall(rb'/Type /Page\b(?!s)', data)), text
+
+def test_pdf_reports_render_chunked_tables_across_pages(client):
+    """Reports stream rows in chunks into wrapped tables over as many pages as needed."""
+    import io
+    from datetime import date
+    from models import Client, ProgramModel
+    from reports import render_clients_pdf, render_programs_pdf, render_report
+    with app.app_context():
+        db.session.add(Doctor(username='pdfdoc', name='Pdf Doctor', password='x'))
+        db.session.flush()
+        program = ProgramModel(name='Outreach ' + 'x' * 80, created_by=1)
+        db.session.add_all([Client(name=f'Client {i:03d} ' + 'Longname' * 6, dob=date(1990, 1, 1), gender='Female',
+                                   contact=f'07{i:08d}', address='a', programs=[program]) for i in range(120)])
+        db.session.commit()
+
+        out = io.BytesIO()
+        render_report('clients', db.session, out, {})
+        pages, text = pdf_pages_and_text(out.getvalue())
+        assert pages > 2 and text.count(b'(Name)') == pages  # header row on every page
+        assert b'Client 119' in text and b'Page 1' in text
+
+        out = io.BytesIO()
+        assert render_clients_pdf(db.session, out, program='missing', after='2000-01-01', chunk_size=7) == 0
+        assert b'No records.' in pdf_pages_and_text(out.getvalue())[1]
+        out = io.BytesIO()
+        assert render_programs_pdf(db.session, out) == 1
+        assert b'Pdf Doctor' in pdf_pages_and_text(out.getvalue())[1]
+
+    client.post('/signup', data={'username': 'mailpdf', 'name': 'Mail Pdf', 'password': 'pw'})
+    client.post('/email-clients-pdf', data={'emails': 'a@example.com'})
+    with app.app_context():
+        from app import load_report_attachment
+        from models import OutboxMessage
+        row = OutboxMessage.query.one()  # queued with its report job; the PDF is read when it is sent
+        assert row.attachment is None
+        assert pdf_pages_and_text(load_report_attachment(json.loads(row.attachment_report)))[0] == pages
+
+def test_pdf_reports_are_drawn_in_parts_with_flat_memory():
+    """Reports are drawn a few pages at a time and joined, so peak memory doesn't grow with the row count."""
+    import io
+    import tracemalloc
+    from reports import render_table
+
+    def render(out, rows, part_pages):
+        chunks = ([(f'Client {i}', '1990-01-01', 'Female', f'07{i:08d}', 'Outreach')
+                   for i in range(start, min(rows, start + 100))] for start in range(0, rows, 100))
+        return render_table(out, 'Parts', 'Joined', ['Name', 'DOB', 'Gender', 'Contact', 'Programs'],
+                            [0.24, 0.11, 0.1, 0.17, 0.38], chunks, part_pages=part_pages)
+
+    out = io.BytesIO()
+    assert render(out, 300, 2) == 300
+    data = out.getvalue()
+    pages, text = pdf_pages_and_text(data)
+    assert pages > 6 and text.count(b'(Name)') == pages and text.count(b'(Parts)') == 1
+    assert f'(Page {pages})'.encode() in text and b'Client 299' in text  # numbered across parts
+    assert data.count(b'/Type /Catalog') == 1 and f'/Count {pages} '.encode() in data
+
+    def peak(rows):
+        with open(os.devnull, 'wb') as out:
+            tracemalloc.start()
+            try:
+                render(out, rows, 4)
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+    small, large = peak(300), peak(1500)
+    assert large < small * 1.2
+
+def test_report_jobs_decrypt_pii_in_worker_processes(tmp_path):
+    """Test a report rendered on the process pool shows decrypted client fields."""
+    from datetime import date
+    from cryptography.fernet import Fernet
+    import jobs
+    from models import Client
+    from pii import cipher
+    encrypted = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'jobs.db'}",
+                            'PII_ENCRYPTION_KEYS': Fernet.generate_key().decode(), 'PII_INDEX_KEY': 'index-secret',
+                            'REPORT_CACHE_DIR': str(tmp_path / 'reports'), 'REPORT_WAIT_SECONDS': 0})
+    try:
+        with encrypted.app_context():
+            db.session.add(Client(name='Pooled Secret', dob=date(1990, 1, 1), gender='Female',
+                                  contact='0711000111', address='1 Pool Lane'))
+            db.session.commit()
+        http = encrypted.test_client()
+        job = http.post('/api/reports/clients').get_json()['job_id']
+        for _ in range(150):
+            status = http.get(f'/api/reports/jobs/{job}').get_json()['status']
+            if status != 'pending':
+                break
+            time.sleep(0.2)
+        assert status == 'done'
+        response = http.get(f'/api/reports/jobs/{job}/download')
+        text = pdf_pages_and_text(response.data)[1]
+        response.close()
+        assert b'Pooled Secret' in text and b'gAAAAA' not in text
+        # Nobody waited on the job, its future is still dropped once it finishes
+        for _ in range(50):
+            if job not in jobs._futures:
+                break
+            time.sleep(0.1)
+        assert job not in jobs._futures
+    finally:
+        cipher.configure([])
@@ -1,5 +1,51 @@
-from storage import clients
+from datetime import datetime, timezone
+from storage import client_index
 
-# Utility function to search for clients by name (case-insensitive)
-def search_clients(query):
-    return [client for client in clients.values() if query.lower() in client.name.lower()]
\ No newline at end of file
+# Keyset pagination defaults for the JSON APIs
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Typo-tolerant client name lookup on the in-memory trigram index:
+# [(client_id, similarity)], best match first
+def search_clients(query, limit=10):
+    return client_index.search(query, limit)
+
+# Current UTC time as a naive datetime, the form the DateTime columns hold
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+# Parse a YYYY-MM-DD form/API value into a date (raises ValueError)
+def parse_date(value):
+    return datetime.strptime((value or '').strip(), "%Y-%m-%d").date()
+
+# Read ?cursor= and ?limit= from the request args, clamping the page size
+def parse_page_args(args, default_limit=DEFAULT_PAGE_SIZE, max_limit=MAX_PAGE_SIZE):
+    try:
+        cursor = int(args.get('cursor', 0))
+        limit = int(args.get('limit', default_limit))
+    except ValueError:
+        raise ValueError("cursor and limit must be integers")
+    if cursor < 0 or limit < 1:
+        raise ValueError("cursor must be >= 0 and limit >= 1")
+    return cursor, min(limit, max_limit)
+
+# Fetch one page of `query` ordered by `column`, starting after `cursor`.
+# Returns (rows, next_cursor); next_cursor is None on the last page.
+def keyset_page(query, column, cursor, limit):
+    rows = query.filter(column > cursor).order_by(column).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = getattr(rows[-1], column.key)
+    return rows, next_cursor
+
+# Walk `query` in keyset order, yielding lists of at most `chunk_size` rows so
+# that callers never hold more than one chunk in memory.
+def iter_chunks(query, column, chunk_size=500):
+    cursor = 0
+    while True:
+        rows, cursor = keyset_page(query, column, cursor, chunk_size)
+        if rows:
+            yield rows
+        if cursor is None:
+            return
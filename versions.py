@@ -0,0 +1,51 @@
+# versions.py
+# Per-table data version counters. Every recorded change (see changes.py) bumps
+# the counter of each table it wrote to, inside the same transaction, so a
+# cached artifact keyed on the versions is stale exactly when the data changed.
+from sqlalchemy import insert, select, update
+from changes import on_flush
+from models import db, DataVersion
+
+TRACKED_TABLES = ('client', 'program_model', 'enrollments')
+
+# Create the counter rows that don't exist yet (call once at startup)
+def init_versions():
+    existing = {row.table_name for row in DataVersion.query.all()}
+    for table in TRACKED_TABLES:
+        if table not in existing:
+            db.session.add(DataVersion(table_name=table, version=0))
+    db.session.commit()
+
+# Bump the counters for `tables` on `connection`
+def bump(connection, *tables):
+    if not tables:
+        return
+    result = connection.execute(
+        update(DataVersion)
+        .where(DataVersion.table_name.in_(tables))
+        .values(version=DataVersion.version + 1)
+    )
+    if result.rowcount < len(set(tables)):
+        # Counter rows missing (e.g. tables recreated after startup)
+        existing = set(connection.execute(
+            select(DataVersion.table_name).where(DataVersion.table_name.in_(tables))
+        ).scalars())
+        connection.execute(insert(DataVersion), [
+            {"table_name": t, "version": 1} for t in set(tables) - existing
+        ])
+
+# Current {table: version} mapping
+def current_versions(session=None):
+    session = session or db.session
+    return dict(session.execute(select(DataVersion.table_name, DataVersion.version)).all())
+
+# Compact string form used in cache keys
+def version_tag(*tables, session=None):
+    versions = current_versions(session)
+    tables = tables or TRACKED_TABLES
+    return '.'.join(str(versions.get(t, 0)) for t in tables)
+
+@on_flush
+def _bump_on_flush(connection, changes):
+    bump(connection, *changes.tables)
+    changes.versions = dict(connection.execute(select(DataVersion.table_name, DataVersion.version)).all())